@@ -9,9 +9,9 @@ from queue import Queue
 
 from labchain.blockchainNodeBootstrap import Bootstrapper
 from labchain.consensus.consensus import Consensus
-from labchain.databaseInterface import Db
+from labchain.consensus.proofOfAuthority import ProofOfAuthority
+from labchain.databaseInterface import Db, BlockPersister
 from labchain.datastructure.block import Block
-from labchain.datastructure.block import LogicalBlock
 from labchain.datastructure.blockchain import BlockChain
 from labchain.datastructure.txpool import TxPool
 from labchain.network.networking import JsonRpcClient
@@ -40,7 +40,7 @@ class BlockChainNode:
 
         Attributes
         ----------
-        consensus_obj : Instance of Consensus module
+        consensus_obj : Instance of the ConsensusEngine configured in section CONSENSUS
         crypto_helper_obj : Instance of CryptoHelper module
         blockchain_obj : Instance of BlockChain module
         txpool_obj : Instance of TxPool module
@@ -53,6 +53,7 @@ class BlockChainNode:
         initial_peers : Networking module configured with initial neighbour peers
         config_reader : Instance of the ConfigReader module
         db : DB instance for saving the blockchain data to disk
+        persister : BlockPersister writing new blocks to db in the background, None if disabled
         logger : Instane of logging
         rb_thread : Thread which polls in intervals for blocks requested
 
@@ -63,6 +64,17 @@ class BlockChainNode:
         self.txpool_obj = None
         self.mine_thread = None
         self.orphan_killer = None
+        self.snapshot_thread = None
+        self.status_thread = None
+        self.node_id = None
+        # Wakes the mining thread, see block_mine_timer
+        self.mine_wakeup = threading.Event()
+        self.mine_shutdown = threading.Event()
+        self.mine_threshold = None
+        # Guards _mining_block, _head_hash and kill_mine of the consensus
+        self._mining_lock = threading.Lock()
+        self._mining_block = None
+        self._head_hash = None
         self.network_interface = None
         self.webserver_thread = None
         self.polling_thread = None
@@ -72,6 +84,7 @@ class BlockChainNode:
         self.peer_discovery = peer_discovery
         self.config_reader = None
         self.db = None
+        self.persister = None
         self.logger = logging.getLogger(__name__)
         self.rb_thread = None
         self.q = None
@@ -109,6 +122,31 @@ class BlockChainNode:
                         "Error getting block from neighbour " + str(e))
             time.sleep(interval)
 
+    def schedule_snapshots(self, interval, snapshot_dir):
+        """Write a snapshot of the blockchain at the interval defined"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.blockchain_obj.write_snapshot(snapshot_dir)
+            except Exception as e:
+                self.logger.error("Error writing snapshot " + str(e))
+
+    def schedule_status_logging(self, interval):
+        """Log the statistics of the node at the interval defined"""
+        while True:
+            time.sleep(interval)
+            self.logger.info("Node statistics: " + json.dumps(self.get_statistics()))
+
+    def get_statistics(self):
+        """Returns a dictionary with the statistics of the node components,
+        the queue of the block persister is only included if it is enabled"""
+        lock_wait_sec, lock_contended_acquires = self.blockchain_obj.get_lock_wait_statistics()
+        statistics = {'blockchain_lock': {'wait_sec': lock_wait_sec,
+                                          'contended_acquires': lock_contended_acquires}}
+        if self.persister is not None:
+            statistics['persister'] = self.persister.get_statistics()
+        return statistics
+
     def schedule_orphans_killing(self, interval):
         """Kill orphan blocks at interval defined"""
         while True:
@@ -116,9 +154,12 @@ class BlockChainNode:
             time.sleep(interval)
 
     def block_mine_timer(self, mine_freq, block_transactions_size):
-        """Thread which periodically checks to mine
-        Note: to start mining based on number of transactions,
-        there needs to be either a discussion on few approaches
+        """Thread which mines blocks. A mining attempt starts once mine_freq
+        seconds passed since the last block was mined, when a block of
+        another node becomes the head of the chain or when the transaction
+        pool holds enough transactions for a block, but not before the
+        consensus lets this node create the next block. It runs until
+        stop_mining is called.
 
         Parameters
         ----------
@@ -127,36 +168,123 @@ class BlockChainNode:
         block_transactions_size: Integer
             Maximum number of transactions to put in a block
         """
-        next_call = time.time()
-        while True:
-            # check the last call of mine from consensus component
-            if next_call - self.consensus_obj.last_mine_time_sec >= mine_freq:
-                transactions = self.txpool_obj.get_transactions(
-                    block_transactions_size)
-                block = self.blockchain_obj.create_block(transactions)
-                self.blockchain_obj.active_mine_block_update(block)
-                _timestamp2, _timestamp1, _num_of_blocks, _min_blocks, _difficulty = self.blockchain_obj.calculate_diff(
-                    block.predecessor_hash)
-                self.logger.debug("Created new block, try to mine")
-                st = time.time()
-
-                if self.consensus_obj.mine(block, _timestamp2, _timestamp1,
-                                           _num_of_blocks, _min_blocks, _difficulty):
-                    # have to check if other node already created a block
-                    self.logger.debug("Mining was successful for new block")
-                    if self.blockchain_obj.add_block(block):
-                        self.on_new_block_created(block)
+        mining_delay = 0
+        while not self.mine_shutdown.is_set():
+            delay_time = mine_freq - (time.time() - self.consensus_obj.last_mine_time_sec)
+            if mining_delay is None or mining_delay > delay_time:
+                # Only a new head can let this node create a block earlier
+                delay_time = mining_delay
+            if delay_time is None or delay_time > 0:
+                self.logger.debug(
+                    "Mining Thread waits up to {t} secs".format(t=delay_time))
+                self.mine_wakeup.wait(delay_time)
+            self.mine_wakeup.clear()
+            if self.mine_shutdown.is_set():
+                break
+            mining_delay = self.mine_block(block_transactions_size)
+
+    def mine_block(self, block_transactions_size):
+        """Mines a block on the head of the chain. If a new head aborts the
+        attempt, the block is built again on the new head right away. If the
+        consensus does not let this node create the next block yet, e.g.
+        because another authority has to sign it, no block is built and the
+        transactions stay in the pool.
+
+        Parameters
+        ----------
+        block_transactions_size: Integer
+            Maximum number of transactions to put in a block
+
+        Returns
+        -------
+        Float
+            Seconds until this node may create the next block, None if only
+            a new head can change that
+        """
+        while not self.mine_shutdown.is_set():
+            head = self.blockchain_obj.get_head_block()
+            mining_delay = self.consensus_obj.get_mining_delay(head.block_id + 1, head.timestamp)
+            if mining_delay is None or mining_delay > 0:
+                self.logger.debug("Not the turn of this node to create a block")
+                return mining_delay
+            transactions = self.txpool_obj.get_transactions(
+                block_transactions_size)
+            block = self.blockchain_obj.create_block(transactions)
+            with self._mining_lock:
+                # A head which arrived while the last attempt succeeded left kill_mine set
+                self.consensus_obj.kill_mine = 0
+                self._mining_block = block
+                # A head which arrived after create_block but before _mining_block was set did not abort the attempt
+                on_head = not self.mine_shutdown.is_set() and block.predecessor_hash == head.get_computed_hash() and \
+                    (self._head_hash is None or block.predecessor_hash == self._head_hash)
+            self.blockchain_obj.active_mine_block_update(block)
+            _timestamp2, _timestamp1, _num_of_blocks, _min_blocks, _difficulty = self.blockchain_obj.calculate_diff(
+                block.predecessor_hash)
+            self.logger.debug("Created new block, try to mine")
+            st = time.time()
+
+            mined = False
+            if on_head:
+                mined = self.consensus_obj.mine(block, _timestamp2, _timestamp1,
+                                                _num_of_blocks, _min_blocks, _difficulty, predecessor=head)
+            with self._mining_lock:
+                self._mining_block = None
+            self.blockchain_obj.active_mine_block_update(None)
+            if mined:
+                # have to check if other node already created a block
+                self.logger.debug("Mining was successful for new block")
+                if self.blockchain_obj.add_block(block):
+                    self.on_new_block_created(block)
                 self.logger.debug("Time to mine block is " + str(
                     time.time() - st) + " seconds.")
-            self.blockchain_obj.active_mine_block_update(None)
-            delay_time = mine_freq - (
-                    time.time() - self.consensus_obj.last_mine_time_sec)
-            if delay_time < 0:
-                delay_time = 1
-            self.logger.debug(
-                "Mining Thread sleep for {t} secs".format(t=delay_time))
-            time.sleep(delay_time)
-            next_call = time.time()
+                return 0
+            # Transactions of the block which aborted the attempt are on the chain, the others
+            # may have been returned by check_block_in_mining already
+            unmined_transactions = [t for t in transactions
+                                    if self.blockchain_obj.get_transaction(t.transaction_hash)[0] is None]
+            self.txpool_obj.return_transactions_to_pool(unmined_transactions, self.blockchain_obj)
+            self.logger.debug("Mining aborted after " + str(time.time() - st) + " seconds.")
+            if block.predecessor_hash == head.get_computed_hash() and \
+                    (self._head_hash is None or block.predecessor_hash == self._head_hash):
+                # The head did not change, the attempt was aborted for another reason
+                return 0
+        return 0
+
+    def stop_mining(self):
+        """Aborts the running mining attempt and ends the mining thread"""
+        with self._mining_lock:
+            self.mine_shutdown.set()
+            self.consensus_obj.kill_mine = 1
+        self.mine_wakeup.set()
+
+    def stop(self):
+        """Stops mining, the mining and signature verification processes
+        and writes the blocks queued for the DB. The threads serving the
+        network keep running, the process is expected to exit afterwards."""
+        self.logger.info("Stopping node...")
+        self.stop_mining()
+        if self.mine_thread is not None:
+            self.mine_thread.join()
+        self.consensus_obj.close()
+        self.crypto_helper_obj.close()
+        if self.persister is not None:
+            self.logger.info("Writing {} queued blocks to DB".format(
+                self.persister.get_statistics()['queue_depth']))
+            self.persister.stop()
+        self.db.close()
+        self.logger.info("Node stopped")
+
+    def on_new_head(self, block):
+        """Called by the blockchain when its head changes. Aborts mining on
+        the old head and starts mining on the new one, unless the new head
+        was mined by this node."""
+        with self._mining_lock:
+            self._head_hash = block.get_computed_hash()
+            mining_block = self._mining_block
+            if mining_block is not None and mining_block.predecessor_hash != self._head_hash:
+                self.consensus_obj.kill_mine = 1
+        if not block.is_block_ours(self.node_id):
+            self.mine_wakeup.set()
 
     def on_get_transaction(self, transaction_hash):
         """Retrieve a transaction from the blockchain or the transaction
@@ -193,26 +321,30 @@ class BlockChainNode:
     # for workflow transaction utils
     def get_previous_transaction(self, current_task_transaction) -> TaskTransaction:
         current_in_charge = current_task_transaction.in_charge
-        for transaction in self.txpool_obj.get_task_transactions():
-            if transaction.next_in_charge == current_in_charge:
+        for transaction in self.txpool_obj.get_task_transactions_by_next_in_charge(current_in_charge):
+            if isinstance(transaction, TaskTransaction) and not isinstance(transaction, WorkflowTransaction):
                 return transaction
-        for transaction in self.blockchain_obj.get_task_transactions():
-            if transaction.next_in_charge == current_in_charge:
+        for transaction in self.blockchain_obj.get_task_transactions_by_next_in_charge(current_in_charge):
+            if isinstance(transaction, TaskTransaction) and not isinstance(transaction, WorkflowTransaction):
                 return transaction
         return None
 
     def get_workflow_transaction(self, task_transaction) -> WorkflowTransaction:
-        workflow_id = task_transaction.workflowID
+        workflow_id = task_transaction.workflow_ID
         for transaction in self.txpool_obj.get_workflow_transactions():
-            if transaction.workflowID == workflow_id:
+            if transaction.workflow_ID == workflow_id:
                 return transaction
         for transaction in self.blockchain_obj.get_workflow_transactions():
-            if transaction.workflowID == workflow_id:
+            if transaction.workflow_ID == workflow_id:
                 return transaction
         return None
 
     def on_new_transaction_received(self, transaction):
-        return self.txpool_obj.add_transaction_if_not_exist(transaction, self.blockchain_obj)
+        added = self.txpool_obj.add_transaction_if_not_exist(transaction, self.blockchain_obj)
+        if added and self.mine_threshold and self.txpool_obj.get_transaction_count() >= self.mine_threshold:
+            # Enough transactions for a block, mine without waiting for the next interval
+            self.mine_wakeup.set()
+        return added
 
     def on_new_block_received(self, block):
         """Callback method to pass to network, call add block method in block chain"""
@@ -273,24 +405,41 @@ class BlockChainNode:
                                       self.on_get_highest_workflow_ID,
                                       self.peer_discovery, ip, port)
 
-    def reinitialize_blockchain_from_db(self):
-        """Restore DB by fetching entries from Blockchain"""
-        return self.db.get_blockchain_from_db()
+    def reinitialize_blockchain_from_db(self, load_mode='FULL', snapshot_dir=None):
+        """Restore the Blockchain from the newest snapshot and the DB. The
+        blocks saved after the snapshot are streamed from the DB and added
+        in chunks.
+
+        Parameters
+        ----------
+        load_mode : String
+            FULL validates every block again, TRUSTED only checks the stored
+            hash chain and MERKLE checks the merkle roots as well
+        snapshot_dir : String
+            Directory of the snapshot files, None to load every block from the DB
+
+        Returns
+        -------
+        Int
+            Number of blocks added from the DB
+        """
+        mark = self.blockchain_obj.load_snapshot(snapshot_dir) if snapshot_dir else None
+        return self.blockchain_obj.add_stored_blocks(
+            self.db.iterate_blockchain_from_db(with_hashes=True, after_mark=mark),
+            trusted=load_mode != 'FULL',
+            verify_merkle_root=load_mode == 'MERKLE')
 
     def initialize_components(self, new_database):
         """ Initialize every component of the node"""
         self.logger.debug("Initialized every component for the node")
-        self.consensus_obj = Consensus()
         self.crypto_helper_obj = CryptoHelper.instance()
         self.txpool_obj = TxPool(crypto_helper_obj=self.crypto_helper_obj)
-        self.db = Db(block_chain_db_file=os.path.abspath(os.path.join(
-            os.path.dirname(__file__), 'resources/labchaindb.sqlite')), create_new_database=new_database)
-
         """init blockchain"""
         # Generate the node ID using host ID
         node_uuid = str(uuid.uuid1())
         node_id = node_uuid
         self.logger.info("Creator id " + str(node_id))
+        self.node_id = node_id
 
         # Read all configurations to be used
         try:
@@ -303,6 +452,38 @@ class BlockChainNode:
             fetch_prev_interval = self.config_reader.get_config(
                 section='BLOCK_CHAIN',
                 option='FETCH_PREV_INTERVAL')
+            max_resident_transactions = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='MAX_RESIDENT_TRANSACTIONS',
+                fallback=0)
+            db_write_queue_size = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='DB_WRITE_QUEUE_SIZE',
+                fallback=0)
+            db_synchronous = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='DB_SYNCHRONOUS',
+                fallback='FULL')
+            db_cache_size = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='DB_CACHE_SIZE_KIB',
+                fallback=0)
+            db_load_mode = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='DB_LOAD_MODE',
+                fallback='FULL')
+            snapshot_interval = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='SNAPSHOT_INTERVAL_SEC',
+                fallback=0)
+            signature_workers = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='SIGNATURE_WORKERS',
+                fallback=1)
+            status_log_interval = self.config_reader.get_config(
+                section='BLOCK_CHAIN',
+                option='STATUS_LOG_INTERVAL_SEC',
+                fallback=0)
             if not self.network_port:
                 self.network_port = self.config_reader.get_config(
                     section='NETWORK',
@@ -319,13 +500,48 @@ class BlockChainNode:
                 option='BLOCK_TRANSACTION_SIZE')
             min_blocks = self.config_reader.get_config(section='MINING',
                                                        option='NUM_OF_BLOCKS_FOR_DIFFICULTY')
+            mining_workers = self.config_reader.get_config(section='MINING',
+                                                           option='MINING_WORKERS',
+                                                           fallback=1)
+            consensus_engine = self.config_reader.get_config(section='CONSENSUS',
+                                                             option='ENGINE',
+                                                             fallback='POW')
+            if consensus_engine == 'POA':
+                authorities = json.loads(self.config_reader.get_config(section='CONSENSUS',
+                                                                       option='AUTHORITIES'))
+                out_of_turn_delay = self.config_reader.get_config(section='CONSENSUS',
+                                                                  option='OUT_OF_TURN_DELAY_SEC',
+                                                                  fallback=30)
+                try:
+                    signer_private_key = self.config_reader.get_config(section='CONSENSUS',
+                                                                       option='SIGNER_PRIVATE_KEY')
+                except ConfigReaderException:
+                    # Nodes which are no authority only validate the blocks
+                    signer_private_key = None
         except ConfigReaderException as e:
             self.logger.error(str(e))
             self.logger.error("Exiting Node startup ..!! \n")
             sys.exit(0)
 
+        if consensus_engine == 'POA':
+            self.consensus_obj = ProofOfAuthority(authorities, signer_private_key, out_of_turn_delay,
+                                                  block_period=mine_freq)
+        else:
+            self.consensus_obj = Consensus()
+
+        # stop ends the mining processes
+        self.consensus_obj.set_mining_workers(mining_workers or os.cpu_count() or 1)
+        # stop ends the verification processes
+        self.crypto_helper_obj.set_verification_workers(signature_workers or os.cpu_count() or 1)
+
+        self.db = Db(block_chain_db_file=os.path.abspath(os.path.join(
+            os.path.dirname(__file__), 'resources/labchaindb.sqlite')), create_new_database=new_database,
+            synchronous=db_synchronous, cache_size_kib=db_cache_size or None)
         # Create tables if not already
         self.db.create_tables()
+        if db_write_queue_size:
+            # stop writes the queued blocks
+            self.persister = BlockPersister(self.db, max_queue_size=db_write_queue_size)
 
         self.q = Queue()
 
@@ -337,7 +553,10 @@ class BlockChainNode:
                                          crypto_helper_obj=self.crypto_helper_obj,
                                          min_blocks_for_difficulty=min_blocks,
                                          db=self.db,
-                                         q=self.q)
+                                         q=self.q,
+                                         max_resident_transactions=max_resident_transactions,
+                                         persister=self.persister)
+        self.blockchain_obj.add_head_listener(self.on_new_head)
 
         self.logger.debug("Initialized web server")
         """init network interface"""
@@ -363,13 +582,9 @@ class BlockChainNode:
         self.polling_thread.start()
 
         self.logger.info("Fetching Blocks from Database if present...")
-        blocks_from_db = self.reinitialize_blockchain_from_db()
-        if blocks_from_db is not None:
-            for block in blocks_from_db:
-                self.blockchain_obj.add_block(
-                    LogicalBlock.from_block(block, self.consensus_obj), False)
-                self.logger.info(
-                    'Fetched block nr ' + str(block.block_id) + ' from DB')
+        snapshot_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'resources/snapshots'))
+        blocks_from_db = self.reinitialize_blockchain_from_db(db_load_mode, snapshot_dir)
+        self.logger.info('Fetched {} blocks from DB'.format(blocks_from_db))
 
         self.logger.info("Starting bootstrap...")
         """Bootstrap the blockchain node"""
@@ -386,6 +601,7 @@ class BlockChainNode:
         self.rb_thread.start()
 
         self.logger.debug("Starting mining thread...")
+        self.mine_threshold = num_of_transactions
         """init mining"""
         # start the scheduler for mining
         self.mine_thread = threading.Thread(name="mine_thread",
@@ -401,3 +617,19 @@ class BlockChainNode:
             kwargs=dict(interval=pruning_interval))
 
         self.orphan_killer.start()
+
+        if snapshot_interval:
+            self.logger.debug("Starting snapshot thread...")
+            self.snapshot_thread = threading.Thread(
+                name="Snapshot thread",
+                target=self.schedule_snapshots,
+                kwargs=dict(interval=snapshot_interval, snapshot_dir=snapshot_dir))
+            self.snapshot_thread.start()
+
+        if status_log_interval:
+            self.logger.debug("Starting status thread...")
+            self.status_thread = threading.Thread(
+                name="Status thread",
+                target=self.schedule_status_logging,
+                kwargs=dict(interval=status_log_interval))
+            self.status_thread.start()
@@ -35,8 +35,7 @@ class Bootstrapper:
                 return blockchain
             # traverse reverse because the first block is the last element and vice versa
             logger.info('Received {} blocks from peers. Adding them now...'.format(len(blocks)))
-            for block in reversed(blocks):
-                blockchain.add_block(block)
+            blockchain.add_blocks(list(reversed(blocks)))
 
             if len(blocks) > 0:
                 break
@@ -1,21 +1,89 @@
+import hashlib
 import json
 import math
 import sys
 import time
 import logging
 import datetime
+import multiprocessing
+import threading
 from random import randint
 
+from labchain.consensus.consensusEngine import ConsensusEngine
 from labchain.util.cryptoHelper import CryptoHelper
 
+# Number of nonces hashed between two checks of kill_mine
+NONCE_CHUNK_SIZE = 10000
+# Number of nonces handed to a worker process at once
+NONCE_RANGE_SIZE = 50 * NONCE_CHUNK_SIZE
 
-class Consensus:
+# Set in the worker processes, stops their search when a nonce is found or mining is killed
+_worker_stop_event = None
+
+
+def get_header_parts(block):
+    """Returns the bytes hashed before and after the nonce when the mining
+    header of a block is hashed. CryptoHelper.hash concatenates the values
+    of the JSON header sorted by key: creator, difficulty, index, nonce,
+    pre_hash and tree_hash."""
+    prefix = str(block.block_creator_id) + str(block.difficulty) + str(block.block_id)
+    suffix = str(block.predecessor_hash) + str(block.merkle_tree_root)
+    return prefix.encode(), suffix.encode()
+
+
+def search_nonce(prefix, suffix, target, start, count):
+    """Hashes the header for the nonces start to start + count - 1. The
+    prefix is hashed once, every nonce only hashes its own digits and the
+    suffix on a copy of that state.
+
+    Returns
+    -------
+    The first nonce whose hash as integer is below target, None if there is none
+    """
+    prefix_state = hashlib.sha256(prefix)
+    for nonce in range(start, start + count):
+        state = prefix_state.copy()
+        state.update(b'%d' % nonce)
+        state.update(suffix)
+        if int.from_bytes(state.digest(), 'big') < target:
+            return nonce
+    return None
+
+
+def _init_mining_worker(stop_event):
+    global _worker_stop_event
+    _worker_stop_event = stop_event
+
+
+def _search_nonce_range(prefix, suffix, target, start, count):
+    """Runs search_nonce in a worker process chunk by chunk until a nonce is
+    found, the range is exhausted or the stop event is set.
+
+    Returns
+    -------
+    Tuple of the nonce found or None and the number of hashes computed
+    """
+    hashes = 0
+    for chunk_start in range(start, start + count, NONCE_CHUNK_SIZE):
+        if _worker_stop_event.is_set():
+            break
+        chunk_size = min(NONCE_CHUNK_SIZE, start + count - chunk_start)
+        nonce = search_nonce(prefix, suffix, target, chunk_start, chunk_size)
+        if nonce is not None:
+            return nonce, hashes + nonce - chunk_start + 1
+        hashes += chunk_size
+    return None, hashes
+
+
+class Consensus(ConsensusEngine):
 
     def __init__(self):
 
         self.crypto_helper = CryptoHelper.instance()
         self.max_diff = 5  # Threshold to be defined
         self.min_diff = 1
+        # Set by kill_mine and the results of the mining processes
+        self._mine_wakeup = threading.Event()
         self.kill_mine = 0
         self.last_mine_time_sec = time.time()
         self.expected_mine_freq = 30
@@ -35,6 +103,23 @@ class Consensus:
         self.num_of_mined_blocks = 0
         self.num_of_transactions = 0
         self.avg_diff = 4
+        # Hashes per second of the last mining attempt
+        self.hash_rate = 0
+        self.mining_workers = 1
+        self._pool = None
+        self._stop_event = None
+
+    @property
+    def kill_mine(self):
+        """Setting kill_mine to 1 aborts the running mining attempt right
+        away, mine resets it to 0 when it returns"""
+        return self._kill_mine
+
+    @kill_mine.setter
+    def kill_mine(self, value):
+        self._kill_mine = value
+        if value == 1:
+            self._mine_wakeup.set()
 
     def __getitem__(self, item):
         pass
@@ -94,7 +179,8 @@ class Consensus:
                                                              min_blocks, prev_difficulty, 1)
         return difficulty
 
-    def validate(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1):
+    def validate(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+                 predecessor=None):
         if type(latest_timestamp) is datetime.datetime:
             latest_timestamp = latest_timestamp.timestamp()
 
@@ -106,17 +192,14 @@ class Consensus:
 
         logging.debug('#INFO: validate Difficulty: ' + str(difficulty))
         zeros_array = "0" * difficulty
-        data = {'index': str(block.block_id), 'tree_hash': str(block.merkle_tree_root), 'pre_hash':
-            str(block.predecessor_hash), 'creator': str(block.block_creator_id), 'nonce': str(block.nonce),
-                'difficulty': str(block.difficulty)}
-        message = json.dumps(data)
-        block_hash = self.crypto_helper.hash(message)  # Assumed that hash is str
+        block_hash = self.crypto_helper.hash(self.get_header_json(block))  # Assumed that hash is str
         valid = self.equalZeros(block_hash, zeros_array, difficulty)
         logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' is validated with result ' + str(
             valid) + ' with hash: ' + str(block_hash))
         return valid
 
-    def mine(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1):
+    def mine(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+             predecessor=None):
         if type(latest_timestamp) is datetime.datetime:
             latest_timestamp = latest_timestamp.timestamp()
 
@@ -129,29 +212,20 @@ class Consensus:
         logging.debug('#INFO: mine Difficulty: ' + str(difficulty))
         block.difficulty = difficulty
         start_time = time.time()
-        zeros_array = "0" * difficulty
-        block.nonce = randint(0, sys.maxsize)
-        data = {'index': str(block.block_id), 'tree_hash': str(block.merkle_tree_root), 'pre_hash':
-            str(block.predecessor_hash), 'creator': str(block.block_creator_id), 'nonce': str(block.nonce),
-                'difficulty': str(block.difficulty)}
-        message = json.dumps(data)
-        block_hash = self.crypto_helper.hash(message)
-        counter = 0
-        while not self.equalZeros(block_hash, zeros_array, difficulty):
-            if self.kill_mine == 1:
-                self.kill_mine = 0
-                # need a boolean return to check if mine got killed
-                logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' mining process has been killed')
-                return False
-            block.nonce += 1
-            counter = counter + 1
-            if counter % 10000 == 0:
-                logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' is in mining process')
-            data = {'index': str(block.block_id), 'tree_hash': str(block.merkle_tree_root), 'pre_hash':
-                str(block.predecessor_hash), 'creator': str(block.block_creator_id), 'nonce': str(block.nonce),
-                    'difficulty': str(block.difficulty)}
-            message = json.dumps(data)
-            block_hash = self.crypto_helper.hash(message)
+        target = self.get_target(difficulty)
+        prefix, suffix = get_header_parts(block)
+        nonce = randint(0, sys.maxsize)
+        if self.mining_workers > 1:
+            found, counter = self._search_parallel(prefix, suffix, target, nonce)
+        else:
+            found, counter = self._search_sequential(prefix, suffix, target, nonce)
+        if found is None:
+            self.kill_mine = 0
+            self._update_hash_rate(counter, start_time)
+            # need a boolean return to check if mine got killed
+            logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' mining process has been killed')
+            return False
+        block.nonce = found
         block.timestamp = time.time()
         self.last_mine_time_sec = start_time
         time_diff = time.time() - start_time
@@ -163,11 +237,111 @@ class Consensus:
         self.num_of_transactions = self.num_of_transactions + len(block.transactions)
         self.avg_mining_time = (self.avg_helper + time_diff) / self.num_of_mined_blocks
         self.avg_helper = self.avg_helper + time_diff
-        logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' is mined successfully')
-        logging.debug("hash = " + str(block_hash))
+        self._update_hash_rate(counter, start_time)
+        logging.debug('#INFO:Consensus-> Block: ' + str(block.block_id) + ' is mined successfully with '
+                      + str(int(self.hash_rate)) + ' hashes/s')
         # need a boolean return to check if mine got killed
         return True
 
+    def set_mining_workers(self, workers):
+        """Sets the number of processes mine spreads the nonces over, 1
+        mines in the calling thread. The processes are started on the next
+        mining attempt."""
+        if workers != self.mining_workers:
+            self.close()
+        self.mining_workers = workers
+
+    def close(self):
+        """Stops the mining processes"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _search_sequential(self, prefix, suffix, target, nonce):
+        """Searches the nonces from nonce on in the calling thread until one
+        is found or kill_mine is set. Returns the nonce or None and the number of hashes."""
+        counter = 0
+        while self.kill_mine != 1:
+            found = search_nonce(prefix, suffix, target, nonce, NONCE_CHUNK_SIZE)
+            if found is not None:
+                return found, counter + found - nonce + 1
+            nonce += NONCE_CHUNK_SIZE
+            counter += NONCE_CHUNK_SIZE
+            logging.debug('#INFO:Consensus-> nonce search is in process')
+        return None, counter
+
+    def _search_parallel(self, prefix, suffix, target, nonce):
+        """Hands disjoint nonce ranges from nonce on to the mining processes
+        until one of them finds a nonce or kill_mine is set. Returns the
+        nonce or None and the number of hashes."""
+        if self._pool is None:
+            # Forking would copy the locks held by the threads of the node
+            context = multiprocessing.get_context('spawn')
+            self._stop_event = context.Event()
+            self._pool = context.Pool(self.mining_workers, initializer=_init_mining_worker,
+                                      initargs=(self._stop_event,))
+        results = []
+        # A kill before the clear is seen by the loop condition
+        self._mine_wakeup.clear()
+
+        def on_result(result):
+            results.append(result)
+            self._mine_wakeup.set()
+
+        def on_error(error):
+            logging.error('#INFO:Consensus-> mining process failed: ' + str(error))
+            on_result((None, 0))
+
+        found = None
+        counter = 0
+        outstanding = 0
+        while found is None and self.kill_mine != 1:
+            while outstanding < self.mining_workers:
+                self._pool.apply_async(_search_nonce_range, (prefix, suffix, target, nonce, NONCE_RANGE_SIZE),
+                                       callback=on_result, error_callback=on_error)
+                nonce += NONCE_RANGE_SIZE
+                outstanding += 1
+            self._mine_wakeup.wait()
+            self._mine_wakeup.clear()
+            while results:
+                result_nonce, hashes = results.pop()
+                outstanding -= 1
+                counter += hashes
+                if found is None:
+                    found = result_nonce
+
+        # Stop the other ranges and wait for them before the next attempt
+        self._stop_event.set()
+        while outstanding:
+            self._mine_wakeup.wait()
+            self._mine_wakeup.clear()
+            while results:
+                counter += results.pop()[1]
+                outstanding -= 1
+        self._stop_event.clear()
+        return found, counter
+
+    def get_header_json(self, block):
+        """Returns the JSON of the block header fields covered by the proof of work"""
+        data = {'index': str(block.block_id), 'tree_hash': str(block.merkle_tree_root), 'pre_hash':
+            str(block.predecessor_hash), 'creator': str(block.block_creator_id), 'nonce': str(block.nonce),
+                'difficulty': str(block.difficulty)}
+        return json.dumps(data)
+
+    def get_target(self, difficulty):
+        """Returns the integer a header hash has to be below to satisfy
+        equalZeros for the difficulty, 0 if no hash satisfies it"""
+        bits = difficulty if self.granular else 4 * difficulty
+        if bits < 0 or bits > 256 or (self.granular and bits == 0):
+            return 0
+        return 1 << (256 - bits)
+
+    def _update_hash_rate(self, hashes, start_time):
+        time_diff = time.time() - start_time
+        if time_diff > 0:
+            self.hash_rate = hashes / time_diff
+
     def equalZeros(self, block_hash, zeros_array, difficulty):
         if not self.granular:
             return block_hash[:difficulty] == zeros_array
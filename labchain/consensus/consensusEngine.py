@@ -0,0 +1,68 @@
+class ConsensusEngine:
+    """Interface of the consensus used by the node to create blocks and by
+    the blockchain to validate them.
+
+    Attributes
+    ----------
+    kill_mine : Integer
+        Setting it to 1 aborts the running mine call, mine resets it to 0
+    last_mine_time_sec : Float
+        Time of the last mining attempt, the node schedules the next one
+        relative to it
+    """
+
+    def get_mining_delay(self, block_id, predecessor_timestamp):
+        """Returns the seconds until this node may create the block with index
+        block_id on a predecessor with the timestamp given, 0 if it may
+        create it right away and None if it never may."""
+        return 0
+
+    def mine(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+             predecessor=None):
+        """Completes the header of the block so that it passes validate.
+
+        Parameters
+        ----------
+        block : LogicalBlock
+            Block built on the head of the chain
+        latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty
+            Difficulty data of the predecessor as returned by BlockChain.calculate_diff
+        predecessor : LogicalBlock
+            Predecessor of the block in the chain
+
+        Returns
+        -------
+        Boolean
+            True if the block is ready to be added, False if the attempt
+            was aborted or this node may not create the block
+        """
+        raise NotImplementedError
+
+    def validate(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+                 predecessor=None):
+        """Checks the header of a block created by mine.
+
+        Parameters
+        ----------
+        block : LogicalBlock
+            Block to validate
+        latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty
+            Difficulty data of the predecessor as returned by BlockChain.calculate_diff
+        predecessor : LogicalBlock
+            Predecessor of the block in the chain
+
+        Returns
+        -------
+        Boolean
+            True if the block satisfies the consensus
+        """
+        raise NotImplementedError
+
+    def set_mining_workers(self, workers):
+        """Sets the number of processes used by mine, ignored by engines
+        which do not need them"""
+        pass
+
+    def close(self):
+        """Releases the resources held for mining"""
+        pass
@@ -0,0 +1,126 @@
+import json
+import logging
+import time
+
+from labchain.consensus.consensusEngine import ConsensusEngine
+from labchain.util.cryptoHelper import CryptoHelper
+
+# Seconds a block may be timestamped ahead of the clock of the validating node
+MAX_CLOCK_DRIFT_SEC = 15
+
+
+class ProofOfAuthority(ConsensusEngine):
+    """Round robin proof of authority for permissioned deployments. The
+    block with index i is signed by the authority at position i modulo the
+    number of authorities, at least block_period seconds after its
+    predecessor. If that authority is offline, the next one in the rotation
+    may sign the block once out_of_turn_delay more seconds have passed, the
+    one after it after twice that delay and so on. The genesis block has no
+    creation time, so block 1 is only signed by the authority in turn.
+    """
+
+    def __init__(self, authorities, private_key=None, out_of_turn_delay=30, block_period=10):
+        """
+        Parameters
+        ----------
+        authorities : List
+            Public keys of the authorities in signing order
+        private_key : String
+            Private key of this node, None for nodes which only validate
+        out_of_turn_delay : Float
+            Seconds after the block period until the next authority in the
+            rotation may sign a block in place of an offline one
+        block_period : Float
+            Minimal seconds between a block and its predecessor, which keeps
+            the authorities from signing empty blocks as fast as they arrive
+
+        Attributes
+        ----------
+        _public_key : Public key of private_key, None if it is not one of the authorities
+        """
+        if not authorities:
+            raise ValueError('Proof of authority needs at least one authority')
+        self.crypto_helper = CryptoHelper.instance()
+        self.authorities = list(authorities)
+        self.out_of_turn_delay = out_of_turn_delay
+        self.block_period = block_period
+        self._private_key = private_key
+        self._public_key = None
+        if private_key is not None:
+            public_key = self.crypto_helper.get_public_key(private_key)
+            if public_key in self.authorities:
+                self._public_key = public_key
+            else:
+                logging.warning('#INFO:ProofOfAuthority-> signer key is not one of the authorities')
+        self.kill_mine = 0
+        self.last_mine_time_sec = time.time()
+
+    def get_signer(self, block_id, offset=0):
+        """Returns the public key of the authority which signs the block with
+        index block_id, or of the authority offset places after it in the rotation"""
+        return self.authorities[(block_id + offset) % len(self.authorities)]
+
+    def get_signing_payload(self, block):
+        """Returns the JSON of the block fields covered by the signature"""
+        data = {'index': str(block.block_id), 'tree_hash': str(block.merkle_tree_root),
+                'pre_hash': str(block.predecessor_hash), 'creator': str(block.block_creator_id),
+                'nonce': str(block.nonce), 'difficulty': str(block.difficulty), 'timestamp': str(block.timestamp)}
+        return json.dumps(data)
+
+    def get_mining_delay(self, block_id, predecessor_timestamp):
+        if self._public_key is None:
+            return None
+        offset = (self.authorities.index(self._public_key) - block_id) % len(self.authorities)
+        if block_id == 1:
+            # There is no creation time of the genesis block to wait from
+            return 0 if offset == 0 else None
+        return max(0, predecessor_timestamp + self.block_period + offset * self.out_of_turn_delay - time.time())
+
+    def mine(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+             predecessor=None):
+        # Attempts out of turn count as well, so the node waits for the next head instead of retrying
+        self.last_mine_time_sec = time.time()
+        if self.kill_mine == 1:
+            self.kill_mine = 0
+            return False
+        if predecessor is None:
+            return False
+        mining_delay = self.get_mining_delay(block.block_id, predecessor.timestamp)
+        if mining_delay is None or mining_delay > 0:
+            logging.debug('#INFO:ProofOfAuthority-> Block: ' + str(block.block_id) + ' is not signed by this node')
+            return False
+        block.timestamp = time.time()
+        block.signature = self.crypto_helper.sign(self._private_key, self.get_signing_payload(block))
+        logging.debug('#INFO:ProofOfAuthority-> Block: ' + str(block.block_id) + ' is signed')
+        return True
+
+    def validate(self, block, latest_timestamp, earliest_timestamp, num_of_blocks, min_blocks, prev_difficulty=-1,
+                 predecessor=None):
+        if predecessor is None or block.block_id != predecessor.block_id + 1:
+            logging.debug('#INFO:ProofOfAuthority-> Block: ' + str(block.block_id) + ' does not follow its predecessor')
+            return False
+        if not predecessor.timestamp <= block.timestamp <= time.time() + MAX_CLOCK_DRIFT_SEC or not block.signature:
+            return False
+        if block.block_id == 1:
+            offsets = 1
+        elif block.timestamp < predecessor.timestamp + self.block_period:
+            logging.debug('#INFO:ProofOfAuthority-> Block: ' + str(block.block_id) + ' is created too soon')
+            return False
+        else:
+            # Authorities later in the rotation may only sign once the ones before them had their time
+            offsets = len(self.authorities)
+            if self.out_of_turn_delay > 0:
+                offsets = min(offsets, int((block.timestamp - predecessor.timestamp - self.block_period)
+                                           // self.out_of_turn_delay) + 1)
+        payload = self.get_signing_payload(block)
+        valid = False
+        for offset in range(offsets):
+            try:
+                valid = self.crypto_helper.validate(self.get_signer(block.block_id, offset), payload, block.signature)
+            except (ValueError, TypeError):
+                valid = False
+            if valid:
+                break
+        logging.debug('#INFO:ProofOfAuthority-> Block: ' + str(block.block_id) + ' is validated with result '
+                      + str(valid))
+        return valid
@@ -2,14 +2,21 @@ import json
 import logging
 import os
 import sqlite3
+import threading
+import time
+from queue import Queue, Empty
 
-from labchain.datastructure.block import Block
+from labchain.datastructure.block import Block, LogicalBlock
 from labchain.datastructure.transaction import Transaction
 from labchain.util.TransactionFactory import TransactionFactory
 
 
 class Db:
-    def __init__(self, block_chain_db_file, create_new_database=False):
+    # Version of the schema created by create_tables, stored as user_version in the database
+    SCHEMA_VERSION = 2
+
+    def __init__(self, block_chain_db_file, create_new_database=False, synchronous='FULL',
+                 cache_size_kib=None):
         """
         Constructor for Database
 
@@ -17,12 +24,21 @@ class Db:
         ----------
         block_chain_db_file: String
             Location of database file
+        synchronous: String
+            SQLite synchronous setting of the connections, OFF, NORMAL or FULL.
+            Decides how often the data is flushed to disk.
+        cache_size_kib: Int
+            Page cache of each connection in KiB, None for the SQLite default
 
         Attributes
         ----------
         db_file : Location of database file
         blockchain_table: Name of blockchain table
         transaction_table: Nmae of transaction table
+        conn : Connection kept open for writing, in WAL mode
+        _lock : Serializes the use of conn between threads
+        _readers : Thread local storage of the read only connection of each thread
+        _reader_connections : Read only connections by the thread they were opened for, closed by close
         """
         # Creates or opens a file called mydb with a SQLite3 DB
         self.logger = logging.getLogger(__name__)
@@ -33,56 +49,170 @@ class Db:
                 self.logger.debug('Database removed.')
             else:
                 self.logger.debug('Database not found.')
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(block_chain_db_file + suffix):
+                    os.remove(block_chain_db_file + suffix)
         self.db_file = block_chain_db_file
-        self.open_connection(block_chain_db_file)
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.conn = None
+        self._lock = threading.RLock()
+        self._readers = threading.local()
+        self._reader_connections = {}
         self.blockchain_table = 'blockchain'
         self.transaction_table = 'transactions'
+        # There are no explicitly prepared statements. The same SQL text is passed on every call, so sqlite3
+        # reuses the statement it compiled from the implicit statement cache of the connection
+        self._insert_into_blockchain = "INSERT INTO {0} (hash, block_id, block_creator_id, " \
+            "merkle_tree_root, predecessor_hash, nonce, ts, difficulty, signature, height) " \
+            "VALUES (?,?,?,?,?,?,?,?,?,COALESCE(?, (SELECT height + 1 FROM {0} WHERE hash = ?)))"\
+            .format(self.blockchain_table)
+        self._insert_into_transactions = "INSERT INTO {} (sender, receiver, " \
+            "payload, signature, transaction_hash, block_hash) " \
+            "VALUES (?,?,?,?,?,?)".format(self.transaction_table)
+        self._select_block_transactions = "SELECT * FROM {} WHERE block_hash = ? ORDER BY rowid"\
+            .format(self.transaction_table)
+        self._select_block_exists = "SELECT 1 FROM {} WHERE hash = ?".format(self.blockchain_table)
+        self.open_connection(block_chain_db_file)
 
     def open_connection(self, db_file):
         """Create a database connection to the SQLite database
-            specified by db_file
+            specified by db_file, replacing the connection opened before
 
         :param db_file: database file
         :return: Connection object or None
         """
-        try:
-            self.conn = sqlite3.connect(db_file, check_same_thread=False)
-            self.cursor = self.conn.cursor()
-        except sqlite3.Error as e:
-            self.logger.error(str(e))
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            try:
+                self.conn = self._connect(db_file)
+                self.conn.execute('PRAGMA journal_mode = WAL')
+            except sqlite3.Error as e:
+                self.logger.error(str(e))
+            return self.conn
+
+    def close(self):
+        """Close the write connection and the read connections of all threads,
+        the threads open new read connections on their next read"""
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            for reader in self._reader_connections.values():
+                reader.close()
+            self._reader_connections = {}
+            self._readers = threading.local()
+
+    def _connect(self, db_file):
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        conn.execute('PRAGMA synchronous = {}'.format(self.synchronous))
+        if self.cache_size_kib:
+            conn.execute('PRAGMA cache_size = -{}'.format(int(self.cache_size_kib)))
+        return conn
+
+    def _reader_connection(self):
+        """Returns the read connection of the calling thread, WAL mode lets it
+        read while the write connection is used by another thread"""
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._connect(self.db_file)
+            with self._lock:
+                # The connections of threads which ended are closed when the next one is opened
+                for thread in [thread for thread in self._reader_connections if not thread.is_alive()]:
+                    self._reader_connections.pop(thread).close()
+                self._reader_connections[threading.current_thread()] = conn
+                self._readers.conn = conn
+        return conn
 
     def create_tables(self):
-        """Create the tables if they do no exists
+        """Create the tables and indexes if they do no exists. Tables created
+        by an older version are migrated to the current schema.
 
         Returns
         -------
         True if table created or already present, false if database error
         """
-
-        create_blockchain_table = "CREATE TABLE IF NOT EXISTS {} " \
-            "(hash text PRIMARY KEY, block_id integer NOT NULL, " \
-            "merkle_tree_root text, predecessor_hash text NOT NULL, " \
-            "block_creator_id text NOT NULL, nonce integer NOT NULL, " \
-            "ts timestamp NOT NULL, difficulty integer NOT NULL)".\
-            format(self.blockchain_table)
-
         create_transactions_table = "CREATE TABLE IF NOT EXISTS {}" \
             "(sender text NOT NULL, receiver text NOT NULL, " \
             "payload text NOT NULL, signature text NOT NULL, " \
             "transaction_hash text PRIMARY KEY, block_hash text" \
             " NOT NULL, FOREIGN KEY (block_hash) REFERENCES {}" \
             " (hash))".format(self.transaction_table, self.blockchain_table)
-        try:
-            self.cursor.execute(create_blockchain_table)
-            self.cursor.execute(create_transactions_table)
-
-            self.conn.commit()
-            self.conn.close()
-        except sqlite3.Error as e:
-            self.logger.error("Table creation error: "+ str(e.args[0]))
-            return False
+        create_indexes = ["CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(table, column)
+                          for table, column in [(self.transaction_table, 'block_hash'),
+                                                (self.transaction_table, 'sender'),
+                                                (self.transaction_table, 'receiver'),
+                                                (self.blockchain_table, 'block_id'),
+                                                (self.blockchain_table, 'height')]]
+        with self._lock:
+            try:
+                version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+                exists = self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                           (self.blockchain_table,)).fetchone()[0]
+                self.conn.execute('BEGIN')
+                if exists and version < self.SCHEMA_VERSION:
+                    self._migrate_blockchain_table(version)
+                else:
+                    self.conn.execute(self._create_blockchain_table(self.blockchain_table))
+                self.conn.execute(create_transactions_table)
+                for create_index in create_indexes:
+                    self.conn.execute(create_index)
+                self.conn.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                self.logger.error("Table creation error: "+ str(e.args[0]))
+                return False
         return True
 
+    def _create_blockchain_table(self, name):
+        return "CREATE TABLE IF NOT EXISTS {} " \
+            "(hash text PRIMARY KEY, block_id integer NOT NULL, " \
+            "merkle_tree_root text, predecessor_hash text NOT NULL, " \
+            "block_creator_id text NOT NULL, nonce integer NOT NULL, " \
+            "ts real NOT NULL, difficulty integer NOT NULL, height integer, " \
+            "is_main_chain integer NOT NULL DEFAULT 0, signature text)".format(name)
+
+    def _migrate_blockchain_table(self, version):
+        """Copies the blockchain table of schema version 0 into the current
+        schema and fills in the height and is_main_chain columns, tables of
+        schema version 1 only get the signature column. Must be called with
+        _lock held inside a transaction"""
+        self.logger.info('Migrating database to schema version {}'.format(self.SCHEMA_VERSION))
+        if version >= 1:
+            self.conn.execute("ALTER TABLE {} ADD COLUMN signature text".format(self.blockchain_table))
+            return
+        new_table = self.blockchain_table + '_new'
+        self.conn.execute(self._create_blockchain_table(new_table))
+        self.conn.execute("INSERT INTO {0} (hash, block_id, merkle_tree_root, predecessor_hash, "
+                          "block_creator_id, nonce, ts, difficulty) "
+                          "SELECT hash, block_id, merkle_tree_root, predecessor_hash, block_creator_id, "
+                          "nonce, CAST(ts AS REAL), difficulty FROM {1} ORDER BY rowid"
+                          .format(new_table, self.blockchain_table))
+        self.conn.execute("DROP TABLE {}".format(self.blockchain_table))
+        self.conn.execute("ALTER TABLE {} RENAME TO {}".format(new_table, self.blockchain_table))
+
+        # Blocks are saved after their predecessor, the genesis block at height 0 is never saved
+        predecessors = {}
+        heights = {}
+        for block_hash, predecessor_hash in self.conn.execute(
+                "SELECT hash, predecessor_hash FROM {} ORDER BY rowid".format(self.blockchain_table)):
+            predecessors[block_hash] = predecessor_hash
+            heights[block_hash] = heights.get(predecessor_hash, 0) + 1
+        self.conn.executemany("UPDATE {} SET height = ? WHERE hash = ?".format(self.blockchain_table),
+                              [(height, block_hash) for block_hash, height in heights.items()])
+
+        # The main chain ends in the first saved block of the highest height
+        head = max(heights, key=heights.get, default=None)
+        main_chain = []
+        while head in predecessors:
+            main_chain.append((head,))
+            head = predecessors[head]
+        self.conn.executemany("UPDATE {} SET is_main_chain = 1 WHERE hash = ?".format(self.blockchain_table),
+                              main_chain)
+
     def save_block(self, block):
         """Saves the block data to blockchain table and its transactions to
         transactions table
@@ -97,34 +227,159 @@ class Db:
         """
         if not block:
             return False
-        self.open_connection(self.db_file)
-        # save a single block and its correspondent transactions in the db
+        with self._lock:
+            try:
+                self._insert_block(block)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                self.logger.error("Error in adding block: " + str(e.args[0]))
+                return False
+        return True
+
+    def save_blocks(self, blocks):
+        """Saves several blocks with their transactions in a single database
+        transaction. Either all blocks are saved or none of them.
+
+        Parameters
+        ----------
+        blocks: list of block objects to be saved in database
+
+        Returns
+        -------
+        True if data saved successfully, False otherwise
+        """
+        with self._lock:
+            try:
+                for block in blocks:
+                    self._insert_block(block)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                self.logger.error("Error in adding blocks: " + str(e.args[0]))
+                return False
+        return True
+
+    def _insert_block(self, block):
+        """Inserts a single block and its transactions without committing"""
         block_hash = block.get_computed_hash()
+        # The height of a block without position is derived from its predecessor in the database
+        height = block.get_block_pos() if isinstance(block, LogicalBlock) else None
         block_data = [block_hash, block.block_id, block.block_creator_id, block.merkle_tree_root,
-                      block.predecessor_hash, block.nonce, block.timestamp, block.difficulty]
-        insert_into_blockchain = "INSERT INTO {} (hash, block_id, block_creator_id, " \
-             "merkle_tree_root, predecessor_hash, nonce, ts, difficulty) " \
-             "VALUES (?,?,?,?,?,?,?,?)".format(self.blockchain_table)
-        insert_into_transactions = "INSERT INTO {} (sender, receiver, " \
-            "payload, signature, transaction_hash, block_hash) " \
-            "VALUES (?,?,?,?,?,?)".format(self.transaction_table)
+                      block.predecessor_hash, block.nonce, block.timestamp, block.difficulty,
+                      block.signature, height, block.predecessor_hash]
+        self.conn.execute(self._insert_into_blockchain, block_data)
+        transactions_data = []
+        for t in block.transactions:
+            payload = t.payload
+            if isinstance(payload, dict):
+                payload = json.dumps(payload)
+            transactions_data.append((t.sender, t.receiver, payload, t.signature,
+                                      t.transaction_hash, block_hash))
+        self.conn.executemany(self._insert_into_transactions, transactions_data)
 
-        try:
-            self.cursor.execute(insert_into_blockchain, block_data)
-            for t in block.transactions:
-                payload = t.payload
-                if isinstance(payload, dict):
-                    payload = json.dumps(payload)
-                self.cursor.execute(insert_into_transactions,
-                                    (t.sender, t.receiver, payload, t.signature,
-                                     t.transaction_hash, block_hash))
-            self.conn.commit()
-            self.conn.close()
-        except sqlite3.Error as e:
-            self.logger.error("Error in adding block: " + str(e.args[0]))
-            return False
+    def update_main_chain(self, fork_height, branch_hashes):
+        """Moves the is_main_chain flag to a new branch. Only rows whose
+        flag changes are written.
+
+        Parameters
+        ----------
+        fork_height: Int
+            Height of the last block the old and the new main chain share
+        branch_hashes: List
+            Hashes of the blocks of the new main chain following the fork, in height order
+
+        Returns
+        -------
+        True if the flags were updated, False if database error
+        """
+        unmark_height = "UPDATE {} SET is_main_chain = 0 WHERE height = ? AND hash != ? AND is_main_chain = 1"\
+            .format(self.blockchain_table)
+        unmark_above = "UPDATE {} SET is_main_chain = 0 WHERE height > ? AND is_main_chain = 1"\
+            .format(self.blockchain_table)
+        mark = "UPDATE {} SET is_main_chain = 1 WHERE hash = ? AND is_main_chain = 0"\
+            .format(self.blockchain_table)
+        with self._lock:
+            try:
+                self.conn.executemany(unmark_height, [(fork_height + i + 1, block_hash)
+                                                      for i, block_hash in enumerate(branch_hashes)])
+                self.conn.execute(unmark_above, (fork_height + len(branch_hashes),))
+                self.conn.executemany(mark, [(block_hash,) for block_hash in branch_hashes])
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                self.logger.error("Error in updating main chain: " + str(e.args[0]))
+                return False
         return True
 
+    def get_save_mark(self):
+        """Marks the position of the last saved block, blocks saved later
+        are fetched with iterate_blockchain_from_db(after_mark=...)
+
+        Returns
+        -------
+        (rowid, hash) of the last saved block, None if no block is saved
+        """
+        row = self._reader_connection().execute(
+            "SELECT rowid, hash FROM {} ORDER BY rowid DESC LIMIT 1".format(self.blockchain_table)).fetchone()
+        return tuple(row) if row else None
+
+    def has_save_mark(self, mark):
+        """Checks if a save mark refers to a block of this database, it does
+        not if the database was created again after the mark was taken
+
+        Returns
+        -------
+        True if the block of the mark is saved at the marked position
+        """
+        row = self._reader_connection().execute(
+            "SELECT hash FROM {} WHERE rowid = ?".format(self.blockchain_table), (mark[0],)).fetchone()
+        return row is not None and row[0] == mark[1]
+
+    def get_main_chain_block_hash(self, height):
+        """Hash of the main chain block at the given height
+
+        Parameters
+        ----------
+        height: Int
+            Position of the block in the chain, the genesis block is at height 0
+
+        Returns
+        -------
+        Hash of the block, None if there is no such block in the database
+        """
+        row = self._reader_connection().execute(
+            "SELECT hash FROM {} WHERE height = ? AND is_main_chain = 1".format(self.blockchain_table),
+            (height,)).fetchone()
+        return row[0] if row else None
+
+    def get_main_chain_transactions(self, sender=None, receiver=None):
+        """Fetch transactions of main chain blocks sent by and/or addressed to a
+        public key, without loading the chain
+
+        Parameters
+        ----------
+        sender: public key of the sender, None for any sender
+        receiver: public key of the receiver, None for any receiver
+
+        Returns
+        -------
+        List of (transaction, block hash) tuples in height order
+        """
+        conditions = ['b.is_main_chain = 1']
+        parameters = []
+        if sender is not None:
+            conditions.append('t.sender = ?')
+            parameters.append(sender)
+        if receiver is not None:
+            conditions.append('t.receiver = ?')
+            parameters.append(receiver)
+        query = "SELECT t.sender, t.receiver, t.payload, t.signature, t.transaction_hash, t.block_hash " \
+            "FROM {} AS t JOIN {} AS b ON b.hash = t.block_hash WHERE {} ORDER BY b.height, t.rowid"\
+            .format(self.transaction_table, self.blockchain_table, ' AND '.join(conditions))
+        return [(self._transaction_from_row(row), row[5])
+                for row in self._reader_connection().execute(query, parameters)]
+
     def get_blockchain_from_db(self):
         """Fetch all blocks with their transactions from database
 
@@ -132,40 +387,215 @@ class Db:
         -------
         List of all blocks
         """
-        self.open_connection(self.db_file)
-        get_block = "SELECT * from {}".format(self.blockchain_table)
-        get_transactions = "SELECT * FROM {} WHERE block_hash = ?".format(self.transaction_table)
-
-        self.cursor.execute(get_block)
-        blocks = []
-        blocks_db = self.cursor.fetchall()
-        if len(blocks_db) == 0:
+        blocks = list(self.iterate_blockchain_from_db())
+        if len(blocks) == 0:
             return None
-        for block_db in blocks_db:
-            self.cursor.execute(get_transactions, (block_db[0],))
-            txns = []
-            txns_db = self.cursor.fetchall()
-            if len(txns_db) != 0:
-                for txn_db in txns_db:
-                    try:
-                        json_payload = json.loads(txn_db[2])
-                        if isinstance(json_payload, dict):
-                            transaction_data = {'payload': json_payload, 'signature': txn_db[3], 'sender': txn_db[0],
-                                                'receiver': txn_db[1]}
-                            txn = TransactionFactory.create_transcation(transaction_data)
-                        elif isinstance(json_payload, int):
-                            txn = Transaction(txn_db[0], txn_db[1], txn_db[2], txn_db[3])
-                        else:
-                            txn = None
-                    except json.JSONDecodeError:
-                        txn = Transaction(txn_db[0], txn_db[1], txn_db[2], txn_db[3])
-                    if not txn.transaction_hash:
-                        txn.transaction_hash = txn_db[4]
-                    txns.append(txn)
-            block = Block(block_id=block_db[1], merkle_tree_root=block_db[2],
-                          predecessor_hash=block_db[3], block_creator_id=block_db[4],
-                          transactions=txns, nonce=block_db[5], timestamp=float(block_db[6]),
-                          difficulty=int(block_db[7]))
-            blocks.append(block)
-        self.conn.close()
         return blocks
+
+    def iterate_blockchain_from_db(self, with_hashes=False, after_mark=None):
+        """Fetch all blocks with their transactions from database with a
+        single query. The blocks are yielded in the order they were saved,
+        which puts every block after its predecessor.
+
+        Parameters
+        ----------
+        with_hashes: Boolean
+            Yield (stored hash, block) tuples instead of blocks
+        after_mark: Tuple
+            Save mark returned by get_save_mark, only the blocks saved after it are fetched
+
+        Returns
+        -------
+        Generator of blocks
+        """
+        get_blocks = "SELECT b.hash, b.block_id, b.merkle_tree_root, b.predecessor_hash, " \
+            "b.block_creator_id, b.nonce, b.ts, b.difficulty, b.signature, " \
+            "t.sender, t.receiver, t.payload, t.signature, t.transaction_hash " \
+            "FROM {} AS b LEFT JOIN {} AS t ON t.block_hash = b.hash WHERE b.rowid > ? " \
+            "ORDER BY b.rowid, t.rowid".format(self.blockchain_table, self.transaction_table)
+
+        block_db = None
+        txns = []
+        for row in self._reader_connection().execute(get_blocks, (after_mark[0] if after_mark else 0,)):
+            if block_db is None or row[0] != block_db[0]:
+                if block_db is not None:
+                    yield self._block_from_row(block_db, txns, with_hashes)
+                block_db = row[:9]
+                txns = []
+            if row[13] is not None:
+                txns.append(self._transaction_from_row(row[9:]))
+        if block_db is not None:
+            yield self._block_from_row(block_db, txns, with_hashes)
+
+    @staticmethod
+    def _block_from_row(block_db, txns, with_hash=False):
+        """Create a block from a row of the blockchain table and its transactions"""
+        block = Block(block_id=block_db[1], merkle_tree_root=block_db[2],
+                      predecessor_hash=block_db[3], block_creator_id=block_db[4],
+                      transactions=txns, nonce=block_db[5], timestamp=float(block_db[6]),
+                      difficulty=int(block_db[7]), signature=block_db[8])
+        if with_hash:
+            return block_db[0], block
+        return block
+
+    def get_block_transactions(self, block_hash):
+        """Fetch the transactions of a single block from database. The read
+        connection of the calling thread is used, so it can be called while
+        other threads save blocks.
+
+        Parameters
+        ----------
+        block_hash: hash of the block
+
+        Returns
+        -------
+        List of the transactions in the order they were saved, None if database error or the block is not
+        stored
+        """
+        try:
+            connection = self._reader_connection()
+            txns_db = connection.execute(self._select_block_transactions, (block_hash,)).fetchall()
+            if not txns_db and connection.execute(self._select_block_exists, (block_hash,)).fetchone() is None:
+                self.logger.error("Error in fetching transactions: block {} is not stored".format(block_hash))
+                return None
+        except sqlite3.Error as e:
+            self.logger.error("Error in fetching transactions: " + str(e.args[0]))
+            return None
+        return [self._transaction_from_row(txn_db) for txn_db in txns_db]
+
+    @staticmethod
+    def _transaction_from_row(txn_db):
+        """Create a transaction from a row of the transactions table"""
+        try:
+            json_payload = json.loads(txn_db[2])
+            if isinstance(json_payload, dict):
+                transaction_data = {'payload': json_payload, 'signature': txn_db[3], 'sender': txn_db[0],
+                                    'receiver': txn_db[1]}
+                txn = TransactionFactory.create_transcation(transaction_data)
+            elif isinstance(json_payload, int):
+                txn = Transaction(txn_db[0], txn_db[1], txn_db[2], txn_db[3])
+            else:
+                txn = None
+        except json.JSONDecodeError:
+            txn = Transaction(txn_db[0], txn_db[1], txn_db[2], txn_db[3])
+        if not txn.transaction_hash:
+            txn.transaction_hash = txn_db[4]
+        return txn
+
+
+class BlockPersister:
+    """Writes blocks to the database on a background thread, so adding a
+    block to the chain does not wait for the disk. Blocks waiting in the
+    queue are written together in one database transaction."""
+
+    def __init__(self, db, max_queue_size=1000, max_batch_size=100):
+        """
+        Parameters
+        ----------
+        db: Db instance the blocks are written to
+        max_queue_size: Int
+            Number of blocks which may wait to be written, put blocks while the queue is full
+        max_batch_size: Int
+            Maximal number of blocks written in one transaction
+
+        Attributes
+        ----------
+        _queue: Queue of (block, callback, time of put) tuples, (None, main chain update, time of put)
+            tuples and None, which stops the writer thread
+        _saved_blocks: Number of blocks written so far
+        _failed_blocks: Number of blocks which could not be written
+        _last_lag: Seconds the oldest block of the last written batch waited in the queue
+        _max_lag: Highest _last_lag seen so far
+        """
+        self.logger = logging.getLogger(__name__)
+        self._db = db
+        self._queue = Queue(maxsize=max_queue_size)
+        self._max_batch_size = max_batch_size
+        self._statistics_lock = threading.Lock()
+        self._saved_blocks = 0
+        self._failed_blocks = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self._thread = threading.Thread(name='Block persister thread', target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, block, on_saved=None):
+        """Queues a block for writing
+
+        Parameters
+        ----------
+        block: block object to be saved in database
+        on_saved: function called with the block from the writer thread once it is saved
+        """
+        self._queue.put((block, on_saved, time.time()))
+
+    def put_main_chain(self, fork_height, branch_hashes):
+        """Queues an update of the main chain flags, it is written after the
+        blocks queued before. See Db.update_main_chain for the parameters."""
+        self._queue.put((None, (fork_height, branch_hashes), time.time()))
+
+    def flush(self):
+        """Waits until every queued block is written"""
+        self._queue.join()
+
+    def stop(self):
+        """Writes the queued blocks and stops the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def get_statistics(self):
+        """Returns a dictionary with the number of queued, saved and failed
+        blocks and the last and highest durability lag in seconds"""
+        with self._statistics_lock:
+            return {'queue_depth': self._queue.qsize(),
+                    'saved_blocks': self._saved_blocks,
+                    'failed_blocks': self._failed_blocks,
+                    'last_lag': self._last_lag,
+                    'max_lag': self._max_lag}
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self._max_batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            batch = []
+            for item in items:
+                if item is None:
+                    continue
+                if item[0] is not None:
+                    batch.append(item)
+                    continue
+                # The blocks of the new main chain have to be written first
+                if batch:
+                    self._write(batch)
+                    batch = []
+                self._db.update_main_chain(*item[1])
+            if batch:
+                self._write(batch)
+            for _ in items:
+                self._queue.task_done()
+            if None in items:
+                return
+
+    def _write(self, batch):
+        blocks = [block for block, _, _ in batch]
+        if self._db.save_blocks(blocks):
+            saved = [True] * len(batch)
+        else:
+            # A single block, e.g. with a transaction stored for another branch, fails the whole transaction
+            saved = [self._db.save_block(block) for block in blocks]
+        lag = time.time() - batch[0][2]
+        with self._statistics_lock:
+            self._saved_blocks += saved.count(True)
+            self._failed_blocks += saved.count(False)
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+        self.logger.debug('Saved {} of {} blocks to DB, {:.3f}s after they were queued'
+                          .format(saved.count(True), len(batch), lag))
+        for (block, on_saved, _), block_saved in zip(batch, saved):
+            if block_saved and on_saved is not None:
+                on_saved(block)
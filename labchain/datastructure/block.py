@@ -12,7 +12,7 @@ class Block(object):
     def __init__(self, block_id=None, merkle_tree_root=None,
                  predecessor_hash=None, block_creator_id=None,
                  transactions=[], nonce=0, timestamp=time.time(),
-                 difficulty=-1):
+                 difficulty=-1, signature=None):
         """Constructor for Block, placeholder for Block information.
 
         Parameters
@@ -32,6 +32,8 @@ class Block(object):
         timestamp : Timestamp of the block creation
         difficulty: Int
             Difficulty value used for the block mining
+        signature: String
+            Signature of the block by its creator, used by proof of authority
 
         Attributes
         ----------
@@ -46,30 +48,22 @@ class Block(object):
         self._nonce = nonce
         self._block_creator_id = block_creator_id
         self._difficulty = difficulty
+        self._signature = signature
+        # Cached hash of to_json_headers, reset when a header field changes
+        self._header_hash = None
         self._logger = logging.getLogger(__name__)
 
     def to_dict(self):
         """Returns block data as a dictionary."""
-        if self._transactions is None:
-            return {
-                'nr': self._block_id,
-                'timestamp': self._timestamp,
-                'merkleHash': self._merkle_tree_root,
-                'predecessorBlock': self._predecessor_hash,
-                'nonce': self._nonce,
-                'creator': self._block_creator_id,
-                'transactions': [],
-                'difficulty': self._difficulty
-            }
         t = []
-        for transaction in self._transactions:
+        for transaction in self.transactions or []:
             try:
                 t.append(transaction.to_dict())
             except Exception as e:
                 logging.error("tx error = " + e)
                 raise e
 
-        return {
+        data = {
             'nr': self._block_id,
             'timestamp': self._timestamp,
             'merkleHash': self._merkle_tree_root,
@@ -79,15 +73,24 @@ class Block(object):
             'transactions': t,
             'difficulty': self._difficulty
         }
+        # Only signed blocks carry the field, so blocks of proof of work nodes are unchanged
+        if self._signature is not None:
+            data['signature'] = self._signature
+        return data
 
     def to_json_headers(self):
-        """Returns block headers data as JSON"""
-        return json.dumps({'nr': self._block_id,
-                           'merkleHash': self._merkle_tree_root,
-                           'predecessorBlock': self._predecessor_hash,
-                           'nonce': self._nonce,
-                           'creator': self._block_creator_id,
-                           'difficulty': self._difficulty})
+        """Returns block headers data as JSON. The signature of a signed
+        block is part of the headers, it covers the timestamp, so neither
+        can be replaced without changing the block hash."""
+        headers = {'nr': self._block_id,
+                   'merkleHash': self._merkle_tree_root,
+                   'predecessorBlock': self._predecessor_hash,
+                   'nonce': self._nonce,
+                   'creator': self._block_creator_id,
+                   'difficulty': self._difficulty}
+        if self._signature is not None:
+            headers['signature'] = self._signature
+        return json.dumps(headers)
 
     def get_json(self):
         """Returns this Block instance as a JSON string."""
@@ -110,7 +113,8 @@ class Block(object):
                                    for transaction_dict in data_dict['transactions']],
                      nonce=data_dict['nonce'],
                      timestamp=data_dict['timestamp'],
-                     difficulty=data_dict['difficulty'])
+                     difficulty=data_dict['difficulty'],
+                     signature=data_dict.get('signature'))
 
     def __str__(self):
         """String representation of Block object"""
@@ -151,6 +155,7 @@ class Block(object):
     @nonce.setter
     def nonce(self, nonce):
         self._nonce = nonce
+        self._header_hash = None
 
     @property
     def difficulty(self):
@@ -160,13 +165,23 @@ class Block(object):
     def difficulty(self, difficulty):
         if self._difficulty < 1:
             self._difficulty = difficulty
+            self._header_hash = None
+
+    @property
+    def signature(self):
+        return self._signature
+
+    @signature.setter
+    def signature(self, signature):
+        self._signature = signature
+        self._header_hash = None
 
     def __eq__(self, other):
         """Compare this block fields with other block"""
         if isinstance(other, Block) or isinstance(other, LogicalBlock):
             return all([self._block_id == other.block_id,
                         self._timestamp == other.timestamp,
-                        self._transactions == other.transactions,
+                        self.transactions == other.transactions,
                         self._merkle_tree_root == other.merkle_tree_root,
                         self._predecessor_hash == other.predecessor_hash,
                         self._nonce == other.nonce,
@@ -185,14 +200,17 @@ class Block(object):
         if isinstance(other, Block) or isinstance(other, LogicalBlock):
             return any([
                 self._block_id == other.block_id,
-                any(t in self._transactions for t in other.transactions)
+                any(t in self.transactions for t in other.transactions)
             ])
 
 
 class LogicalBlock(Block):
+    # Number of get_computed_hash calls answered from the cached header hash
+    saved_header_hashes = 0
+
     def __init__(self, block_id=None, transactions=[], predecessor_hash=None,
                  block_creator_id=None, merkle_tree_root=None, nonce=0,
-                 timestamp=time.time(), consensus_obj=None, difficulty=-1):
+                 timestamp=time.time(), consensus_obj=None, difficulty=-1, signature=None):
         """Constructor for LogicalBlock, derives properties from the
         placeholder class Block.
 
@@ -214,6 +232,8 @@ class LogicalBlock(Block):
         consensus_obj : Instance of consensus module
         difficulty: Int
             Difficulty value used for the block mining
+        signature: String
+            Signature of the block by its creator, used by proof of authority
 
         Attributes
         ----------
@@ -223,6 +243,20 @@ class LogicalBlock(Block):
         _merkle_tree_root : Hash
             Merkle Tree Root of all transactions combined
         _consensus : Instance of consensus module
+        _difficulty_window_start : Tuple
+            (timestamp, difficulty) of the oldest of the last blocks up to this
+            one which are used for the difficulty calculation
+        _difficulty_window_info : Tuple
+            (latest timestamp, earliest timestamp, number of blocks, difficulty sum)
+            aggregated over these blocks
+        _skip_pointers : Tuple
+            Hashes of the ancestors 1, 2, 4, ... 2^k positions before this block
+        _body_loader : Callable
+            Restores and returns the evicted transactions of this block, None until they are first evicted
+        _content_validated : Boolean
+            True once validate_block_content passed
+        _stored : Boolean
+            True once the block is written to or read from the DB
 
         """
         super(LogicalBlock, self).__init__(block_id=block_id,
@@ -232,8 +266,15 @@ class LogicalBlock(Block):
                                            transactions=transactions,
                                            nonce=nonce,
                                            timestamp=timestamp,
-                                           difficulty=difficulty)
+                                           difficulty=difficulty,
+                                           signature=signature)
         self._position_in_chain = None
+        self._difficulty_window_start = None
+        self._difficulty_window_info = None
+        self._skip_pointers = ()
+        self._body_loader = None
+        self._content_validated = False
+        self._stored = False
         self._crypto_helper = CryptoHelper.instance()
         self._consensus = consensus_obj
         if not self._merkle_tree_root:
@@ -254,15 +295,172 @@ class LogicalBlock(Block):
         """Sets the position at which block will reside in chain"""
         self._position_in_chain = value
 
+    def set_difficulty_window(self, predecessor, window_size, oldest=None):
+        """Derives the difficulty window of this block from the window of
+        its predecessor, which must already be set unless the predecessor is
+        missing or has block ID 0. Only the aggregates and the oldest entry
+        of the window are kept, so this takes constant time.
+
+        Parameters
+        ----------
+        predecessor : LogicalBlock instance or None
+            The block this block is linked to in the chain
+        window_size : Int
+            Maximal number of blocks in the window
+        oldest : LogicalBlock instance or None
+            The ancestor window_size - 1 positions before this block, which
+            becomes the oldest block of the window if the window of the
+            predecessor is full. Not needed otherwise.
+        """
+        _entry = (self._timestamp, self._difficulty)
+        if predecessor is None or predecessor.block_id == 0 or window_size <= 1:
+            self._difficulty_window_start = _entry
+            self._difficulty_window_info = (self._timestamp, self._timestamp, 1, self._difficulty)
+            return
+        _, _earliest_timestamp, _number_of_blocks, _difficulty_sum = predecessor._difficulty_window_info
+        _start = predecessor._difficulty_window_start
+        _difficulty_sum += self._difficulty
+        if _number_of_blocks >= window_size:
+            # The oldest block drops out of the window
+            _difficulty_sum -= _start[1]
+            _start = (oldest.timestamp, oldest.difficulty)
+        else:
+            _number_of_blocks += 1
+        self._difficulty_window_start = _start
+        self._difficulty_window_info = (self._timestamp, _start[0], _number_of_blocks, _difficulty_sum)
+
+    def recompute_difficulty_window(self, ancestors):
+        """Sets the difficulty window of this block to the block itself and
+        the ancestors given, which takes time linear in their number.
+
+        Parameters
+        ----------
+        ancestors : List of LogicalBlock instances
+            The ancestors in the window, predecessor first
+        """
+        _blocks = [self] + list(ancestors)
+        self._difficulty_window_start = (_blocks[-1].timestamp, _blocks[-1].difficulty)
+        self._difficulty_window_info = (self._timestamp, _blocks[-1].timestamp, len(_blocks),
+                                        sum(_block.difficulty for _block in _blocks))
+
+    def get_difficulty_window(self):
+        """Returns (latest timestamp, earliest timestamp, number of blocks,
+        difficulty sum) of the difficulty window, None if it is not set"""
+        return self._difficulty_window_info
+
+    @property
+    def transactions(self):
+        # The list read here or returned by the loader is used, as another
+        # thread may evict the transactions again right after they are restored
+        transactions = self._transactions
+        if transactions is None and self._body_loader is not None:
+            transactions = self._body_loader(self)
+        return transactions
+
+    def evict_transactions(self, body_loader):
+        """Drops the transactions of this block from memory. They are
+        restored by calling body_loader with this block on the next access,
+        which returns them."""
+        self._body_loader = body_loader
+        self._transactions = None
+
+    def restore_transactions(self, transactions):
+        """Puts the transactions of an evicted block back into memory"""
+        self._transactions = transactions
+
+    def is_body_resident(self):
+        """Returns False if the transactions of this block are evicted"""
+        return self._transactions is not None or self._body_loader is None
+
+    def mark_stored(self):
+        """Marks the block as stored in the DB"""
+        self._stored = True
+
+    def is_stored(self):
+        """Returns True if the block is stored in the DB"""
+        return self._stored
+
+    def set_skip_pointers(self, skip_pointers):
+        """Sets the hashes of the ancestors 1, 2, 4, ... 2^k positions before this block"""
+        self._skip_pointers = tuple(skip_pointers)
+
+    def get_skip_pointers(self):
+        """Returns the hashes of the ancestors 1, 2, 4, ... 2^k positions
+        before this block, empty if the block is not linked into a chain"""
+        return self._skip_pointers
+
     def get_computed_hash(self):
-        """Gets the hash for the entire block"""
-        return self._crypto_helper.hash(self.to_json_headers())
+        """Gets the hash for the entire block. The hash is computed once and
+        cached until nonce, difficulty or signature change, the other header
+        fields are fixed after creation and the timestamp is not part of the header."""
+        if self._header_hash is None:
+            self._header_hash = self._crypto_helper.hash(self.to_json_headers())
+        else:
+            LogicalBlock.saved_header_hashes += 1
+        return self._header_hash
 
     @staticmethod
     def from_block(block, consensus_obj):
         """Instantiate LogicalBlock from Block"""
         return LogicalBlock.from_dict(block.to_dict(), consensus_obj)
 
+    def get_snapshot(self):
+        """Returns a tuple with the header and the position in the chain of
+        this block for a snapshot of the chain. It only holds JSON types,
+        the transactions are left out as they are read back from the DB, so
+        the block has to be stored."""
+        return (self.get_computed_hash(), self._block_id, self._merkle_tree_root, self._predecessor_hash,
+                self._block_creator_id, self._nonce, self._timestamp, self._difficulty,
+                self._position_in_chain, self._difficulty_window_start, self._difficulty_window_info,
+                self._skip_pointers, self._signature)
+
+    @staticmethod
+    def from_snapshot(snapshot, consensus_obj, body_loader):
+        """Instantiate LogicalBlock from a sequence created by get_snapshot,
+        also after a round trip through JSON. The block is stored and its
+        transactions are evicted.
+
+        Parameters
+        ----------
+        snapshot : Sequence
+            Created by get_snapshot
+        consensus_obj : Instance of consensus module
+        body_loader : Callable
+            Restores the transactions on the first access
+        """
+        (header_hash, block_id, merkle_tree_root, predecessor_hash, block_creator_id, nonce, timestamp,
+         difficulty, position, difficulty_window_start, difficulty_window_info, skip_pointers,
+         signature) = snapshot
+        block = LogicalBlock(block_id=block_id, transactions=None, predecessor_hash=predecessor_hash,
+                             block_creator_id=block_creator_id, merkle_tree_root=merkle_tree_root,
+                             nonce=nonce, timestamp=timestamp, consensus_obj=consensus_obj,
+                             difficulty=difficulty, signature=signature)
+        block._header_hash = header_hash
+        block._position_in_chain = position
+        if difficulty_window_start is not None:
+            block._difficulty_window_start = tuple(difficulty_window_start)
+            block._difficulty_window_info = tuple(difficulty_window_info)
+        block._skip_pointers = tuple(skip_pointers)
+        block.mark_stored()
+        block.evict_transactions(body_loader)
+        return block
+
+    @staticmethod
+    def from_trusted_block(block, consensus_obj):
+        """Instantiate LogicalBlock from a Block read from the own database.
+        The transactions are shared, so they keep their class and stored
+        hashes instead of being parsed and hashed again."""
+        return LogicalBlock(block_id=block.block_id,
+                            merkle_tree_root=block.merkle_tree_root,
+                            predecessor_hash=block.predecessor_hash,
+                            block_creator_id=block.block_creator_id,
+                            transactions=block.transactions,
+                            nonce=block.nonce,
+                            difficulty=block.difficulty,
+                            timestamp=block.timestamp,
+                            consensus_obj=consensus_obj,
+                            signature=block.signature)
+
     @staticmethod
     def from_json(json_data):
         """Deserialize a JSON string to a Block instance."""
@@ -284,19 +482,20 @@ class LogicalBlock(Block):
                             nonce=data_dict['nonce'],
                             difficulty=data_dict['difficulty'],
                             timestamp=data_dict['timestamp'],
-                            consensus_obj=consesnus_obj)
+                            consensus_obj=consesnus_obj,
+                            signature=data_dict.get('signature'))
 
     def get_block_obj(self):
         """Convert LogicalBlock to Block"""
         return Block.from_json(super(LogicalBlock, self).get_json())
 
     def validate_block(self, _latest_timestamp, _earliest_timestamp, _num_of_blocks, min_blocks,
-                       _prev_difficulty, blockchain):
+                       _prev_difficulty, blockchain, predecessor=None):
         """Validate the block by checking -
            1. The transaction signatures in the block
            2. The Merkle Tree correctness
-           3. The Block Hash with given Nonce to see if it
-              satisfies the configured number of zeroes.
+           3. The block header against the consensus, e.g. if the Block
+              Hash with given Nonce satisfies the configured number of zeroes.
 
         Returns
         -------
@@ -307,8 +506,8 @@ class LogicalBlock(Block):
             0 : If all Checks passed
         """
 
-        # Validate Transaction signatures
-        transactions = self._transactions
+        # Validate transactions, signatures checked by validate_block_content are not checked again
+        transactions = self.transactions
         if transactions is not None:
             for t in transactions:
                 if not t.validate_transaction(self._crypto_helper, blockchain):
@@ -316,20 +515,50 @@ class LogicalBlock(Block):
                     return -1
 
         # Validate Merkle Tree correctness
-        if self.compute_merkle_root() != self._merkle_tree_root:
+        if not self._content_validated and self.compute_merkle_root() != self._merkle_tree_root:
             self._logger.debug('Invalid merkle root: {}'
                                .format(self._merkle_tree_root))
             return -2
 
         #  validate nonce
         block_valid = self._consensus.validate(self, _latest_timestamp, _earliest_timestamp,
-                                               _num_of_blocks, min_blocks, _prev_difficulty)
+                                               _num_of_blocks, min_blocks, _prev_difficulty,
+                                               predecessor=predecessor)
         if not block_valid:
             self._logger.debug('Invalid block: {}'.format(self))
             return -3
 
         return 0
 
+    def validate_block_content(self):
+        """Validate the parts of the block which do not depend on the chain -
+           1. The transaction signatures in the block
+           2. The Merkle Tree correctness
+        It does not need the blockchain lock, validate_block then only
+        checks what depends on the chain.
+
+        Returns
+        -------
+        Integer
+            -1 : If Check 1 failed
+            -2 : If Check 2 failed
+            0 : If all Checks passed
+        """
+        transactions = self.transactions
+        if transactions:
+            for t, valid in zip(transactions, Transaction.verify_signatures(transactions, self._crypto_helper)):
+                if not valid:
+                    self._logger.debug('Invalid transaction signature: {}'.format(t))
+                    return -1
+
+        if self.compute_merkle_root() != self._merkle_tree_root:
+            self._logger.debug('Invalid merkle root: {}'
+                               .format(self._merkle_tree_root))
+            return -2
+
+        self._content_validated = True
+        return 0
+
     def compute_merkle_root(self):
         """Computes the hashes of all transaction and calls _merkle_root
 
@@ -374,8 +603,8 @@ class LogicalBlock(Block):
                 return _merkle_root(sub_tree)
 
         txn_hashes = []
-        if self._transactions is None:
+        if self.transactions is None:
             return None
-        for t in self._transactions:
+        for t in self.transactions:
             txn_hashes.append(self._crypto_helper.hash(t.get_json()))
         return _merkle_root(txn_hashes)
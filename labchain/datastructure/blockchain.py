@@ -1,18 +1,27 @@
+import hashlib
+import itertools
 import json
 import logging
+import os
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 from labchain.datastructure.block import LogicalBlock
 from labchain.workflow.taskTransaction import TaskTransaction
 from labchain.workflow.taskTransaction import WorkflowTransaction
-from labchain.datastructure.transaction import NoHashError
+from labchain.datastructure.transaction import NoHashError, Transaction
+from labchain.util.readWriteLock import ReadWriteLock
 
 
 class BlockChain:
+    # Format of the files written by write_snapshot
+    SNAPSHOT_VERSION = 1
+
     def __init__(self, node_id, tolerance_value, pruning_interval,
                  consensus_obj, txpool_obj, crypto_helper_obj,
-                 min_blocks_for_difficulty, db, q):
+                 min_blocks_for_difficulty, db, q, max_resident_transactions=0, persister=None):
         """Constructor for BlockChain
 
         Parameters
@@ -40,14 +49,11 @@ class BlockChain:
             key = block hash, value = LogicalBlock instance
         _orphan_blocks : Dictionary
             Dictionary of blocks whose predecessor block is not in our chain
-            key = predecessor block hash, value = LogicalBlock instance
+            key = predecessor block hash, value = List of LogicalBlock instances
         _current_branch_heads : List
             List of the block hashes, which are branch heads maintained by the node
         _node_branch_head : Hash value
             Hash value of the branch head this node is following
-        _furthest_branching_point : Dictionary
-            Information about the point where earliest branching happened in chain
-            key = block instance of branching point, value = position in the chain
         _tolerance_level : Int
             Length required by the longest chain to be switched to
         _pruning_interval : Int
@@ -57,6 +63,52 @@ class BlockChain:
         _crypto_helper : Instance of cryptoHelper module
         _db : Instance of database object
         _q = queue to get missing blocks
+        max_resident_transactions : Int
+            Number of transactions of blocks stored in the DB which are kept
+            in memory, 0 keeps all of them
+        persister : BlockPersister instance writing new blocks to the DB in
+            the background, None to write them while adding them
+        _transaction_index : Dictionary
+            Location of every transaction stored in _blockchain
+            key = transaction hash, value = Dictionary with
+            key = block hash, value = position of the transaction in the block
+        _sender_index : Dictionary
+            Posting lists of the transactions sent by a public key
+            key = sender public key, value = Dictionary with
+            key = (block hash, position of the transaction in the block), value = None
+        _receiver_index : Dictionary
+            Posting lists of the transactions received by a public key, same layout as _sender_index
+        _main_chain : List
+            Hashes of the blocks from the genesis block to _node_branch_head,
+            index = position of the block in the chain
+        _block_id_index : Dictionary
+            Hashes of all blocks in _blockchain, including side branches
+            key = block id, value = List of block hashes
+        _workflow_index : Dictionary
+            Posting lists of the workflow transactions defining a workflow id,
+            key = workflow id, value = same layout as the entries of _sender_index
+        _highest_workflow_id : Int
+            Highest numeric workflow id in _workflow_index
+        _lineage_index : Dictionary
+            Posting lists of the task and workflow transactions,
+            key = (workflow id, previous transaction hash), value = same layout as the entries of _sender_index
+        _next_in_charge_index : Dictionary
+            Posting lists of the task transactions,
+            key = next_in_charge PID, value = same layout as the entries of _sender_index
+        _type_index : Dictionary
+            Posting lists of the transactions by their class,
+            key = 'plain', 'task' or 'workflow', value = same layout as the entries of _sender_index
+        _body_cache : OrderedDict
+            Blocks stored in the DB whose transactions are in memory, least recently used first
+            key = block hash, value = number of transactions of the block
+        _resident_transactions : Int
+            Number of transactions of the blocks in _body_cache
+        _main_chain_dirty_pos : Int
+            Lowest position of _main_chain changed since the main chain flags
+            were last written to the DB, None if the DB is up to date
+        _head_listeners : List
+            Functions called with the new head block when _node_branch_head changes
+        _notified_head : Hash of the head the listeners were last called with
 
         """
         self._logger = logging.getLogger(__name__)
@@ -65,8 +117,6 @@ class BlockChain:
         self._orphan_blocks = {}
         self._current_branch_heads = []
         self._node_branch_head = None
-        self._furthest_branching_point = {"block": None,
-                                          "position": float("inf")}
         self._tolerance_level = tolerance_value
         self._pruning_interval = pruning_interval * 3600
         self._consensus = consensus_obj
@@ -75,10 +125,28 @@ class BlockChain:
         self._min_blocks = min_blocks_for_difficulty
         self._active_mine_block = None
         self._db = db
+        self._persister = persister
         self._q = q
-
-        # RLock allows for recursive use of add_block
-        self._blockchain_lock = threading.RLock()
+        self._transaction_index = {}
+        self._sender_index = {}
+        self._receiver_index = {}
+        self._main_chain = []
+        self._block_id_index = {}
+        self._workflow_index = {}
+        self._highest_workflow_id = 0
+        self._lineage_index = {}
+        self._next_in_charge_index = {}
+        self._type_index = {'plain': {}, 'task': {}, 'workflow': {}}
+        self._max_resident_transactions = max_resident_transactions
+        self._body_cache = OrderedDict()
+        self._resident_transactions = 0
+        self._body_cache_lock = threading.RLock()
+        self._main_chain_dirty_pos = None
+        self._head_listeners = []
+
+        # Queries share the lock, add_block and branch switching take it exclusively.
+        # Both modes are reentrant, which allows for recursive use of add_block
+        self._blockchain_lock = ReadWriteLock()
         self._orphan_lock = threading.RLock()
 
         # Create the very first Block, add it to Blockchain
@@ -87,12 +155,15 @@ class BlockChain:
         _first_block.set_block_pos(0)
         self._first_block_hash = _first_block.get_computed_hash()
         self._blockchain[self._first_block_hash] = _first_block
+        self._index_block(_first_block)
+        self._main_chain.append(self._first_block_hash)
 
         self._logger.debug("Added Genesis block --- \n {b} \n"
                            .format(b=str(_first_block)))
 
         self._node_branch_head = self._first_block_hash
         self._current_branch_heads = [self._first_block_hash, ]
+        self._notified_head = self._first_block_hash
         self._logger.debug("BlockChain initialized with genesis block")
 
     def get_block_range(self, range_start=None, range_end=None):
@@ -104,7 +175,7 @@ class BlockChain:
         if range_start or range_end is not found in chain, returns None
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("get_block_by_range was unable to acquire lock")
             raise TimeoutError
 
@@ -116,9 +187,18 @@ class BlockChain:
 
         if any([range_start not in self._blockchain,
                 range_end not in self._blockchain]):
-            self._blockchain_lock.release()
+            self._blockchain_lock.release_read()
             return None
 
+        _start_pos = self._get_main_chain_pos(range_start)
+        _end_pos = self._get_main_chain_pos(range_end)
+        if _start_pos is not None and _end_pos is not None:
+            # Both ends are on the chain followed by this node, slice the height array
+            _hashes = self._main_chain[max(_start_pos, 1):_end_pos + 1]
+            blocks_range = [self._blockchain.get(_h) for _h in reversed(_hashes)]
+            self._blockchain_lock.release_read()
+            return blocks_range
+
         blocks_range = []
         while _b_hash != range_start:
             _b = self._blockchain.get(_b_hash)
@@ -126,23 +206,46 @@ class BlockChain:
             blocks_range.append(_b)
         if not _b_hash == self._first_block_hash:
             blocks_range.append(self._blockchain.get(_b_hash))
-        self._blockchain_lock.release()
+        self._blockchain_lock.release_read()
         return blocks_range
 
     def get_block_by_id(self, block_id):
         """Returns the block if found in blockchain, else returns None"""
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("get_block_by_id was unable to acquire lock")
             raise TimeoutError
 
-        block_list = []
-        for _, _block in self._blockchain.items():
-            if _block.block_id == block_id:
-                block_list.append(_block)
-        self._blockchain_lock.release()
+        block_list = [self._blockchain[_hash] for _hash in self._block_id_index.get(block_id, [])
+                      if _hash in self._blockchain]
+        self._blockchain_lock.release_read()
         return block_list
 
+    def get_block_by_height(self, height):
+        """Returns the block at the given position of the chain followed by
+        this node, or None if the chain is not that long"""
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug("get_block_by_height was unable to acquire lock")
+            raise TimeoutError
+
+        block = None
+        if 0 <= height < len(self._main_chain):
+            block = self._blockchain.get(self._main_chain[height])
+        self._blockchain_lock.release_read()
+        return block
+
+    def _get_main_chain_pos(self, block_hash):
+        """Returns the position of a block if it is part of the chain followed
+        by this node, else None"""
+        _block = self._blockchain.get(block_hash)
+        if _block is None:
+            return None
+        _pos = _block.get_block_pos()
+        if _pos is None or _pos >= len(self._main_chain) or self._main_chain[_pos] != block_hash:
+            return None
+        return _pos
+
     def get_block_by_hash(self, block_hash):
         """Sends the Block information requested by any neighbour.
 
@@ -159,7 +262,7 @@ class BlockChain:
 
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("get_block_by_hash was unable to acquire lock")
             raise TimeoutError
 
@@ -167,7 +270,7 @@ class BlockChain:
         _req_block = self._blockchain.get(block_hash, None)
         if _req_block:
             block_info = _req_block.get_json()
-        self._blockchain_lock.release()
+        self._blockchain_lock.release_read()
         return block_info
 
     def get_transaction(self, transaction_hash):
@@ -182,37 +285,109 @@ class BlockChain:
             (Transaction obj, Block_hash)
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("get_transaction was unable to acquire lock")
             raise TimeoutError
 
-        for _hash, _block in self._blockchain.items():
-            _txns = _block.transactions
-            for _txn in _txns:
-                if transaction_hash == _txn.transaction_hash:
-                    self._blockchain_lock.release()
-                    return _txn, _hash
+        _locations = self._transaction_index.get(transaction_hash, {})
+        for _hash, _pos in _locations.items():
+            _block = self._blockchain.get(_hash)
+            if _block is not None:
+                self._touch_block_body(_hash)
+                self._blockchain_lock.release_read()
+                return _block.transactions[_pos], _hash
         pool_transaction = self._txpool.get_transaction_by_hash(transaction_hash)[0]
         if pool_transaction:
-            self._blockchain_lock.release()
+            self._blockchain_lock.release_read()
             return pool_transaction, "No block hash - this transaction still in the pool"
         else:
-            self._blockchain_lock.release()
+            self._blockchain_lock.release_read()
             return None, None
 
     def get_highest_workflow_ID(self):
-        list_of_transactions = self.get_all_transactions()
-        list_of_task_transaction = [TaskTransaction.from_json(t.get_json_with_signature())
-                                    for t in list_of_transactions if 'workflow_id' in t.payload]
-        list_of_workflow_transactions = [t for t in list_of_task_transaction if t.type == '1']
-        list_of_workflow_transactions += self._txpool.get_workflow_transactions()
-        highest_id = int(0)
-        for _txn in list_of_workflow_transactions:
-            wid = int(_txn.workflow_ID)
-            if wid > highest_id:
-                highest_id = wid
+        """Returns the highest workflow id defined in the blockchain or in the pool, 0 if there is none"""
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug(
+                "get_highest_workflow_ID was unable to acquire lock")
+            raise TimeoutError
+
+        highest_id = max(self._highest_workflow_id, self._txpool.get_highest_workflow_ID())
+        self._blockchain_lock.release_read()
         return highest_id
 
+    def get_workflow_transactions_by_id(self, workflow_id, skip_pool_transaction=None):
+        """Returns the workflow transactions defining a workflow id
+
+        Parameters
+        ----------
+        workflow_id : String
+            Id of the workflow
+        skip_pool_transaction : Transaction
+            Transaction left out if it is in the pool, e.g. the one being validated.
+            Copies of it in the blockchain are still returned
+
+        Returns
+        -------
+        List
+            Transaction objects from the blockchain followed by those still in the pool
+        """
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug(
+                "get_workflow_transactions_by_id was unable to acquire lock")
+            raise TimeoutError
+
+        res = self._resolve_posting_list(self._workflow_index.get(workflow_id, {}))
+        res += [t for t in self._txpool.get_workflow_transactions_by_id(workflow_id)
+                if skip_pool_transaction is None or t != skip_pool_transaction]
+        self._blockchain_lock.release_read()
+        return res
+
+    def get_task_transactions_by_lineage(self, workflow_id, previous_transaction, skip_pool_transaction=None):
+        """Returns the task and workflow transactions in the blockchain and in
+        the pool which follow a given transaction of a workflow
+
+        Parameters
+        ----------
+        workflow_id : String
+            Id of the workflow
+        previous_transaction : String
+            Hash of the preceding transaction, empty for the workflow transaction itself
+        skip_pool_transaction : Transaction
+            Transaction left out if it is in the pool, e.g. the one being validated.
+            Copies of it in the blockchain are still returned
+
+        Returns
+        -------
+        List
+            Transaction objects from the blockchain in the order their blocks
+            were added, followed by those still in the pool
+        """
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug(
+                "get_task_transactions_by_lineage was unable to acquire lock")
+            raise TimeoutError
+
+        res = self._resolve_posting_list(self._lineage_index.get((workflow_id, previous_transaction), {}))
+        res += [t for t in self._txpool.get_task_transactions_by_lineage(workflow_id, previous_transaction)
+                if skip_pool_transaction is None or t != skip_pool_transaction]
+        self._blockchain_lock.release_read()
+        return res
+
+    def get_task_transactions_by_next_in_charge(self, next_in_charge):
+        """Returns the task transactions in the blockchain handing the document flow to a PID"""
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug(
+                "get_task_transactions_by_next_in_charge was unable to acquire lock")
+            raise TimeoutError
+
+        res = self._resolve_posting_list(self._next_in_charge_index.get(next_in_charge, {}))
+        self._blockchain_lock.release_read()
+        return res
+
     def get_all_transactions(self):
         """
         Returns
@@ -221,7 +396,7 @@ class BlockChain:
             (Transaction obj, Block_hash)
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "get_all_transactions was unable to acquire lock")
             raise TimeoutError
@@ -231,71 +406,108 @@ class BlockChain:
             _txns = _block.transactions
             for _txn in _txns:
                 res.append(_txn)
-        self._blockchain_lock.release()
+        self._blockchain_lock.release_read()
         return res
 
-    def search_transaction_to_receiver(self, receiver_public_key):
+    def search_transaction_to_receiver(self, receiver_public_key, limit=None, offset=0,
+                                       min_height=None, max_height=None):
+        """Returns the transactions in the blockchain received by a public key
+
+        Parameters
+        ----------
+        receiver_public_key : String
+            Public key of the receiver
+        limit : Int
+            Maximum number of transactions to return, all if None
+        offset : Int
+            Number of matching transactions to skip
+        min_height : Int
+            Only transactions of blocks at this position in the chain or later
+        max_height : Int
+            Only transactions of blocks at this position in the chain or earlier
+
+        Returns
+        -------
+        List
+            Transaction objects, in the order their blocks were added
+        """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "search_transaction_from_receiver was unable to acquire lock")
             raise TimeoutError
 
-        res = []
-        for _hash, _block in self._blockchain.items():
-            _txns = _block.transactions
-            for _txn in _txns:
-                if _txn.receiver == receiver_public_key:
-                    res.append(_txn)
-        self._blockchain_lock.release()
+        res = self._resolve_posting_list(self._receiver_index.get(receiver_public_key, {}),
+                                         limit, offset, min_height, max_height)
+        self._blockchain_lock.release_read()
         return res
 
-    def search_transaction_from_sender(self, sender_public_key):
+    def search_transaction_from_sender(self, sender_public_key, limit=None, offset=0,
+                                       min_height=None, max_height=None):
+        """Returns the transactions in the blockchain sent by a public key,
+        see search_transaction_to_receiver for the optional parameters"""
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "search_transaction_from_sender was unable to acquire lock")
             raise TimeoutError
 
+        res = self._resolve_posting_list(self._sender_index.get(sender_public_key, {}),
+                                         limit, offset, min_height, max_height)
+        self._blockchain_lock.release_read()
+        return res
+
+    def _resolve_posting_list(self, posting_list, limit=None, offset=0,
+                              min_height=None, max_height=None):
+        """
+        Looks up the transactions referenced by a posting list of _sender_index or _receiver_index
+        :param posting_list: Dictionary with (block hash, position in block) keys
+        :param limit: maximum number of transactions to return, all if None
+        :param offset: number of matching transactions to skip
+        :param min_height: lowest block position in the chain to consider
+        :param max_height: highest block position in the chain to consider
+        :return: list of transaction objects
+        """
         res = []
-        for _hash, _block in self._blockchain.items():
-            _txns = _block.transactions
-            for _txn in _txns:
-                if _txn.sender == sender_public_key:
-                    res.append(_txn)
-        self._blockchain_lock.release()
+        for _hash, _pos in posting_list:
+            if limit is not None and len(res) >= limit:
+                break
+            _block = self._blockchain.get(_hash)
+            if _block is None:
+                continue
+            if min_height is not None or max_height is not None:
+                _height = _block.get_block_pos()
+                if min_height is not None and _height < min_height:
+                    continue
+                if max_height is not None and _height > max_height:
+                    continue
+            if offset > 0:
+                offset -= 1
+                continue
+            self._touch_block_body(_hash)
+            res.append(_block.transactions[_pos])
         return res
 
     def get_task_transactions(self):
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "get_task_transactions was unable to acquire lock")
             raise TimeoutError
 
-        task_transactions = []
-        for _hash, _block in self._blockchain.items():
-            _txns = _block.transactions
-            for _txn in _txns:
-                if isinstance(_txn, TaskTransaction) and not isinstance(_txn, WorkflowTransaction):
-                    task_transactions.append(_txn)
-        self._blockchain_lock.release()
+        task_transactions = self._resolve_posting_list(self._type_index['task'])
+        self._blockchain_lock.release_read()
         return task_transactions
 
     def get_workflow_transactions(self):
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "get_workflow_transaction was unable to acquire lock")
             raise TimeoutError
 
-        task_transactions = []
-        for _hash, _block in self._blockchain.items():
-            _txns = _block.transactions
-            for _txn in _txns:
-                if isinstance(_txn, WorkflowTransaction):
-                    task_transactions.append(_txn)
-        self._blockchain_lock.release()
+        task_transactions = self._resolve_posting_list(self._type_index['workflow'])
+        self._blockchain_lock.release_read()
         return task_transactions
 
     def get_n_last_transactions(self, n):
@@ -308,23 +520,21 @@ class BlockChain:
         array of transactions
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug(
                 "get_n_last_transactions was unable to acquire lock")
             raise TimeoutError
 
         n = int(n)
-        number_of_transactions = 0
         total_transactions = []
-        current_block_hash = self._node_branch_head
-        while (number_of_transactions < n
-               and self._blockchain[current_block_hash].block_id != 0):
-            remained_transactions = n - number_of_transactions
-            block_transactions = self._blockchain[current_block_hash].transactions[:remained_transactions]
-            current_block_hash = self._blockchain[current_block_hash].predecessor_hash
+        # Walk the height array backwards, position 0 is the genesis block
+        for _pos in range(len(self._main_chain) - 1, 0, -1):
+            if len(total_transactions) >= n:
+                break
+            remained_transactions = n - len(total_transactions)
+            block_transactions = self._blockchain[self._main_chain[_pos]].transactions[:remained_transactions]
             total_transactions.extend(block_transactions)
-            number_of_transactions += len(block_transactions)
-        self._blockchain_lock.release()
+        self._blockchain_lock.release_read()
         return total_transactions
 
     def calculate_diff(self, _hash=None):
@@ -350,53 +560,74 @@ class BlockChain:
             difficulty of the latest block
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("calculate_diff was unable to acquire lock")
             raise TimeoutError
 
         if not _hash:
             _hash = self._node_branch_head
-        last_block_json = self.get_block_by_hash(_hash)
-        if last_block_json:
-            _last_block = json.loads(last_block_json)
-        else:
-            self._blockchain_lock.release()
+        _last_block = self._blockchain.get(_hash)
+        if _last_block is None:
+            self._blockchain_lock.release_read()
             return -1, -1, -1, -1, -1
 
         # if only genesis block present in chain return 0 as timestamps
         # and 1 as difficulty
-        if _last_block["nr"] == 0:
-            self._blockchain_lock.release()
+        if _last_block.block_id == 0:
+            self._blockchain_lock.release_read()
             return 0, 0, 1, self._min_blocks, 1
 
-        avg_difficulty = 0
-        # getting timestamp and difficulty of the last block added in the chain
-        _latest_timestamp = _last_block['timestamp']
-        _latest_difficulty = _last_block['difficulty']
-        avg_difficulty += _latest_difficulty
-
-        # setting hash of the second last block
-        _hash = _last_block['predecessorBlock']
-        # if there is only one block
-        _earliest_timestamp = _latest_timestamp
-        _number_of_blocks = 1
-        # looping over last min_blocks to get the timestamp of the earliest block
-        while _number_of_blocks < self._min_blocks:
-            _json_block = self.get_block_by_hash(_hash)
-            if _json_block is None:
-                break
-            _block = json.loads(_json_block)
-            _id = _block["nr"]
-            if _id == 0:
-                break
-            _earliest_timestamp = _block['timestamp']
-            _hash = _block['predecessorBlock']
-            avg_difficulty += _block['difficulty']
-            _number_of_blocks += 1
-        avg_difficulty = float(avg_difficulty) / _number_of_blocks
-        self._blockchain_lock.release()
+        _latest_timestamp, _earliest_timestamp, _number_of_blocks, _difficulty_sum = \
+            self._get_difficulty_window(_last_block)
+        avg_difficulty = float(_difficulty_sum) / _number_of_blocks
+        self._blockchain_lock.release_read()
         return _latest_timestamp, _earliest_timestamp, _number_of_blocks, self._min_blocks, avg_difficulty
 
+    def _get_difficulty_window(self, block: LogicalBlock):
+        """
+        Returns the difficulty window aggregates of a block in _blockchain. Windows of blocks which were not
+        linked by _add_block_to_blockchain are derived from the closest ancestor with a window.
+        :param block: block in _blockchain
+        :return: (latest timestamp, earliest timestamp, number of blocks, difficulty sum)
+        """
+        _missing = []
+        _b = block
+        while _b is not None and _b.get_difficulty_window() is None:
+            _missing.append(_b)
+            if _b.block_id == 0:
+                break
+            _b = self._blockchain.get(_b.predecessor_hash)
+        for _b in reversed(_missing):
+            if _b.block_id != 0:
+                self._set_difficulty_window(_b, self._blockchain.get(_b.predecessor_hash))
+        return block.get_difficulty_window()
+
+    def _set_difficulty_window(self, block: LogicalBlock, predecessor):
+        """
+        Derives the difficulty window of a block from the window of its predecessor
+        :param block: block whose window is set
+        :param predecessor: predecessor of the block, None if it is missing
+        """
+        _oldest = None
+        if predecessor is not None and predecessor.block_id != 0 and self._min_blocks > 1 and \
+                predecessor.get_difficulty_window()[2] >= self._min_blocks:
+            # The window slides, the block min_blocks - 1 positions back becomes its oldest block
+            _distance = self._min_blocks - 2
+            if predecessor.get_block_pos() is not None:
+                _oldest = self._get_ancestor(predecessor, predecessor.get_block_pos() - _distance)
+            else:
+                # Blocks which were not linked have no skip pointers
+                _ancestors = [predecessor]
+                while len(_ancestors) <= _distance:
+                    _ancestor = self._blockchain.get(_ancestors[-1].predecessor_hash)
+                    if _ancestor is None or _ancestor.block_id == 0:
+                        # The window ends at the oldest ancestor present
+                        block.recompute_difficulty_window(_ancestors)
+                        return
+                    _ancestors.append(_ancestor)
+                _oldest = _ancestors[-1]
+        block.set_difficulty_window(predecessor, self._min_blocks, _oldest)
+
     def add_block(self, block, db_flag=True):
         """Finds correct position and adds the new block to the chain.
         If block predecessor not found in chain, stores block as an orphan.
@@ -420,56 +651,237 @@ class BlockChain:
             self._logger.debug("Converting block to logical block!")
             block = LogicalBlock.from_block(block, self._consensus)
 
+        # Checks which do not depend on the chain run before taking the lock
+        if block.get_computed_hash() not in self._blockchain and not self._check_block_content(block):
+            return False
+
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_write():
             self._logger.debug("Add block was unable to acquire lock")
             raise TimeoutError
 
+        try:
+            _added = self._insert_block(block, db_flag)
+        except ValueError:
+            self._blockchain_lock.release_write()
+            raise
+        if not _added:
+            self._blockchain_lock.release_write()
+            return False
+
+        self._logger.info("Added new block --- \n {h} \n {b} \n"
+                          .format(h=str(block.get_computed_hash()),
+                                  b=str(block)))
+        self._logger.debug("Number of branches currently branch heads = {}"
+                           .format(len(self._current_branch_heads)))
+        i = 0
+        for branch in self._current_branch_heads:
+            self._logger.debug("Branch {} : {}".format(i + 1, branch))
+            i += 1
+
+        self._blockchain_lock.release_write()
+
+        self.switch_to_longest_branch()
+        return True
+
+    def add_blocks(self, blocks, db_flag=True):
+        """Adds a batch of blocks, e.g. received while bootstrapping or read
+        from the DB. The lock is taken once for the whole batch, the blocks
+        to be stored are written to the DB in a single transaction and the
+        longest branch is only evaluated after the last block.
+
+        Parameters
+        ----------
+        blocks : List
+            Block or LogicalBlock instances, every block should come after
+            its predecessor. Blocks out of order are kept as orphans until
+            their predecessor is added.
+        db_flag : Boolean
+            To check if provided blocks be added to DB or not
+
+        Returns
+        -------
+        Int
+            Number of blocks saved in the chain or as orphans
+        """
+        blocks = [block if isinstance(block, LogicalBlock) else LogicalBlock.from_block(block, self._consensus)
+                  for block in blocks]
+        # The signatures of all blocks are verified in one batch, the checks per block then find them verified
+        Transaction.verify_signatures([transaction for block in blocks
+                                       if block.get_computed_hash() not in self._blockchain
+                                       for transaction in block.transactions or []], self._crypto_helper)
+        # Checks which do not depend on the chain run before taking the lock
+        blocks = [block for block in blocks
+                  if block.get_computed_hash() in self._blockchain or self._check_block_content(block)]
+
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_write():
+            self._logger.debug("Add blocks was unable to acquire lock")
+            raise TimeoutError
+
+        _pending_saves = []
+        _added = 0
+        try:
+            for block in blocks:
+                if self._insert_block(block, db_flag, _pending_saves):
+                    _added += 1
+        finally:
+            self._save_blocks(_pending_saves)
+            self._blockchain_lock.release_write()
+
+        self._logger.info("Added {} of {} blocks, node branch head: {}"
+                          .format(_added, len(blocks), self._node_branch_head))
+        self.switch_to_longest_branch()
+        return _added
+
+    def add_stored_blocks(self, stored_blocks, trusted=True, verify_merkle_root=False, chunk_size=1000):
+        """Adds the blocks read from the own DB at startup. In trusted mode
+        the blocks are linked into the chain without validating them again,
+        only the stored hash chain is checked: every block must hash to the
+        hash it was stored under and its predecessor must be in the chain.
+        The first block failing the checks and all blocks after it are
+        validated in full by add_blocks.
+
+        Parameters
+        ----------
+        stored_blocks : Iterable
+            (stored hash, Block instance) tuples, every block should come after its predecessor
+        trusted : Boolean
+            False validates every block in full
+        verify_merkle_root : Boolean
+            Additionally check the merkle root of every block in trusted mode
+        chunk_size : Int
+            Number of blocks added while holding the lock once
+
+        Returns
+        -------
+        Int
+            Number of blocks saved in the chain or as orphans
+        """
+        _added = 0
+        _stored_blocks = iter(stored_blocks)
+        for _chunk in iter(lambda: list(itertools.islice(_stored_blocks, chunk_size)), []):
+            if trusted:
+                _linked = self._link_stored_blocks(_chunk, verify_merkle_root)
+                _added += _linked
+                if _linked == len(_chunk):
+                    continue
+                self._logger.warning("Stored block {} is inconsistent, validating the remaining blocks in full"
+                                     .format(_chunk[_linked][0]))
+                trusted = False
+                _chunk = _chunk[_linked:]
+            _added += self.add_blocks([_block for _, _block in _chunk], False)
+        self.switch_to_longest_branch()
+        return _added
+
+    def _link_stored_blocks(self, stored_blocks, verify_merkle_root):
+        """
+        Links blocks read from the own DB into the chain without validating them again
+        :param stored_blocks: list of (stored hash, Block instance) tuples
+        :param verify_merkle_root: True, if the merkle root of every block is checked as well
+        :return: number of blocks linked, the block after them failed the checks
+        """
+        if not self._blockchain_lock.acquire_write():
+            self._logger.debug("Link stored blocks was unable to acquire lock")
+            raise TimeoutError
+
+        _linked = 0
+        try:
+            for _stored_hash, _block in stored_blocks:
+                if not isinstance(_block, LogicalBlock):
+                    _block = LogicalBlock.from_trusted_block(_block, self._consensus)
+                if _block.get_computed_hash() != _stored_hash or _block.predecessor_hash not in self._blockchain:
+                    break
+                if verify_merkle_root and _block.compute_merkle_root() != _block.merkle_tree_root:
+                    break
+                if _stored_hash not in self._blockchain:
+                    self._add_block_to_blockchain(_block, False)
+                _linked += 1
+        finally:
+            self._blockchain_lock.release_write()
+        return _linked
+
+    def _check_block_content(self, block: LogicalBlock):
+        """
+        Checks the signatures and the merkle root of a block without holding the lock
+        :param block: the block to be added
+        :return: True if the checks passed, False if the block is discarded
+        """
+        if block.validate_block_content() == 0:
+            return True
+        self._logger.debug("The block received is not valid, discarding this block -- \n {b}".format(b=str(block)))
+        if block.is_block_ours(self._node_id):
+            self._logger.debug("Since this block is ours, returning the transactions back to transaction pool")
+            self._txpool.return_transactions_to_pool(block.transactions, self)
+        return False
+
+    def _insert_block(self, block: LogicalBlock, db_flag, pending_saves=None):
+        """
+        Validates a block and adds it to the blockchain or the orphan pool, the write lock must be held
+        :param block: the block to be added
+        :param db_flag: True, if block should be added to database
+        :param pending_saves: list collecting the blocks to be saved later, None to save them right away
+        :return: True if the block is saved in the chain or as orphan, False if it is discarded
+        :raises ValueError if the validation result is unexpected
+        """
         if block.get_computed_hash() in self._blockchain:
             self._logger.debug("Hash already present in blockchain! Not adding.")
-            self._blockchain_lock.release()
             return False
 
         validation_result = self._get_validation_data(block)
 
         if validation_result == 0:  # Block is valid and can be added
-            self._add_block_to_blockchain(block, db_flag)
-            self._check_for_orphans_with_parent(db_flag)  # New block might be predecessor of orphans
+            self._add_block_to_blockchain(block, db_flag, pending_saves)
+            # New block might be predecessor of orphans
+            self._check_for_orphans_with_parent(block.get_computed_hash(), db_flag, pending_saves)
         elif validation_result == -1:  # Block is invalid and has to be discarded
             self._logger.debug("The block received is not valid, discarding this block -- \n {b}".format(b=str(block)))
             if block.is_block_ours(self._node_id):
                 self._logger.debug("Since this block is ours, returning the transactions back to transaction pool")
                 _txns = block.transactions
                 self._txpool.return_transactions_to_pool(_txns, self)
-            del block
             self._logger.debug("Block not valid! Not adding.")
-            self._blockchain_lock.release()
             return False
         elif validation_result == -2:  # Blocks seems to be an orphan and is added to orphan_pool
             self._add_block_to_orphan_pool(block)
         else:  # This case could be relevant in future and informs about possible bugs
             self._logger.error('Unexpected block state')
-            self._blockchain_lock.release()
             raise ValueError
 
         # kill mine check
         if not block.is_block_ours(self._node_id):
             self.check_block_in_mining(block)
+        return True
 
-        self._logger.info("Added new block --- \n {h} \n {b} \n"
-                          .format(h=str(block.get_computed_hash()),
-                                  b=str(block)))
-        self._logger.debug("Number of branches currently branch heads = {}"
-                           .format(len(self._current_branch_heads)))
-        i = 0
-        for branch in self._current_branch_heads:
-            self._logger.debug("Branch {} : {}".format(i + 1, branch))
-            i += 1
-
-        self._blockchain_lock.release()
+    def _save_blocks(self, blocks):
+        """
+        Writes blocks to the DB in one transaction, or hands them to the persister.
+        If the transaction fails, e.g. because a transaction is stored for another
+        branch already, every block is saved on its own.
+        :param blocks: blocks which were added to _blockchain
+        """
+        if not blocks:
+            return
+        if self._persister is not None:
+            for block in blocks:
+                self._persister.put(block, self._on_block_stored)
+            return
+        if self._db.save_blocks(blocks):
+            for block in blocks:
+                self._on_block_stored(block)
+        else:
+            for block in blocks:
+                if self._db.save_block(block):
+                    self._on_block_stored(block)
+        self._logger.info('Saved {} blocks to DB'.format(len(blocks)))
 
-        self.switch_to_longest_branch()
-        return True
+    def _on_block_stored(self, block: LogicalBlock):
+        """
+        Called once a block in _blockchain is written to or read from the DB
+        :param block: the stored block
+        """
+        block.mark_stored()
+        self._cache_block_body(block)
 
     def _get_validation_data(self, block: LogicalBlock):
         """
@@ -488,7 +900,7 @@ class BlockChain:
             _latest_ts, _earliest_ts, _num_of_blocks, _min_blocks, _latest_difficulty = self.calculate_diff(
                 block.predecessor_hash)
             validity_level = block.validate_block(_latest_ts, _earliest_ts, _num_of_blocks, _min_blocks,
-                                                  _latest_difficulty, self)
+                                                  _latest_difficulty, self, predecessor=self._blockchain[_prev_hash])
             if validity_level == 0:
                 return 0
             elif validity_level == -1:
@@ -500,32 +912,109 @@ class BlockChain:
         else:
             return -2  # without predecessor it has to be an orphan
 
-    def _add_block_to_blockchain(self, block: LogicalBlock, db_flag):
+    def _add_block_to_blockchain(self, block: LogicalBlock, db_flag, pending_saves=None):
         """
         A valid block is added to the blockchain
         :param block:   the block to be added to the blockchain
         :param db_flag: True, if block should be added to database
+        :param pending_saves: list collecting the blocks to be saved later, None to save the block right away
         """
         _prev_block = self._blockchain.get(block.predecessor_hash)
         _prev_block_pos = _prev_block.get_block_pos()
 
         if block.predecessor_hash in self._current_branch_heads:
             self._current_branch_heads.remove(block.predecessor_hash)
-        else:
-            if _prev_block_pos < self._furthest_branching_point["position"]:
-                self._furthest_branching_point["position"] = _prev_block_pos
-                self._furthest_branching_point["block"] = _prev_block
 
         block.set_block_pos(_prev_block_pos + 1)
+        self._set_difficulty_window(block, _prev_block)
+        block.set_skip_pointers(self._compute_skip_pointers(block))
         self._blockchain[block.get_computed_hash()] = block
+        self._index_block(block)
         self._current_branch_heads.append(block.get_computed_hash())
-        if db_flag:
-            self._db.save_block(block)
-            self._logger.info('Saved block no. {} to DB'.format(block.block_id))
+        if db_flag and pending_saves is not None:
+            pending_saves.append(block)
+        elif db_flag:
+            self._save_blocks([block])
+        elif self._db is not None:
+            # The block was loaded from the DB
+            self._on_block_stored(block)
 
         if block.predecessor_hash == self._node_branch_head:
             self._logger.debug("Branch head updated for node {}".format(self._node_id))
             self._node_branch_head = block.get_computed_hash()
+            del self._main_chain[block.get_block_pos():]
+            self._main_chain.append(self._node_branch_head)
+            self._mark_main_chain_dirty(block.get_block_pos())
+
+    def _index_block(self, block: LogicalBlock):
+        """
+        Adds the transactions of a block which is part of _blockchain to the lookup indexes
+        :param block: the block whose transactions are indexed
+        """
+        _block_hash = block.get_computed_hash()
+        self._block_id_index.setdefault(block.block_id, []).append(_block_hash)
+        for _pos, _txn in enumerate(block.transactions or []):
+            if not _txn.transaction_hash:
+                _txn.transaction_hash = self._crypto_helper.hash(_txn.get_json())
+            self._transaction_index.setdefault(_txn.transaction_hash, {})[_block_hash] = _pos
+            self._sender_index.setdefault(_txn.sender, {})[(_block_hash, _pos)] = None
+            self._receiver_index.setdefault(_txn.receiver, {})[(_block_hash, _pos)] = None
+            _workflow_id = WorkflowTransaction.get_defined_workflow_id(_txn)
+            if _workflow_id is not None:
+                self._workflow_index.setdefault(_workflow_id, {})[(_block_hash, _pos)] = None
+                _workflow_number = WorkflowTransaction.get_workflow_number(_workflow_id)
+                if _workflow_number is not None and _workflow_number > self._highest_workflow_id:
+                    self._highest_workflow_id = _workflow_number
+            self._type_index[TaskTransaction.get_transaction_type(_txn)][(_block_hash, _pos)] = None
+            _lineage_key = TaskTransaction.get_lineage_key(_txn)
+            if _lineage_key is not None:
+                self._lineage_index.setdefault(_lineage_key, {})[(_block_hash, _pos)] = None
+            _next_in_charge = TaskTransaction.get_next_in_charge(_txn)
+            if _next_in_charge is not None:
+                self._next_in_charge_index.setdefault(_next_in_charge, {})[(_block_hash, _pos)] = None
+
+    def _unindex_block(self, block: LogicalBlock):
+        """
+        Removes the transactions of a block, which is dropped from _blockchain, from the lookup indexes
+        :param block: the block whose transactions are removed from the indexes
+        """
+        _block_hash = block.get_computed_hash()
+        _hashes = self._block_id_index.get(block.block_id, [])
+        if _block_hash in _hashes:
+            _hashes.remove(_block_hash)
+            if not _hashes:
+                del self._block_id_index[block.block_id]
+        for _pos, _txn in enumerate(block.transactions or []):
+            self._remove_from_index(self._transaction_index, _txn.transaction_hash, _block_hash)
+            self._remove_from_index(self._sender_index, _txn.sender, (_block_hash, _pos))
+            self._remove_from_index(self._receiver_index, _txn.receiver, (_block_hash, _pos))
+            _workflow_id = WorkflowTransaction.get_defined_workflow_id(_txn)
+            if _workflow_id is not None:
+                self._remove_from_index(self._workflow_index, _workflow_id, (_block_hash, _pos))
+                if _workflow_id not in self._workflow_index and \
+                        WorkflowTransaction.get_workflow_number(_workflow_id) == self._highest_workflow_id:
+                    self._highest_workflow_id = WorkflowTransaction.get_highest_workflow_number(
+                        self._workflow_index)
+            self._type_index[TaskTransaction.get_transaction_type(_txn)].pop((_block_hash, _pos), None)
+            self._remove_from_index(self._lineage_index, TaskTransaction.get_lineage_key(_txn),
+                                    (_block_hash, _pos))
+            self._remove_from_index(self._next_in_charge_index, TaskTransaction.get_next_in_charge(_txn),
+                                    (_block_hash, _pos))
+
+    @staticmethod
+    def _remove_from_index(index, key, location):
+        """
+        Removes a single location from an index and drops the key once no location is left
+        :param index: one of the transaction indexes
+        :param key: key of the index entry
+        :param location: key of the location inside the index entry
+        """
+        _locations = index.get(key)
+        if _locations is None:
+            return
+        _locations.pop(location, None)
+        if not _locations:
+            del index[key]
 
     def _add_block_to_orphan_pool(self, block: LogicalBlock):
         """
@@ -538,23 +1027,24 @@ class BlockChain:
         if not self._orphan_lock.acquire():
             self._logger.debug("Add block was unable to acquire orphan_lock")
             raise TimeoutError
-        """
-        The case that multiple orphans could have the same predecessor block was not considered in the previous
-        version of the code. In this refactoring, the logic to add orphans to the blockchain if predecessors arrive
-        has been added. Idea to implement this would be to modify the dictionary so that a list of orphans is saved
-        for each predecessor-hash
-        """
-        if block.predecessor_hash in self._orphan_blocks:
-            self._logger.warning("Orphan with same predecessor already in orphan_pool, overwriting")
-        self._orphan_blocks[block.predecessor_hash] = block
+
+        _siblings = self._orphan_blocks.setdefault(block.predecessor_hash, [])
+        _block_hash = block.get_computed_hash()
+        if any(_sibling.get_computed_hash() == _block_hash for _sibling in _siblings):
+            self._logger.debug("Orphan already in orphan_pool, not adding")
+        else:
+            _siblings.append(block)
         self._orphan_lock.release()
         self.request_block_from_neighbour(block.predecessor_hash)
 
-    def _check_for_orphans_with_parent(self, db_flag):
+    def _check_for_orphans_with_parent(self, parent_hash, db_flag, pending_saves=None):
         """
-        Checks, if adding orphans to the blockchain results in other orphans finding their predecessor. If so, these
-        blocks should be added too.
-        :param db_flag: flag passed to _add_block_to_blockchain (due to recursive calls)
+        Adds the orphans waiting for a block which was just added to the blockchain. Every orphan added this way can
+        be the predecessor of other orphans, so their subtrees are attached with a worklist until no orphan is left
+        whose predecessor is in the blockchain.
+        :param parent_hash: hash of the block which was added to the blockchain
+        :param db_flag: flag passed to _add_block_to_blockchain
+        :param pending_saves: list passed to _add_block_to_blockchain
         :raises TimeoutError if orphan_pool cannot be accessed
         :raises ValueError if orphan is still considered in orphan although predecessor is in blockchain
         """
@@ -563,53 +1053,45 @@ class BlockChain:
             self._logger.debug("Add block was unable to acquire orphan_lock")
             raise TimeoutError
 
-        predecessor_is_in_blockchain = self._get_orphans_with_predecessor_in_blockchain()
-
-        # Add blocks with predecessor in blockchain to blockchain
-        for predecessor_hash in predecessor_is_in_blockchain:  # Checks each block in orphan_pool
-            block = predecessor_is_in_blockchain[predecessor_hash]
-            validation_result = self._get_validation_data(block)  # Revalidation of block
-            if validation_result == 0:  # former orphan is now a valid block and is added
-                self._add_block_to_blockchain(block, db_flag)
-            elif validation_result == -1:  # former orphan is invalid and should be discarded
-                self._logger.debug("The block taken from orphan_pool is not valid, discarding this block -- \n {b}"
-                                   .format(b=str(block)))
-                if block.is_block_ours(self._node_id):
-                    self._logger.debug("Since this block is ours, returning the transactions back to transaction pool")
-                    _txns = block.transactions
-                    self._txpool.return_transactions_to_pool(_txns, self)
-                del block
-                self._logger.debug("Block not valid! Not adding.")
-            else:
-                """
-                    validation_result -2 cannot happen, because block was taken from orphan pool and cannot be an
-                    orphan again since predecessor is now in blockchain
-                """
-                self._logger.error('Unexpected block state')
-                self._orphan_lock.release()
-                raise ValueError
-
-        # Remove non-orphans from orphan_pool
-        self._orphan_blocks = {k: self._orphan_blocks[k] for k in
-                               set(self._orphan_blocks) - set(predecessor_is_in_blockchain)}
-        if len(predecessor_is_in_blockchain) == 0:
-            # All orphans have predecessors not in blockchain, terminate recursion
-            self._orphan_lock.release()
-            return
-        else:  # Check if orphans got a parent in blockchain
-            self._check_for_orphans_with_parent(db_flag)
-            self._orphan_lock.release()
+        _worklist = [parent_hash]
+        while _worklist:
+            _children = self._orphan_blocks.pop(_worklist.pop(), [])
+            for block in _children:
+                if block.get_computed_hash() in self._blockchain:
+                    continue
+                validation_result = self._get_validation_data(block)  # Revalidation of block
+                if validation_result == 0:  # former orphan is now a valid block and is added
+                    self._add_block_to_blockchain(block, db_flag, pending_saves)
+                    _worklist.append(block.get_computed_hash())
+                elif validation_result == -1:  # former orphan is invalid and should be discarded
+                    self._logger.debug("The block taken from orphan_pool is not valid, discarding this block -- \n {b}"
+                                       .format(b=str(block)))
+                    if block.is_block_ours(self._node_id):
+                        self._logger.debug("Since this block is ours, returning the transactions back to "
+                                           "transaction pool")
+                        _txns = block.transactions
+                        self._txpool.return_transactions_to_pool(_txns, self)
+                    self._logger.debug("Block not valid! Not adding.")
+                else:
+                    """
+                        validation_result -2 cannot happen, because block was taken from orphan pool and cannot be an
+                        orphan again since predecessor is now in blockchain
+                    """
+                    self._logger.error('Unexpected block state')
+                    self._orphan_lock.release()
+                    raise ValueError
+        self._orphan_lock.release()
 
-    def _get_orphans_with_predecessor_in_blockchain(self):
-        """
-        Searches for orphans where a predecessor can be found
-        :return: list of orphans with predecessor
-        """
-        _pred_is_in_blockchain = {}
-        for _orphan_predecessor_hash in self._orphan_blocks:
-            if _orphan_predecessor_hash in self._blockchain:
-                _pred_is_in_blockchain[_orphan_predecessor_hash] = self._orphan_blocks[_orphan_predecessor_hash]
-        return _pred_is_in_blockchain
+    def get_head_block(self):
+        """Returns the LogicalBlock at the head of the branch this node mines on"""
+        # Protection mechanism for multithreading
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug("get_head_block was unable to acquire lock")
+            raise TimeoutError
+
+        _head = self._blockchain[self._node_branch_head]
+        self._blockchain_lock.release_read()
+        return _head
 
     def create_block(self, transactions):
         """Creates a new LogicalBlock instance.
@@ -626,7 +1108,7 @@ class BlockChain:
 
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_read():
             self._logger.debug("create_block was unable to acquire lock")
             raise TimeoutError
 
@@ -637,7 +1119,7 @@ class BlockChain:
                                  predecessor_hash=self._node_branch_head,
                                  block_creator_id=self._node_id,
                                  consensus_obj=self._consensus)
-        self._blockchain_lock.release()
+        self._blockchain_lock.release_read()
         return new_block
 
     def switch_to_longest_branch(self):
@@ -648,24 +1130,28 @@ class BlockChain:
 
         """
         # Protection mechanism for multithreading
-        if not self._blockchain_lock.acquire():
+        if not self._blockchain_lock.acquire_write():
             self._logger.debug(
                 "Switch_to_longest_branch was unable to acquire lock")
             raise TimeoutError
 
         if len(self._current_branch_heads) == 1:
             # No Branching happened yet, nothing to do here
-            self._blockchain_lock.release()
+            self._sync_main_chain()
+            self._notify_head_listeners()
+            self._blockchain_lock.release_write()
             return
 
-        _check_point_pos = self._furthest_branching_point['position']
-        _check_point = self._furthest_branching_point['block']
-        _check_point_hash = _check_point.get_computed_hash()
+        # The earliest branching point is the common ancestor of all branch heads
+        _heads = [self._blockchain[_hash] for _hash in self._current_branch_heads if _hash in self._blockchain]
+        _check_point = _heads[0]
+        for _head in _heads[1:]:
+            _check_point = self._find_common_ancestor(_check_point, _head)
+        _check_point_pos = _check_point.get_block_pos()
 
         _max_len = 0
         _max_head = None
-        for _branch_head_hash in self._current_branch_heads:
-            _head = self._blockchain.get(_branch_head_hash)
+        for _head in _heads:
             _path_len = _head.get_block_pos() - _check_point_pos
             if _path_len > _max_len:
                 _max_len = _path_len
@@ -677,33 +1163,209 @@ class BlockChain:
 
             # Save all block hashes between furthest branch and head in max chain
             _b_hash = _new_head_hash
-            _longest_chain = []
-            while _b_hash != _check_point_hash:
-                _longest_chain.append(_b_hash)
-                _b = self._blockchain.get(_b_hash)
-                _b_hash = _b.predecessor_hash
-            _longest_chain.append(_check_point_hash)
-
-            # Remove all other branches
-            # self._current_branch_heads.remove(_new_head_hash)
+            _longest_chain = set()
+            for _i in range(_max_len):
+                _longest_chain.add(_b_hash)
+                _b_hash = self._blockchain[_b_hash].predecessor_hash
+            _longest_chain.add(_check_point.get_computed_hash())
+
+            # Remove all other branches, a block shared by two of them is only removed once
             for _head in self._current_branch_heads:
                 _b_hash = _head
-                while _b_hash not in _longest_chain:
+                while _b_hash not in _longest_chain and _b_hash in self._blockchain:
                     _b = self._blockchain.pop(_b_hash)
+                    self._unindex_block(_b)
                     if _b.is_block_ours(self._node_id):
                         _txns = _b.transactions
                         self._txpool.return_transactions_to_pool(_txns, self)
+                    self._forget_block_body(_b_hash)
                     _b_hash = _b.predecessor_hash
                     del _b
 
             self._current_branch_heads = [_new_head_hash, ]
             self._node_branch_head = _new_head_hash
-            self._furthest_branching_point = {"block": None,
-                                              "position": float("inf")}
+            self._update_main_chain(_new_head_hash)
             self._logger.debug(
                 "Branch switching successful, new node branch head : {}"
                     .format(self._node_branch_head))
-        self._blockchain_lock.release()
+        self._sync_main_chain()
+        self._notify_head_listeners()
+        self._blockchain_lock.release_write()
+
+    def add_head_listener(self, listener):
+        """Registers a function which is called with the new head block
+        whenever the branch followed by this node gets a new head. It is
+        called while the lock is held, so it must return quickly.
+
+        Parameters
+        ----------
+        listener : Callable
+            Takes the LogicalBlock instance of the new head
+        """
+        self._head_listeners.append(listener)
+
+    def _notify_head_listeners(self):
+        """
+        Calls the head listeners if _node_branch_head changed since the last call, the write lock must be held
+        """
+        if self._node_branch_head == self._notified_head:
+            return
+        self._notified_head = self._node_branch_head
+        _head = self._blockchain[self._node_branch_head]
+        for _listener in self._head_listeners:
+            _listener(_head)
+
+    def _compute_skip_pointers(self, block: LogicalBlock):
+        """
+        Builds the binary lifting table of a block whose predecessor is in _blockchain
+        :param block: the block to be linked into the chain
+        :return: list of the hashes of the ancestors 1, 2, 4, ... 2^k positions before the block
+        """
+        _skip_pointers = [block.predecessor_hash]
+        while True:
+            # The ancestor 2^(k+1) positions back is the 2^k-th ancestor of the 2^k-th ancestor
+            _k = len(_skip_pointers) - 1
+            _ancestor = self._blockchain.get(_skip_pointers[_k])
+            if _ancestor is None or len(_ancestor.get_skip_pointers()) <= _k:
+                return _skip_pointers
+            _skip_pointers.append(_ancestor.get_skip_pointers()[_k])
+
+    def _get_ancestor(self, block: LogicalBlock, position):
+        """
+        Follows the skip pointers of a block down to its ancestor at a position in the chain
+        :param block: block in _blockchain
+        :param position: position of the ancestor, at most the position of block
+        :return: the ancestor block
+        """
+        while block.get_block_pos() > position:
+            _skip_pointers = block.get_skip_pointers()
+            _k = min((block.get_block_pos() - position).bit_length(), len(_skip_pointers)) - 1
+            block = self._blockchain[_skip_pointers[_k]]
+        return block
+
+    def _find_common_ancestor(self, block_a: LogicalBlock, block_b: LogicalBlock):
+        """
+        Finds the lowest common ancestor of two blocks in _blockchain in O(log n) steps
+        :param block_a: first block
+        :param block_b: second block
+        :return: the last block both blocks have in their chains
+        """
+        _position = min(block_a.get_block_pos(), block_b.get_block_pos())
+        block_a = self._get_ancestor(block_a, _position)
+        block_b = self._get_ancestor(block_b, _position)
+        if block_a is block_b:
+            return block_a
+        # Both blocks are at the same position and thus have equally long tables.
+        # Levels reaching past the genesis block after a jump are skipped
+        for _k in reversed(range(len(block_a.get_skip_pointers()))):
+            if _k >= len(block_a.get_skip_pointers()):
+                continue
+            _pointer_a = block_a.get_skip_pointers()[_k]
+            _pointer_b = block_b.get_skip_pointers()[_k]
+            if _pointer_a != _pointer_b:
+                block_a = self._blockchain[_pointer_a]
+                block_b = self._blockchain[_pointer_b]
+        return self._blockchain[block_a.predecessor_hash]
+
+    def _cache_block_body(self, block: LogicalBlock):
+        """
+        Registers the transactions of a block stored in the DB as resident and evicts
+        the least recently used transactions once _max_resident_transactions is exceeded
+        :param block: block in _blockchain whose transactions are in memory
+        """
+        if not self._max_resident_transactions:
+            return
+        _block_hash = block.get_computed_hash()
+        _count = len(block.transactions or [])
+        if not _count:
+            return
+        with self._body_cache_lock:
+            if _block_hash not in self._body_cache:
+                self._body_cache[_block_hash] = _count
+                self._resident_transactions += _count
+            self._body_cache.move_to_end(_block_hash)
+            while self._resident_transactions > self._max_resident_transactions and len(self._body_cache) > 1:
+                _evicted_hash, _evicted_count = self._body_cache.popitem(last=False)
+                self._resident_transactions -= _evicted_count
+                _evicted = self._blockchain.get(_evicted_hash)
+                if _evicted is not None:
+                    _evicted.evict_transactions(self._load_block_body)
+
+    def _load_block_body(self, block: LogicalBlock):
+        """
+        Reads the evicted transactions of a block back from the DB, called on first access
+        :param block: block whose transactions were evicted
+        :return: transactions of the block, None if they could not be loaded
+        """
+        with self._body_cache_lock:
+            if block.is_body_resident():
+                return block.transactions
+            _transactions = self._db.get_block_transactions(block.get_computed_hash())
+            if _transactions is None:
+                self._logger.error("Transactions of block {} could not be loaded from DB".format(block.block_id))
+                return None
+            block.restore_transactions(_transactions)
+            self._cache_block_body(block)
+            return _transactions
+
+    def _touch_block_body(self, block_hash):
+        """
+        Marks the transactions of a block as recently used
+        :param block_hash: hash of a block in _blockchain
+        """
+        if not self._max_resident_transactions:
+            return
+        with self._body_cache_lock:
+            if block_hash in self._body_cache:
+                self._body_cache.move_to_end(block_hash)
+
+    def _forget_block_body(self, block_hash):
+        """
+        Drops a block removed from _blockchain from the resident transactions
+        :param block_hash: hash of the removed block
+        """
+        with self._body_cache_lock:
+            _count = self._body_cache.pop(block_hash, None)
+            if _count:
+                self._resident_transactions -= _count
+
+    def _update_main_chain(self, new_head_hash):
+        """
+        Replaces the part of _main_chain after the branching point with the branch ending in new_head_hash
+        :param new_head_hash: hash of the new head of the chain followed by this node
+        """
+        _new_branch = []
+        _b_hash = new_head_hash
+        while self._get_main_chain_pos(_b_hash) is None:
+            _new_branch.append(_b_hash)
+            _b_hash = self._blockchain[_b_hash].predecessor_hash
+        _fork_pos = self._blockchain[_b_hash].get_block_pos()
+        del self._main_chain[_fork_pos + 1:]
+        self._main_chain.extend(reversed(_new_branch))
+        self._mark_main_chain_dirty(_fork_pos + 1)
+
+    def _mark_main_chain_dirty(self, pos):
+        """
+        Records that _main_chain changed from a position on, the DB is updated by _sync_main_chain
+        :param pos: lowest position of _main_chain which changed
+        """
+        if self._main_chain_dirty_pos is None or pos < self._main_chain_dirty_pos:
+            self._main_chain_dirty_pos = pos
+
+    def _sync_main_chain(self):
+        """
+        Writes the changed part of _main_chain to the main chain flags of the DB, the write lock must be held.
+        With a persister the update is queued behind the blocks it refers to.
+        """
+        if self._main_chain_dirty_pos is None:
+            return
+        _fork_height = self._main_chain_dirty_pos - 1
+        _branch = self._main_chain[self._main_chain_dirty_pos:]
+        self._main_chain_dirty_pos = None
+        if self._persister is not None:
+            self._persister.put_main_chain(_fork_height, _branch)
+        elif self._db is not None:
+            self._db.update_main_chain(_fork_height, _branch)
 
     def prune_orphans(self):
         """Delete orphans stored in the orphan store once the pruning
@@ -715,15 +1377,239 @@ class BlockChain:
             raise TimeoutError
 
         _curr_time = datetime.now()
-        for _hash in self._orphan_blocks.copy():
-            _block = self._orphan_blocks[_hash]
-            _block_creation_time = datetime.fromtimestamp(_block.timestamp)
-            _time_passed = (_curr_time - _block_creation_time).total_seconds()
-            if _time_passed >= self._pruning_interval:
+        for _hash in list(self._orphan_blocks):
+            _kept = []
+            for _block in self._orphan_blocks[_hash]:
+                _block_creation_time = datetime.fromtimestamp(_block.timestamp)
+                _time_passed = (_curr_time - _block_creation_time).total_seconds()
+                if _time_passed < self._pruning_interval:
+                    _kept.append(_block)
+            if _kept:
+                self._orphan_blocks[_hash] = _kept
+            else:
                 self._orphan_blocks.pop(_hash)
-                del _block
         self._orphan_lock.release()
 
+    def write_snapshot(self, snapshot_dir, keep=2):
+        """Writes the in-memory state of the chain, i.e. the block headers
+        with their positions and difficulty windows, the branch heads and the
+        query indexes, as JSON to a file in snapshot_dir. The transactions
+        are left out, they are read back from the DB. Blocks are not added
+        while the snapshot is taken, queries can continue.
+
+        Parameters
+        ----------
+        snapshot_dir : String
+            Directory of the snapshot files, created if missing
+        keep : Int
+            Number of the newest snapshots kept, older ones are deleted
+
+        Returns
+        -------
+        String
+            Path of the snapshot, None if there is no block besides the genesis block, no DB or the head of the
+            chain is not stored in the DB
+        """
+        if not self._blockchain_lock.acquire_read():
+            self._logger.debug("write_snapshot was unable to acquire lock")
+            raise TimeoutError
+
+        try:
+            if len(self._blockchain) == 1 or self._db is None:
+                return None
+            if self._persister is not None:
+                # Every block of the snapshot has to be saved before the save mark is taken
+                self._persister.flush()
+            _mark = self._db.get_save_mark()
+            # A block whose save failed, e.g. as a sibling stored a transaction of it first, and the blocks
+            # after it are left out, they would not be read from the DB either
+            _unstored = self._get_unstored_hashes()
+            if self._node_branch_head in _unstored:
+                self._logger.warning("Snapshot skipped, the head of the chain is not stored in the DB")
+                return None
+            _blocks = [_block for _block_hash, _block in self._blockchain.items()
+                       if _block.block_id != 0 and _block_hash not in _unstored]
+            _branch_heads = [_head for _head in self._current_branch_heads if _head not in _unstored]
+            if _unstored:
+                # Blocks whose successors were all left out become branch heads
+                _predecessors = {_block.predecessor_hash for _block in _blocks}
+                for _block_hash in _unstored:
+                    _predecessor_hash = self._blockchain[_block_hash].predecessor_hash
+                    if _predecessor_hash not in _unstored and _predecessor_hash not in _predecessors and \
+                            _predecessor_hash not in _branch_heads:
+                        _branch_heads.append(_predecessor_hash)
+            _state = {'blocks': [_block.get_snapshot() for _block in _blocks],
+                      'node_branch_head': self._node_branch_head,
+                      'current_branch_heads': _branch_heads,
+                      'main_chain': self._main_chain,
+                      'main_chain_dirty_pos': self._main_chain_dirty_pos,
+                      'transaction_index': {_hash: _positions for _hash, _positions in (
+                          (_hash, {_block_hash: _pos for _block_hash, _pos in _positions.items()
+                                   if _block_hash not in _unstored})
+                          for _hash, _positions in self._transaction_index.items()) if _positions},
+                      'sender_index': self._index_to_snapshot(self._sender_index, _unstored),
+                      'receiver_index': self._index_to_snapshot(self._receiver_index, _unstored),
+                      'block_id_index': [[_block_id, _hashes] for _block_id, _hashes in (
+                          (_block_id, [_block_hash for _block_hash in _hashes if _block_hash not in _unstored])
+                          for _block_id, _hashes in self._block_id_index.items()) if _hashes],
+                      'workflow_index': self._index_to_snapshot(self._workflow_index, _unstored),
+                      'highest_workflow_id': self._highest_workflow_id,
+                      'lineage_index': self._index_to_snapshot(self._lineage_index, _unstored),
+                      'next_in_charge_index': self._index_to_snapshot(self._next_in_charge_index, _unstored),
+                      'type_index': {_type: [_entry for _entry in _entries if _entry[0] not in _unstored]
+                                     for _type, _entries in self._type_index.items()}}
+            _payload = json.dumps({'version': self.SNAPSHOT_VERSION,
+                                   'genesis': self._first_block_hash,
+                                   'mark': _mark,
+                                   'state': _state}).encode()
+        finally:
+            self._blockchain_lock.release_read()
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        _path = os.path.join(snapshot_dir, 'snapshot-{:020d}.json'.format(time.time_ns()))
+        # The checksum in the first line detects snapshots which were not written completely
+        with open(_path + '.tmp', 'wb') as _file:
+            _file.write(hashlib.sha256(_payload).hexdigest().encode() + b'\n')
+            _file.write(_payload)
+            _file.flush()
+            os.fsync(_file.fileno())
+        os.replace(_path + '.tmp', _path)
+        for _old_path in self._list_snapshots(snapshot_dir)[keep:]:
+            os.remove(_old_path)
+        self._logger.info("Wrote snapshot of {} blocks to {}".format(len(_state['blocks']), _path))
+        return _path
+
+    def load_snapshot(self, snapshot_dir):
+        """Replaces the state of the chain with the newest valid snapshot in
+        snapshot_dir, must be called before any block is added. A snapshot
+        is valid if its checksum matches and the blocks it was taken after
+        are still in the DB. The transactions of the blocks are read from
+        the DB on first access, the blocks saved after the snapshot are
+        added with add_stored_blocks.
+
+        Parameters
+        ----------
+        snapshot_dir : String
+            Directory of the snapshot files
+
+        Returns
+        -------
+        Tuple
+            Save mark of the DB the snapshot was taken at, None if no snapshot was loaded
+        """
+        for _path in self._list_snapshots(snapshot_dir):
+            _snapshot = self._read_snapshot(_path)
+            if _snapshot is None:
+                continue
+            if not self._blockchain_lock.acquire_write():
+                self._logger.debug("load_snapshot was unable to acquire lock")
+                raise TimeoutError
+            _state = _snapshot['state']
+            # The genesis block is not part of the snapshot
+            self._blockchain = {self._first_block_hash: self._blockchain[self._first_block_hash]}
+            for _block_snapshot in _state['blocks']:
+                _block = LogicalBlock.from_snapshot(_block_snapshot, self._consensus, self._load_block_body)
+                self._blockchain[_block.get_computed_hash()] = _block
+            self._node_branch_head = _state['node_branch_head']
+            self._current_branch_heads = _state['current_branch_heads']
+            self._main_chain = _state['main_chain']
+            self._main_chain_dirty_pos = _state['main_chain_dirty_pos']
+            self._transaction_index = _state['transaction_index']
+            self._sender_index = self._index_from_snapshot(_state['sender_index'])
+            self._receiver_index = self._index_from_snapshot(_state['receiver_index'])
+            self._block_id_index = dict(_state['block_id_index'])
+            self._workflow_index = self._index_from_snapshot(_state['workflow_index'])
+            self._highest_workflow_id = _state['highest_workflow_id']
+            self._lineage_index = self._index_from_snapshot(_state['lineage_index'], tuple_keys=True)
+            self._next_in_charge_index = self._index_from_snapshot(_state['next_in_charge_index'])
+            self._type_index = {_type: {tuple(_entry): None for _entry in _entries}
+                                for _type, _entries in _state['type_index'].items()}
+            with self._body_cache_lock:
+                self._body_cache = OrderedDict()
+                self._resident_transactions = 0
+            self._blockchain_lock.release_write()
+            self._logger.info("Loaded snapshot of {} blocks from {}".format(len(self._blockchain), _path))
+            return tuple(_snapshot['mark'])
+        return None
+
+    def _get_unstored_hashes(self):
+        """
+        :return: set of the hashes of the blocks which are not stored in the DB or follow such a block
+        """
+        _unstored = set()
+        for _block_hash, _block in sorted(self._blockchain.items(),
+                                          key=lambda _item: _item[1].block_id or 0):
+            if _block.block_id == 0:
+                continue
+            if not _block.is_stored() or _block.predecessor_hash in _unstored:
+                _unstored.add(_block_hash)
+        return _unstored
+
+    @staticmethod
+    def _index_to_snapshot(index, excluded_blocks=()):
+        """
+        :param index: lookup index, value = dict with (block hash, position) keys
+        :param excluded_blocks: hashes of the blocks whose entries are left out
+        :return: list of [key, list of [block hash, position]] pairs, JSON keeps keys which are no strings
+        """
+        _pairs = []
+        for _key, _entries in index.items():
+            _entries = [_entry for _entry in _entries if _entry[0] not in excluded_blocks]
+            if _entries:
+                _pairs.append([_key, _entries])
+        return _pairs
+
+    @staticmethod
+    def _index_from_snapshot(pairs, tuple_keys=False):
+        """
+        :param pairs: list created by _index_to_snapshot after a round trip through JSON
+        :param tuple_keys: True if the keys of the index are tuples
+        :return: the lookup index
+        """
+        return {(tuple(_key) if tuple_keys else _key): {tuple(_entry): None for _entry in _entries}
+                for _key, _entries in pairs}
+
+    def _read_snapshot(self, path):
+        """
+        Reads and checks a snapshot file
+        :param path: path of the snapshot
+        :return: the snapshot dictionary, None if the snapshot is not valid
+        """
+        try:
+            with open(path, 'rb') as _file:
+                _checksum = _file.readline().strip().decode()
+                _payload = _file.read()
+            if hashlib.sha256(_payload).hexdigest() != _checksum:
+                self._logger.warning("Snapshot {} is damaged".format(path))
+                return None
+            _snapshot = json.loads(_payload.decode())
+        except (OSError, ValueError) as e:
+            self._logger.warning("Snapshot {} could not be read: {}".format(path, e))
+            return None
+        if _snapshot.get('version') != self.SNAPSHOT_VERSION or _snapshot.get('genesis') != self._first_block_hash:
+            self._logger.warning("Snapshot {} was written by an incompatible version".format(path))
+            return None
+        if self._db is not None and (_snapshot['mark'] is None or not self._db.has_save_mark(_snapshot['mark'])):
+            self._logger.warning("Snapshot {} does not match the DB".format(path))
+            return None
+        return _snapshot
+
+    @staticmethod
+    def _list_snapshots(snapshot_dir):
+        """
+        :param snapshot_dir: directory of the snapshot files
+        :return: paths of the snapshots, newest first
+        """
+        if not os.path.isdir(snapshot_dir):
+            return []
+        return [os.path.join(snapshot_dir, _name) for _name in sorted(os.listdir(snapshot_dir), reverse=True)
+                if _name.startswith('snapshot-') and _name.endswith('.json')]
+
+    def get_lock_wait_statistics(self):
+        """Returns (seconds spent waiting, number of contended acquisitions)
+        for the blockchain lock, summed over all threads"""
+        return self._blockchain_lock.get_wait_statistics()
+
     def request_block_from_neighbour(self, requested_block_hash):
         """Requests a block from other nodes connected with.
 
@@ -12,6 +12,8 @@ class Transaction:
         self.__payload = payload
         self.__signature = signature
         self.__transaction_hash = None
+        # (JSON, signature) of the last successful signature check
+        self.__verified_content = None
 
     def to_dict(self):
         """Convert own data to a dictionary."""
@@ -75,7 +77,46 @@ class Transaction:
         :param blockchain: Blockchain object
         :returns: Receives result of transaction validation.
         """
-        return crypto_helper.validate(self.sender, self.get_json(), self.signature)
+        return self.verify_signature(crypto_helper)
+
+    def verify_signature(self, crypto_helper):
+        """
+        Checks the signature of this transaction. A successful check is remembered
+        for the signed content, so checking the transaction again only compares its JSON.
+        :param crypto_helper: Crypto_Helper instance used for validation
+        :returns: True if the signature is valid.
+        """
+        content = (self.get_json(), self.signature)
+        if content == self.__verified_content:
+            return True
+        if crypto_helper.validate(self.sender, content[0], self.signature):
+            self.__verified_content = content
+            return True
+        return False
+
+    @staticmethod
+    def verify_signatures(transactions, crypto_helper):
+        """
+        Checks the signatures of several transactions with a single call of
+        CryptoHelper.validate_many. Transactions checked before are skipped, the
+        successful checks are remembered like in verify_signature.
+        :param transactions: List of transactions
+        :param crypto_helper: Crypto_Helper instance used for validation
+        :returns: List of booleans, True if the signature of the transaction at that position is valid.
+        """
+        pending = []
+        for position, transaction in enumerate(transactions):
+            content = (transaction.get_json(), transaction.signature)
+            if content != transaction.__verified_content:
+                pending.append((position, content))
+        results = [True] * len(transactions)
+        checked = crypto_helper.validate_many([(transactions[position].sender, content[0], content[1])
+                                               for position, content in pending])
+        for (position, content), valid in zip(pending, checked):
+            if valid:
+                transactions[position].__verified_content = content
+            results[position] = valid
+        return results
 
     def __str__(self):
         return str(self.to_dict())
@@ -11,6 +11,18 @@ class TxPool:
         #  Note: Re-look this logic again later
         if self._first_time:
             self._transactions = []
+            # key = transaction hash, value = transaction in the pool
+            self._transaction_index = {}
+            # key = workflow id, value = List of workflow transactions in the pool
+            self._workflow_index = {}
+            self._highest_workflow_id = 0
+            # key = (workflow id, previous transaction hash), value = List of task transactions in the pool
+            self._lineage_index = {}
+            # key = next_in_charge PID, value = List of task transactions in the pool
+            self._next_in_charge_index = {}
+            # key = 'plain', 'task' or 'workflow', value = Dictionary with
+            # key = transaction hash, value = transaction in the pool
+            self._type_index = {'plain': {}, 'task': {}, 'workflow': {}}
             self._crypto_helper = crypto_helper_obj
             self._first_time = False
 
@@ -20,52 +32,59 @@ class TxPool:
         return cls._singleton
 
     def get_transaction(self):
-        return self._transactions.pop()
+        transaction = self._transactions.pop()
+        self._unindex_transaction(transaction)
+        return transaction
 
     def get_transaction_by_hash(self, transaction_hash):
         """tuple with 1st element as transaction and 2nd element as block_hash"""
-        for transaction in self._transactions:
-            if transaction.transaction_hash == transaction_hash:
-                return (transaction, None)
+        transaction = self._transaction_index.get(transaction_hash)
+        if transaction is not None:
+            return (transaction, None)
         return None, None
 
     def get_transactions(self, count, remove_result=True):
         transactions = self._transactions[:count]
         if remove_result:
             self._transactions = self._transactions[count:]
+            for transaction in transactions:
+                self._unindex_transaction(transaction)
         return transactions
 
     def get_task_transactions(self):
-        from labchain.workflow.taskTransaction import WorkflowTransaction, TaskTransaction
-        task_transactions = []
-        for transaction in self._transactions:
-            if isinstance(transaction,
-                          TaskTransaction) and not isinstance(transaction, WorkflowTransaction):
-                task_transactions.append(transaction)
-        return task_transactions
+        return list(self._type_index['task'].values())
 
     def get_workflow_transactions(self):
-        from labchain.workflow.taskTransaction import WorkflowTransaction
-        task_transactions = []
-        for transaction in self._transactions:
-            if isinstance(transaction, WorkflowTransaction):
-                task_transactions.append(transaction)
-        return task_transactions
+        return list(self._type_index['workflow'].values())
+
+    def get_workflow_transactions_by_id(self, workflow_id):
+        return list(self._workflow_index.get(workflow_id, []))
+
+    def get_highest_workflow_ID(self):
+        return self._highest_workflow_id
+
+    def get_task_transactions_by_lineage(self, workflow_id, previous_transaction):
+        return list(self._lineage_index.get((workflow_id, previous_transaction), []))
+
+    def get_task_transactions_by_next_in_charge(self, next_in_charge):
+        return list(self._next_in_charge_index.get(next_in_charge, []))
 
     def remove_transaction(self, transaction):
         if transaction in self._transactions:
             self._transactions.remove(transaction)
+            self._unindex_transaction(transaction)
             return True
         return False
 
     def add_transaction_if_not_exist(self, transaction, blockchain):
         if isinstance(transaction, Transaction):
-            if transaction not in self._transactions and \
+            if not transaction.transaction_hash:
+                hash_val = self._crypto_helper.hash(transaction.get_json())
+                transaction.transaction_hash = hash_val
+            if transaction.transaction_hash not in self._transaction_index and \
                     transaction.validate_transaction(self._crypto_helper, blockchain):
-                if not transaction.transaction_hash:
-                    hash_val = self._crypto_helper.hash(transaction.get_json())
-                    transaction.transaction_hash = hash_val
                 self._transactions.append(transaction)
+                self._index_transaction(transaction)
                 logging.info('Added transaction to pool: {}'.format(transaction))
                 return True
             else:
@@ -75,7 +94,56 @@ class TxPool:
     def get_transaction_count(self):
         return len(self._transactions)
 
+    def _index_transaction(self, transaction):
+        from labchain.workflow.taskTransaction import TaskTransaction, WorkflowTransaction
+        self._transaction_index[transaction.transaction_hash] = transaction
+        workflow_id = WorkflowTransaction.get_defined_workflow_id(transaction)
+        if workflow_id is not None:
+            self._workflow_index.setdefault(workflow_id, []).append(transaction)
+            workflow_number = WorkflowTransaction.get_workflow_number(workflow_id)
+            if workflow_number is not None and workflow_number > self._highest_workflow_id:
+                self._highest_workflow_id = workflow_number
+        typed_transactions = self._type_index[TaskTransaction.get_transaction_type(transaction)]
+        typed_transactions[transaction.transaction_hash] = transaction
+        lineage_key = TaskTransaction.get_lineage_key(transaction)
+        if lineage_key is not None:
+            self._lineage_index.setdefault(lineage_key, []).append(transaction)
+        next_in_charge = TaskTransaction.get_next_in_charge(transaction)
+        if next_in_charge is not None:
+            self._next_in_charge_index.setdefault(next_in_charge, []).append(transaction)
+
+    def _unindex_transaction(self, transaction):
+        from labchain.workflow.taskTransaction import TaskTransaction, WorkflowTransaction
+        if self._transaction_index.get(transaction.transaction_hash) == transaction:
+            del self._transaction_index[transaction.transaction_hash]
+        workflow_id = WorkflowTransaction.get_defined_workflow_id(transaction)
+        workflows = self._workflow_index.get(workflow_id, [])
+        if transaction in workflows:
+            workflows.remove(transaction)
+            if not workflows:
+                del self._workflow_index[workflow_id]
+                if WorkflowTransaction.get_workflow_number(workflow_id) == self._highest_workflow_id:
+                    self._highest_workflow_id = WorkflowTransaction.get_highest_workflow_number(
+                        self._workflow_index)
+        typed_transactions = self._type_index[TaskTransaction.get_transaction_type(transaction)]
+        if typed_transactions.get(transaction.transaction_hash) == transaction:
+            del typed_transactions[transaction.transaction_hash]
+        self._remove_from_bucket(self._lineage_index, TaskTransaction.get_lineage_key(transaction), transaction)
+        self._remove_from_bucket(self._next_in_charge_index, TaskTransaction.get_next_in_charge(transaction),
+                                 transaction)
+
+    @staticmethod
+    def _remove_from_bucket(index, key, transaction):
+        bucket = index.get(key)
+        if bucket and transaction in bucket:
+            bucket.remove(transaction)
+            if not bucket:
+                del index[key]
+
     def return_transactions_to_pool(self, transactions, blockchain):
+        # Verify the signatures in one batch, validate_transaction then finds them verified
+        Transaction.verify_signatures([transaction for transaction in transactions
+                                       if isinstance(transaction, Transaction)], self._crypto_helper)
         status = True
         for transaction in transactions:
             status = status and self.add_transaction_if_not_exist(transaction, blockchain)
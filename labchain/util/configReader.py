@@ -46,7 +46,8 @@ class ConfigReader:
         option: String
             The name of the option to return
         fallback: String/Integer
-            If option not found in section, return this value
+            If option not found in section or defined without value, return
+            this value. None raises ConfigReaderException instead
         """
         if self.config.has_section(section):
             if self.config.has_option(section, option):
@@ -55,7 +56,7 @@ class ConfigReader:
                 if value.isdigit():
                     value = int(value)
                 elif not value:
-                    if fallback:
+                    if fallback is not None:
                         value = fallback
                     else:
                         raise ConfigReaderException("Option {opt} in section {sec} "
@@ -68,7 +69,7 @@ class ConfigReader:
         else:
             logger.error("Error reading Config : section {sec} missing".
                          format(sec=section))
-        if fallback:
+        if fallback is not None:
             logger.info("Default value {d} being returned for option "
                         "{opt} in section {sec}".format(opt=option, sec=section, d=fallback))
             return fallback
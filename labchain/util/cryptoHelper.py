@@ -8,6 +8,60 @@ from labchain.util.utility import Utility
 
 import json
 import logging
+import multiprocessing
+import threading
+
+# Number of public keys kept imported in each process
+KEY_CACHE_SIZE = 1024
+# Batches of validate_many smaller than this are verified in the calling process
+MIN_PARALLEL_SIGNATURES = 64
+
+# Imported public keys by their string format, each process has its own cache
+_key_cache = {}
+
+
+def _import_public_key(pub_key):
+    key = _key_cache.get(pub_key)
+    if key is None:
+        if len(_key_cache) >= KEY_CACHE_SIZE:
+            _key_cache.clear()
+        key = ECC.import_key(b64decode(pub_key).decode())
+        _key_cache[pub_key] = key
+    return key
+
+
+def _unpack_payload(payload):
+    if not Utility.is_json(payload):
+        raise ValueError('Payload is not json')
+
+    payload_dict = json.loads(payload)  # Get JSON string
+    sorted_payload = sorted(payload_dict)  # Get the sorted list of keys
+
+    real_payload = ""
+
+    for i in sorted_payload:
+        real_payload += str(payload_dict[i])  # Concatenate all values according to sorted keys
+
+    return real_payload
+
+
+def _validate_signatures(items):
+    """Verifies (pub_key, payload, signature) items, an item which cannot
+    be decoded is invalid instead of raising.
+
+    Returns
+    -------
+    List of booleans in the order of the items
+    """
+    results = []
+    for pub_key, payload, signature in items:
+        try:
+            h = SHA256.new(_unpack_payload(payload).encode())
+            DSS.new(_import_public_key(pub_key), 'fips-186-3').verify(h, b64decode(signature))
+            results.append(True)
+        except (ValueError, TypeError):
+            results.append(False)
+    return results
 
 
 @Singleton
@@ -16,7 +70,9 @@ class CryptoHelper:
     In order to use the CryptoHelper, please use CryptoHelper.instance() """
 
     def __init__(self):
-        pass
+        self.verification_workers = 1
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def sign(self, private_key, payload):
         """
@@ -41,9 +97,8 @@ class CryptoHelper:
         :param signature: Signature in binary string that was produced for the given data.
         :return result: True if signature and data pair matches, false otherwise."""
 
-        pub_key = b64decode(pub_key).decode()
         h = self.__hash(payload)  # Hash the payload
-        public_key = ECC.import_key(pub_key)  # Get the public key object using public key string
+        public_key = _import_public_key(pub_key)  # Get the public key object using public key string
         verifier = DSS.new(public_key, 'fips-186-3')  # Create a signature object
         signature = b64decode(signature.encode('utf-8'))
 
@@ -58,6 +113,44 @@ class CryptoHelper:
 
         return result
 
+    def validate_many(self, items):
+        """
+        Validates several signatures at once. Large batches are spread over the
+        verification processes, each of them keeps the public keys it imported.
+        :param items: List of (public key, payload, signature) tuples as taken by validate.
+        :return results: List of booleans in the order of the items, False for items which cannot be decoded."""
+
+        items = list(items)
+        if self.verification_workers <= 1 or len(items) < MIN_PARALLEL_SIGNATURES:
+            return _validate_signatures(items)
+        with self._pool_lock:
+            if self._pool is None:
+                # Forking would copy the locks held by the threads of the node
+                self._pool = multiprocessing.get_context('spawn').Pool(self.verification_workers)
+            pool = self._pool
+        chunk_size = -(-len(items) // (4 * self.verification_workers))
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        return [result for results in pool.map(_validate_signatures, chunks) for result in results]
+
+    def set_verification_workers(self, workers):
+        """
+        Sets the number of processes validate_many uses for large batches, 1 verifies in the calling process.
+        :param workers: Number of processes, started on the first large batch."""
+
+        if workers != self.verification_workers:
+            self.close()
+        self.verification_workers = workers
+
+    def close(self):
+        """
+        Stops the verification processes."""
+
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
     def generate_key_pair(self):
         """
         Generates a public and private ECC key pair.
@@ -70,6 +163,16 @@ class CryptoHelper:
         logging.debug('Cryptohelper created a new key pair.')
         return b64encode(private_key.encode()).decode(), b64encode(public_key.encode()).decode()
 
+    def get_public_key(self, private_key):
+        """
+        Derives the public key of a private key.
+        :param private_key: Private key in the string format of generate_key_pair.
+        :return public_key: Corresponding public key in the same format."""
+
+        key = ECC.import_key(b64decode(private_key).decode())
+        public_key = key.public_key().export_key(format='PEM')
+        return b64encode(public_key.encode()).decode()
+
     def __hash(self, payload):
         try:
             real_payload = self.__unpack_payload(payload)  # Get the real payload to be hashed
@@ -89,16 +192,4 @@ class CryptoHelper:
         return hash_object.hexdigest()  # Return hex representation of the hash
 
     def __unpack_payload(self, payload):
-
-        if not Utility.is_json(payload):
-            raise ValueError('Payload is not json')
-
-        payload_dict = json.loads(payload)  # Get JSON string
-        sorted_payload = sorted(payload_dict)  # Get the sorted list of keys
-
-        real_payload = ""
-
-        for i in sorted_payload:
-            real_payload += str(payload_dict[i])  # Concatenate all values according to sorted keys
-
-        return real_payload
+        return _unpack_payload(payload)
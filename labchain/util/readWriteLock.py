@@ -0,0 +1,133 @@
+import threading
+import time
+
+
+class ReadWriteLock:
+    """Lock which lets any number of readers in at the same time, while a
+    writer gets exclusive access. Waiting writers are preferred over new
+    readers so that a steady stream of queries cannot starve the writer.
+
+    Both modes are reentrant for the owning thread, and the thread holding
+    the write lock may also acquire the read lock. Acquiring the write lock
+    while only holding the read lock is not supported, because two readers
+    upgrading at the same time would wait for each other forever.
+    """
+
+    def __init__(self):
+        """
+        Attributes
+        ----------
+        _condition : Condition guarding the fields below
+        _readers : Dictionary
+            key = thread ident, value = recursion depth of its read lock
+        _writer : thread ident of the write lock owner or None
+        _writer_depth : Int
+            Recursion depth of the write lock
+        _waiting_writers : Int
+            Number of threads waiting for the write lock
+        _wait_time : Float
+            Seconds spent by all threads waiting for the lock
+        _contended_acquires : Int
+            Number of acquisitions which had to wait
+        """
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+        self._wait_time = 0.0
+        self._contended_acquires = 0
+
+    def acquire_read(self, timeout=-1):
+        """Acquire the lock in shared mode.
+
+        Parameters
+        ----------
+        timeout : Float
+            Seconds to wait for the lock, wait forever if negative
+
+        Returns
+        -------
+        Boolean
+            True if the lock was acquired, False on timeout
+        """
+        _me = threading.get_ident()
+        with self._condition:
+            if self._writer == _me or _me in self._readers:
+                self._readers[_me] = self._readers.get(_me, 0) + 1
+                return True
+            if not self._wait(lambda: self._writer is None and self._waiting_writers == 0, timeout):
+                return False
+            self._readers[_me] = 1
+            return True
+
+    def release_read(self):
+        """Release one level of the shared lock held by this thread"""
+        _me = threading.get_ident()
+        with self._condition:
+            _depth = self._readers.get(_me)
+            if not _depth:
+                raise RuntimeError('Read lock released without being held')
+            if _depth == 1:
+                del self._readers[_me]
+                self._condition.notify_all()
+            else:
+                self._readers[_me] = _depth - 1
+
+    def acquire_write(self, timeout=-1):
+        """Acquire the lock in exclusive mode.
+
+        Parameters
+        ----------
+        timeout : Float
+            Seconds to wait for the lock, wait forever if negative
+
+        Returns
+        -------
+        Boolean
+            True if the lock was acquired, False on timeout
+        """
+        _me = threading.get_ident()
+        with self._condition:
+            if self._writer == _me:
+                self._writer_depth += 1
+                return True
+            if _me in self._readers:
+                raise RuntimeError('Upgrading a read lock to a write lock is not supported')
+            self._waiting_writers += 1
+            _acquired = self._wait(lambda: self._writer is None and not self._readers, timeout)
+            self._waiting_writers -= 1
+            if not _acquired:
+                # Readers held back by this writer may continue
+                self._condition.notify_all()
+                return False
+            self._writer = _me
+            self._writer_depth = 1
+            return True
+
+    def release_write(self):
+        """Release one level of the exclusive lock held by this thread"""
+        with self._condition:
+            if self._writer != threading.get_ident():
+                raise RuntimeError('Write lock released by a thread which does not own it')
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._condition.notify_all()
+
+    def _wait(self, predicate, timeout):
+        """Wait on the condition until predicate holds and account the time
+        spent waiting. Must be called with _condition held."""
+        if predicate():
+            return True
+        _start = time.perf_counter()
+        _acquired = self._condition.wait_for(predicate, None if timeout < 0 else timeout)
+        self._wait_time += time.perf_counter() - _start
+        self._contended_acquires += 1
+        return _acquired
+
+    def get_wait_statistics(self):
+        """Returns a tuple (seconds spent waiting, number of acquisitions
+        which had to wait) summed over both modes and all threads"""
+        with self._condition:
+            return self._wait_time, self._contended_acquires
@@ -6,7 +6,6 @@ from typing import Dict
 
 from Crypto.PublicKey import ECC
 
-import labchain.datastructure.txpool as txpool
 from labchain.datastructure.transaction import Transaction
 from labchain.util.cryptoHelper import CryptoHelper
 
@@ -109,14 +108,13 @@ class TaskTransaction(Transaction):
         return True
 
     def _check_for_duplicate_transactions(self, blockchain):
-        parallel_transactions = list(
-            set(blockchain.search_transaction_from_sender(self.sender))
-            & set(blockchain.search_transaction_to_receiver(self.receiver)))
+        parallel_transactions = blockchain.get_task_transactions_by_lineage(self.workflow_ID,
+                                                                            self.previous_transaction,
+                                                                            skip_pool_transaction=self)
         parallel_transactions = [t for t in parallel_transactions if
                                  isinstance(t, TaskTransaction) or isinstance(t, WorkflowTransaction)]
-        parallel_transactions = [t for t in parallel_transactions if t.workflow_ID == self.workflow_ID]
         parallel_transactions = [t for t in parallel_transactions if
-                                 t.previous_transaction == self.previous_transaction]
+                                 t.sender == self.sender and t.receiver == self.receiver]
         return False if len(parallel_transactions) > 0 else True
 
     def _check_pid_well_formedness(self, PID):
@@ -173,6 +171,38 @@ class TaskTransaction(Transaction):
     def workflow_transaction(self):
         return self.payload['workflow_transaction']
 
+    @staticmethod
+    def get_transaction_type(transaction):
+        """Returns 'workflow', 'task' or 'plain' depending on the class of a transaction"""
+        if isinstance(transaction, WorkflowTransaction):
+            return 'workflow'
+        if isinstance(transaction, TaskTransaction):
+            return 'task'
+        return 'plain'
+
+    @staticmethod
+    def get_lineage_key(transaction):
+        """Returns the tuple (workflow ID, previous transaction hash) of a task or
+        workflow transaction, None for any other transaction. Like
+        WorkflowTransaction.get_defined_workflow_id it only looks at the payload."""
+        payload = transaction.payload
+        if not isinstance(payload, dict) or payload.get('transaction_type') not in ('1', '2'):
+            return None
+        workflow_id = payload.get('workflow_id')
+        previous_transaction = payload.get('previous_transaction')
+        if not isinstance(workflow_id, str) or not isinstance(previous_transaction, str):
+            return None
+        return workflow_id, previous_transaction
+
+    @staticmethod
+    def get_next_in_charge(transaction):
+        """Returns the next_in_charge PID of a task transaction, None if it has none"""
+        payload = transaction.payload
+        if not isinstance(payload, dict) or payload.get('transaction_type') != '2':
+            return None
+        next_in_charge = payload.get('next_in_charge')
+        return next_in_charge if isinstance(next_in_charge, str) else None
+
     @staticmethod
     def from_json(json_data):
         """Deserialize a JSON string to a Transaction instance."""
@@ -212,6 +242,30 @@ class WorkflowTransaction(TaskTransaction):
         return WorkflowTransaction(data_dict['sender'], data_dict['receiver'],
                                    data_dict['payload'], data_dict['signature'])
 
+    @staticmethod
+    def get_defined_workflow_id(transaction):
+        """Returns the workflow ID a transaction defines, None if it is not a
+        workflow transaction. Blocks received from peers hold plain
+        Transaction objects, so the payload is inspected instead of the type."""
+        payload = transaction.payload
+        if isinstance(payload, dict) and payload.get('transaction_type') == '1' and 'workflow_id' in payload:
+            return payload['workflow_id']
+        return None
+
+    @staticmethod
+    def get_workflow_number(workflow_id):
+        """Returns the workflow ID as integer, None if it is not numeric"""
+        try:
+            return int(workflow_id)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_highest_workflow_number(workflow_ids):
+        """Returns the highest numeric workflow ID of an iterable, 0 if there is none"""
+        numbers = [WorkflowTransaction.get_workflow_number(workflow_id) for workflow_id in workflow_ids]
+        return max([number for number in numbers if number is not None], default=0)
+
     def validate_transaction(self, crypto_helper, blockchain):
         TaskTransaction._validation_lock.acquire()
         if self.payload['transaction_type'] is not '1':
@@ -219,17 +273,10 @@ class WorkflowTransaction(TaskTransaction):
             TaskTransaction._validation_lock.release()
             return False
 
-        # Check if workflow_id is already present
-        list_of_transactions = blockchain.get_all_transactions()
-        list_of_transactions += txpool.TxPool(None).get_workflow_transactions()
-        list_of_task_transaction = [TaskTransaction.from_json(t.get_json_with_signature())
-                                    for t in list_of_transactions if 'workflow_id' in t.payload]
-        list_of_workflow_transactions = [t for t in list_of_task_transaction if t.type == '1']
-        for workflow_tuple in list_of_workflow_transactions:
-            workflow = workflow_tuple
-            if self.payload['workflow_id'] == workflow.payload['workflow_id']:
-                TaskTransaction._validation_lock.release()
-                return False
+        # Check if workflow_id is already present, a copy of this transaction in a block counts as well
+        if blockchain.get_workflow_transactions_by_id(self.payload['workflow_id'], skip_pool_transaction=self):
+            TaskTransaction._validation_lock.release()
+            return False
 
         for sender, receivers in self.processes.items():
             if not self._check_pid_well_formedness(sender):
@@ -1,8 +1,10 @@
 import argparse
 import logging
 import os
+import signal
 import socket
 import sys
+import threading
 
 # append project dir to python path
 from labchain.blockchainNode import BlockChainNode
@@ -100,3 +102,13 @@ if __name__ == '__main__':
             os.remove(db_path)
 
     node = create_node(ip, args.port, initial_peers, args.peer_discovery)
+
+    # Stop the node on Ctrl+C or kill, so the blocks queued for the DB are written and the worker processes end
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    while not stop_requested.wait(1):
+        pass
+    node.stop()
+    # The threads serving the network do not end on their own
+    os._exit(0)
@@ -3,9 +3,11 @@ import json
 import logging
 import os
 import sys
+import threading
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+from labchain.blockchainNode import BlockChainNode
 from labchain.consensus.consensus import Consensus
 from labchain.datastructure.block import LogicalBlock, Block
 from labchain.datastructure.blockchain import BlockChain
@@ -318,6 +320,67 @@ class BlockChainComponent(unittest.TestCase):
         # Restore granular_factor
         self.consensus.granular_factor = previous_granular_factor
 
+    def test_add_sibling_orphans_when_predecessor_arrives(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        block1 = self.mine_block(self.blockchain._first_block_hash, 1, [])
+        self.assertTrue(self.blockchain.add_block(block1, False))
+        sibling1 = self.mine_block(block1.get_computed_hash(), 2, [], creator_id=42)
+        self.assertTrue(self.blockchain.add_block(sibling1, False))
+        sibling2 = self.mine_block(block1.get_computed_hash(), 2, [], creator_id=43)
+        self.assertTrue(self.blockchain.add_block(sibling2, False))
+        child = self.mine_block(sibling2.get_computed_hash(), 3, [], creator_id=43)
+        self.assertTrue(self.blockchain.add_block(child, False))
+
+        # Deliver the mined blocks to a fresh blockchain, children first
+        self.init_components()
+        self.blockchain.request_block_from_neighbour = MagicMock()
+
+        for orphan in [child, sibling1, sibling2, sibling2]:
+            self.assertTrue(self.blockchain.add_block(orphan, False))
+        self.assertEqual(len(self.blockchain._orphan_blocks), 2)
+        self.assertEqual(len(self.blockchain._orphan_blocks[block1.get_computed_hash()]), 2,
+                         msg='Siblings were not both kept in the orphan pool')
+
+        self.assertTrue(self.blockchain.add_block(block1, False))
+        self.assertEqual(len(self.blockchain._orphan_blocks), 0, msg='Orphans were not moved to blockchain')
+        for block in [sibling1, sibling2, child]:
+            self.assertIn(block.get_computed_hash(), self.blockchain._blockchain)
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_add_block_with_invalid_content(self):
+        block = LogicalBlock(block_id=1, predecessor_hash=self.blockchain._first_block_hash,
+                             block_creator_id=23, transactions=[self.txn1],
+                             merkle_tree_root='invalid', consensus_obj=self.consensus)
+        self.blockchain._blockchain_lock.acquire_write = MagicMock()
+        self.assertFalse(self.blockchain.add_block(block, False))
+        self.blockchain._blockchain_lock.acquire_write.assert_not_called()
+
+    def test_add_blocks(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        blocks = []
+        predecessor_hash = self.blockchain._first_block_hash
+        for i in range(1, 4):
+            block = self.mine_block(predecessor_hash, i, [])
+            self.assertTrue(self.blockchain.add_block(block, False))
+            blocks.append(block)
+            predecessor_hash = block.get_computed_hash()
+
+        self.init_components()
+        self.blockchain.request_block_from_neighbour = MagicMock()
+        self.blockchain.switch_to_longest_branch = MagicMock()
+        # The third block arrives before its predecessor, the first one twice
+        self.assertEqual(self.blockchain.add_blocks([blocks[0], blocks[2], blocks[1], blocks[0]], False), 3)
+        self.assertEqual(self.blockchain._node_branch_head, blocks[2].get_computed_hash())
+        self.assertEqual(len(self.blockchain._orphan_blocks), 0)
+        self.assertEqual(self.blockchain.switch_to_longest_branch.call_count, 1)
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
     def test_prune_orphans(self):
         self.blockchain.request_block_from_neighbour = MagicMock()
 
@@ -368,6 +431,206 @@ class BlockChainComponent(unittest.TestCase):
         # Restore granular_factor
         self.consensus.granular_factor = previous_granular_factor
 
+    def test_get_transaction(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        block = self.mine_block(self.blockchain._first_block_hash, 1, [self.txn1, self.txn2])
+        self.assertTrue(self.blockchain.add_block(block, False),
+                        msg='Block is not added')
+
+        txn, block_hash = self.blockchain.get_transaction(self.txn2.transaction_hash)
+        self.assertEqual(txn, self.txn2)
+        self.assertEqual(block_hash, block.get_computed_hash())
+        self.assertEqual(self.blockchain.get_transaction('unknown'), (None, None))
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_get_transaction_after_branch_switch(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        short_branch = self.mine_block(self.blockchain._first_block_hash, 1, [self.txn3])
+        self.assertTrue(self.blockchain.add_block(short_branch, False),
+                        msg='Block for first branch is not added')
+        self.assertIsNotNone(self.blockchain.get_transaction(self.txn3.transaction_hash)[0])
+
+        predecessor_hash = self.blockchain._first_block_hash
+        for i in range(1, 5):
+            block = self.mine_block(predecessor_hash, i, [], creator_id=42 + i)
+            self.assertTrue(self.blockchain.add_block(block, False),
+                            msg='Block for second branch is not added')
+            predecessor_hash = block.get_computed_hash()
+
+        self.assertNotIn(short_branch.get_computed_hash(), self.blockchain._blockchain,
+                         msg='Branch was not switched')
+        self.assertEqual(self.blockchain.get_block_by_height(4).get_computed_hash(), predecessor_hash)
+        self.assertEqual(self.blockchain.get_transaction(self.txn3.transaction_hash), (None, None))
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_find_common_ancestor(self):
+        def link(predecessor, block_id, creator_id):
+            block = LogicalBlock(block_id=block_id, predecessor_hash=predecessor.get_computed_hash(),
+                                 block_creator_id=creator_id, transactions=[], consensus_obj=self.consensus)
+            block.set_block_pos(predecessor.get_block_pos() + 1)
+            block.set_skip_pointers(self.blockchain._compute_skip_pointers(block))
+            self.blockchain._blockchain[block.get_computed_hash()] = block
+            return block
+
+        genesis = self.blockchain._blockchain[self.blockchain._first_block_hash]
+        main_branch = [genesis]
+        for i in range(1, 14):
+            main_branch.append(link(main_branch[-1], i, 50))
+        side_branch = [main_branch[5]]
+        for i in range(6, 10):
+            side_branch.append(link(side_branch[-1], i, 51))
+
+        self.assertEqual(len(main_branch[8].get_skip_pointers()), 4)
+        self.assertEqual(main_branch[8].get_skip_pointers()[3], genesis.get_computed_hash())
+        self.assertIs(self.blockchain._get_ancestor(main_branch[13], 0), genesis)
+        self.assertIs(self.blockchain._get_ancestor(main_branch[13], 6), main_branch[6])
+        self.assertIs(self.blockchain._find_common_ancestor(main_branch[13], side_branch[-1]), main_branch[5])
+        self.assertIs(self.blockchain._find_common_ancestor(side_branch[2], main_branch[6]), main_branch[5])
+        self.assertIs(self.blockchain._find_common_ancestor(main_branch[4], main_branch[12]), main_branch[4])
+
+    def test_head_listener(self):
+        heads = []
+        self.blockchain.add_head_listener(heads.append)
+        block1 = self.blockchain.create_block([])
+        self.blockchain._add_block_to_blockchain(block1, False)
+        block2 = self.blockchain.create_block([])
+        self.blockchain._add_block_to_blockchain(block2, False)
+        self.blockchain.switch_to_longest_branch()
+        # The listeners are only called once the head changed
+        self.blockchain.switch_to_longest_branch()
+        self.assertEqual(heads, [block2])
+
+    def test_mining_aborted_by_peer_block(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        node = BlockChainNode.__new__(BlockChainNode)
+        node.blockchain_obj = self.blockchain
+        node.txpool_obj = self.txpool
+        node.consensus_obj = self.consensus
+        node.logger = logger
+        node.node_id = "nodeId1"
+        node.network_interface = MagicMock()
+        node.mine_wakeup = threading.Event()
+        node.mine_shutdown = threading.Event()
+        node._mining_lock = threading.Lock()
+        node._mining_block = None
+        node._head_hash = None
+        self.blockchain.add_head_listener(node.on_new_head)
+        # The node saves the blocks it mined
+        self.blockchain._db = MagicMock()
+        self.txpool.get_transactions(self.txpool.get_transaction_count())
+        for transaction in [self.txn1, self.txn2]:
+            self.txpool.add_transaction_if_not_exist(transaction, self.blockchain)
+        # A peer mined the same transactions while this node was mining them
+        peer_block = self.mine_block(self.blockchain._first_block_hash, 1, [self.txn1, self.txn2], creator_id=42)
+        mine = self.consensus.mine
+        mined_blocks = []
+
+        def mine_after_peer_block(block, *args, **kwargs):
+            mined_blocks.append(block)
+            if len(mined_blocks) == 1:
+                self.assertTrue(self.blockchain.add_block(peer_block, False))
+                self.consensus.kill_mine = 0
+                return False
+            return mine(block, *args, **kwargs)
+
+        with patch.object(self.consensus, 'mine', side_effect=mine_after_peer_block):
+            node.mine_block(2)
+
+        self.assertEqual(len(mined_blocks), 2)
+        self.assertEqual(mined_blocks[1].predecessor_hash, peer_block.get_computed_hash())
+        self.assertEqual(mined_blocks[1].transactions, [])
+        self.assertEqual(self.txpool.get_transaction_count(), 0)
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_mining_after_late_peer_block(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        node = BlockChainNode.__new__(BlockChainNode)
+        node.blockchain_obj = self.blockchain
+        node.txpool_obj = self.txpool
+        node.consensus_obj = self.consensus
+        node.logger = logger
+        node.node_id = "nodeId1"
+        node.network_interface = MagicMock()
+        node.mine_wakeup = threading.Event()
+        node.mine_shutdown = threading.Event()
+        node._mining_lock = threading.Lock()
+        node._mining_block = None
+        node._head_hash = None
+        node.persister = None
+        self.blockchain._db = MagicMock()
+        self.txpool.get_transactions(self.txpool.get_transaction_count())
+        # A peer block arrived while the last attempt finished successfully
+        self.consensus.kill_mine = 1
+        try:
+            self.assertEqual(node.mine_block(2), 0)
+        finally:
+            self.consensus.kill_mine = 0
+        self.assertEqual(self.blockchain.get_head_block().block_id, 1)
+        statistics = node.get_statistics()
+        self.assertEqual(statistics['blockchain_lock']['wait_sec'], self.blockchain.get_lock_wait_statistics()[0])
+        self.assertNotIn('persister', statistics)
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_search_transactions(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        block1 = self.mine_block(self.blockchain._first_block_hash, 1, [self.txn1, self.txn2])
+        self.assertTrue(self.blockchain.add_block(block1, False))
+        block2 = self.mine_block(block1.get_computed_hash(), 2, [self.txn3, self.txn4])
+        self.assertTrue(self.blockchain.add_block(block2, False))
+
+        self.assertEqual(self.blockchain.search_transaction_from_sender(self.txn1.sender), [self.txn1])
+        self.assertEqual(self.blockchain.search_transaction_to_receiver(self.txn4.receiver), [self.txn4])
+        # txn3 is sent to the sender of txn1
+        self.assertEqual(self.blockchain.search_transaction_to_receiver(self.txn1.sender), [self.txn3])
+        self.assertEqual(self.blockchain.search_transaction_from_sender('unknown'), [])
+
+        sender = self.txn2.sender
+        txn5 = Transaction(sender, self.txn1.sender, "Payload5")
+        txn5.sign_transaction(self.crypto_helper_obj, self.pr_key2)
+        block3 = self.mine_block(block2.get_computed_hash(), 3, [txn5])
+        self.assertTrue(self.blockchain.add_block(block3, False))
+
+        self.assertEqual(self.blockchain.search_transaction_from_sender(sender), [self.txn2, txn5])
+        self.assertEqual(self.blockchain.search_transaction_from_sender(sender, limit=1), [self.txn2])
+        self.assertEqual(self.blockchain.search_transaction_from_sender(sender, offset=1), [txn5])
+        self.assertEqual(self.blockchain.search_transaction_from_sender(sender, min_height=2), [txn5])
+        self.assertEqual(self.blockchain.search_transaction_from_sender(sender, max_height=2), [self.txn2])
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_height_queries(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        block1 = self.mine_block(self.blockchain._first_block_hash, 1, [self.txn1, self.txn2])
+        self.assertTrue(self.blockchain.add_block(block1, False))
+        block2 = self.mine_block(block1.get_computed_hash(), 2, [self.txn3, self.txn4])
+        self.assertTrue(self.blockchain.add_block(block2, False))
+        side_block = self.mine_block(block1.get_computed_hash(), 2, [], creator_id=42)
+        self.assertTrue(self.blockchain.add_block(side_block, False))
+
+        self.assertEqual(self.blockchain.get_block_by_height(2), block2)
+        self.assertIsNone(self.blockchain.get_block_by_height(3))
+        self.assertEqual(self.blockchain.get_block_by_id(2), [block2, side_block])
+        self.assertEqual(self.blockchain.get_block_range(), [block2, block1])
+        self.assertEqual(self.blockchain.get_block_range(block1.get_computed_hash(),
+                                                         block1.get_computed_hash()), [block1])
+        self.assertEqual(self.blockchain.get_block_range(range_end=side_block.get_computed_hash()),
+                         [side_block, block1])
+        self.assertEqual(self.blockchain.get_n_last_transactions(3), [self.txn3, self.txn4, self.txn1])
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
     """
     def test_add_block1(self):
         # now block8 has a branch with block 6
@@ -407,6 +670,59 @@ class BlockChainComponent(unittest.TestCase):
         self.assertIsNotNone(min_blocks)
         self.assertIsNotNone(diff)
 
+    def test_calculate_diff_window(self):
+        previous_granular_factor = self.consensus.granular_factor
+        self.consensus.granular_factor = 0.25
+        self.blockchain._min_blocks = 3
+        blocks = []
+        predecessor_hash = self.blockchain._first_block_hash
+        for i in range(1, 6):
+            block = self.mine_block(predecessor_hash, i, [])
+            self.assertTrue(self.blockchain.add_block(block, False))
+            blocks.append(block)
+            predecessor_hash = block.get_computed_hash()
+
+        self.assertEqual(self.blockchain.calculate_diff(blocks[0].get_computed_hash()),
+                         (blocks[0].timestamp, blocks[0].timestamp, 1, 3, blocks[0].difficulty))
+        self.assertEqual(self.blockchain.calculate_diff(blocks[1].get_computed_hash()),
+                         (blocks[1].timestamp, blocks[0].timestamp, 2, 3,
+                          (blocks[0].difficulty + blocks[1].difficulty) / 2))
+        self.assertEqual(self.blockchain.calculate_diff(),
+                         (blocks[4].timestamp, blocks[2].timestamp, 3, 3,
+                          (blocks[2].difficulty + blocks[3].difficulty + blocks[4].difficulty) / 3))
+        self.assertEqual(self.blockchain.calculate_diff('unknown'), (-1, -1, -1, -1, -1))
+
+        # Restore granular_factor
+        self.consensus.granular_factor = previous_granular_factor
+
+    def test_calculate_diff_window_missing_ancestor(self):
+        self.blockchain._min_blocks = 4
+        blocks = []
+        predecessor_hash = self.blockchain._first_block_hash
+        for i in range(1, 6):
+            # The blocks are put into the chain without being linked
+            block = LogicalBlock(block_id=i, predecessor_hash=predecessor_hash, block_creator_id=50,
+                                 transactions=[], timestamp=100 + i, difficulty=i, consensus_obj=self.consensus)
+            self.blockchain._blockchain[block.get_computed_hash()] = block
+            blocks.append(block)
+            predecessor_hash = block.get_computed_hash()
+        self.assertEqual(self.blockchain.calculate_diff(blocks[3].get_computed_hash()), (104, 101, 4, 4, 2.5))
+
+        # The window of the last block ends at the block after the missing one
+        del self.blockchain._blockchain[blocks[1].get_computed_hash()]
+        self.assertEqual(self.blockchain.calculate_diff(blocks[4].get_computed_hash()), (105, 103, 3, 4, 4.0))
+
+    def test_computed_hash_cache(self):
+        block = self.blockchain.create_block([self.txn1])
+        first_hash = block.get_computed_hash()
+        saved_hashes = LogicalBlock.saved_header_hashes
+        self.assertEqual(block.get_computed_hash(), first_hash)
+        self.assertEqual(LogicalBlock.saved_header_hashes, saved_hashes + 1)
+
+        block.nonce = block.nonce + 1
+        self.assertNotEqual(block.get_computed_hash(), first_hash)
+        self.assertEqual(block.get_computed_hash(), self.crypto_helper_obj.hash(block.to_json_headers()))
+
     def test_create_block(self):
         # creating new block based on given transaction list
         new_block = self.blockchain.create_block([self.txn2, self.txn4])
@@ -446,6 +762,21 @@ class BlockChainComponent(unittest.TestCase):
                                      db=None,
                                      q=None)
 
+    def mine_block(self, predecessor_hash, block_id, transactions, creator_id=23):
+        """Creates a block on top of predecessor_hash and mines a valid nonce for it"""
+        block = LogicalBlock(block_id=block_id, merkle_tree_root=None,
+                             predecessor_hash=predecessor_hash,
+                             block_creator_id=creator_id, transactions=transactions,
+                             nonce=0, consensus_obj=self.consensus)
+        _latest_ts, _earliest_ts, _num_of_blocks, _min_blocks, _latest_difficulty = \
+            self.blockchain.calculate_diff(predecessor_hash)
+        self.consensus.mine(block=block, latest_timestamp=_latest_ts,
+                            earliest_timestamp=_earliest_ts,
+                            num_of_blocks=_num_of_blocks,
+                            min_blocks=_min_blocks,
+                            prev_difficulty=_latest_difficulty)
+        return block
+
     def create_transactions(self):
         pr_key1, pub_key1 = self.crypto_helper_obj.generate_key_pair()
         pr_key2, pub_key2 = self.crypto_helper_obj.generate_key_pair()
@@ -459,6 +790,7 @@ class BlockChainComponent(unittest.TestCase):
 
         self.txn1.sign_transaction(self.crypto_helper_obj, pr_key1)
         self.txn2.sign_transaction(self.crypto_helper_obj, pr_key2)
+        self.pr_key2 = pr_key2
         self.txn3.sign_transaction(self.crypto_helper_obj, pr_key3)
         self.txn4.sign_transaction(self.crypto_helper_obj, pr_key4)
 
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from unittest.mock import patch, MagicMock, call
+from unittest.mock import patch, MagicMock
 
 from labchain.blockchainNodeBootstrap import Bootstrapper, BlockchainInitFailed
 
@@ -34,8 +34,8 @@ class BootstrapperTestCase(TestCase):
         # when
         self.bootstrapper.do_bootstrap(self.blockchain)
         # then
-        self.assertEqual(2, self.blockchain.add_block.call_count)
-        self.blockchain.add_block.assert_has_calls([call(self.block2), call(self.block1)], any_order=False)
+        self.assertEqual(1, self.blockchain.add_blocks.call_count)
+        self.blockchain.add_blocks.assert_called_once_with([self.block2, self.block1])
 
     def test_bootstrap_with_no_blocks(self):
         # given
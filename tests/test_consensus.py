@@ -1,5 +1,9 @@
 from labchain.datastructure.block import Block
-from labchain.consensus.consensus import Consensus
+from labchain.consensus.consensus import Consensus, get_header_parts, search_nonce
+from labchain.consensus.proofOfAuthority import ProofOfAuthority
+from labchain.util.cryptoHelper import CryptoHelper
+import threading
+import time
 from datetime import datetime
 from unittest import TestCase
 
@@ -43,3 +47,133 @@ class Tests(TestCase):
         block.nonce = nonce_false
         self.assertFalse(
             consensus.validate(block, datetime(2007, 12, 6, 15, 29, 52), datetime(2007, 12, 6, 15, 29, 43), 1, 1, 2))
+
+    def test_search_nonce_matches_validate(self):
+        consensus = Consensus()
+        block = Block(7, 'tree', 'pre', 'creator', [], 0, datetime.now(), 2)
+        for granular in [True, False]:
+            consensus.granular = granular
+            for difficulty in range(-1, 4):
+                zeros_array = "0" * difficulty
+                target = consensus.get_target(difficulty)
+                prefix, suffix = get_header_parts(block)
+                for nonce in range(300):
+                    block.nonce = nonce
+                    block_hash = consensus.crypto_helper.hash(consensus.get_header_json(block))
+                    self.assertEqual(search_nonce(prefix, suffix, target, nonce, 1) == nonce,
+                                     consensus.equalZeros(block_hash, zeros_array, difficulty))
+
+    def test_mine_reports_hash_rate(self):
+        consensus = Consensus()
+        block = Block(1, None, None, None, [], 0, datetime.now())
+        self.assertTrue(
+            consensus.mine(block, datetime(2007, 12, 6, 15, 29, 52), datetime(2007, 12, 6, 15, 29, 43), 1, 2))
+        self.assertTrue(consensus.validate(block, datetime(2007, 12, 6, 15, 29, 52),
+                                           datetime(2007, 12, 6, 15, 29, 43), 1, 2))
+        self.assertGreater(consensus.hash_rate, 0)
+
+    def test_mine_with_worker_processes(self):
+        consensus = Consensus()
+        consensus.set_mining_workers(2)
+        try:
+            block = Block(1, None, None, None, [], 0, datetime.now())
+            self.assertTrue(
+                consensus.mine(block, datetime(2007, 12, 6, 15, 29, 52), datetime(2007, 12, 6, 15, 29, 43), 1, 2))
+            self.assertTrue(consensus.validate(block, datetime(2007, 12, 6, 15, 29, 52),
+                                               datetime(2007, 12, 6, 15, 29, 43), 1, 2))
+            consensus.kill_mine = 1
+            self.assertFalse(
+                consensus.mine(block, datetime(2007, 12, 6, 15, 29, 52), datetime(2007, 12, 6, 15, 29, 43), 1, 2))
+            self.assertEqual(consensus.kill_mine, 0)
+        finally:
+            consensus.close()
+
+    def test_kill_aborts_worker_processes(self):
+        consensus = Consensus()
+        consensus.set_mining_workers(2)
+        try:
+            block = Block(1, None, None, None, [], 0, datetime.now())
+            threading.Timer(0.5, setattr, (consensus, 'kill_mine', 1)).start()
+            start_time = time.time()
+            # The difficulty cannot be reached in the time of the test
+            self.assertFalse(consensus.mine(block, 10.0, 0.0, 5, 2, 60))
+            self.assertLess(time.time() - start_time, 10)
+        finally:
+            consensus.close()
+
+    def test_proof_of_authority_round_robin(self):
+        crypto_helper = CryptoHelper.instance()
+        keys = [crypto_helper.generate_key_pair() for _ in range(2)]
+        authorities = [public_key for _, public_key in keys]
+        signers = [ProofOfAuthority(authorities, private_key, block_period=10) for private_key, _ in keys]
+        predecessor = Block(1, None, None, None, [], 0, time.time() - 10)
+        block = Block(2, None, 'pre', 'creator', [], 0, time.time())
+
+        self.assertIsNone(ProofOfAuthority(authorities).get_mining_delay(2, predecessor.timestamp))
+        self.assertEqual(signers[0].get_mining_delay(2, predecessor.timestamp), 0)
+        self.assertGreater(signers[1].get_mining_delay(2, predecessor.timestamp), 0)
+        self.assertFalse(signers[1].mine(block, None, None, 1, 2, predecessor=predecessor))
+        self.assertTrue(signers[0].mine(block, None, None, 1, 2, predecessor=predecessor))
+        # The signature is part of the header hash
+        self.assertIn(block.signature, block.to_json_headers())
+        signed = Block.from_dict(block.to_dict())
+        self.assertEqual(signed.signature, block.signature)
+        for engine in signers + [ProofOfAuthority(authorities)]:
+            self.assertTrue(engine.validate(signed, None, None, 1, 2, predecessor=predecessor))
+
+        signed.nonce = 1
+        self.assertFalse(signers[0].validate(signed, None, None, 1, 2, predecessor=predecessor))
+        self.assertFalse(signers[0].validate(block, None, None, 1, 2))
+
+    def test_proof_of_authority_out_of_turn(self):
+        crypto_helper = CryptoHelper.instance()
+        keys = [crypto_helper.generate_key_pair() for _ in range(2)]
+        authorities = [public_key for _, public_key in keys]
+        signers = [ProofOfAuthority(authorities, private_key, out_of_turn_delay=30, block_period=0)
+                   for private_key, _ in keys]
+        predecessor = Block(1, None, None, None, [], 0, time.time())
+        block = Block(2, None, 'pre', 'creator', [], 0, time.time())
+        block.signature = crypto_helper.sign(keys[1][0], signers[1].get_signing_payload(block))
+        self.assertFalse(signers[0].validate(block, None, None, 1, 2, predecessor=predecessor))
+
+        # The next authority may sign once the authority in turn had its time
+        late_predecessor = Block(1, None, None, None, [], 0, time.time() - 31)
+        self.assertEqual(signers[1].get_mining_delay(2, late_predecessor.timestamp), 0)
+        self.assertTrue(signers[1].mine(block, None, None, 1, 2, predecessor=late_predecessor))
+        self.assertTrue(signers[0].validate(block, None, None, 1, 2, predecessor=late_predecessor))
+
+        # Blocks timestamped ahead of the clock are rejected
+        block = Block(2, None, 'pre', 'creator', [], 0, time.time() + 3600)
+        block.signature = crypto_helper.sign(keys[1][0], signers[1].get_signing_payload(block))
+        self.assertFalse(signers[0].validate(block, None, None, 1, 2, predecessor=predecessor))
+
+    def test_proof_of_authority_block_period(self):
+        crypto_helper = CryptoHelper.instance()
+        keys = [crypto_helper.generate_key_pair() for _ in range(2)]
+        authorities = [public_key for _, public_key in keys]
+        signers = [ProofOfAuthority(authorities, private_key, out_of_turn_delay=30, block_period=10)
+                   for private_key, _ in keys]
+
+        # The authority in turn waits for the block period after the predecessor
+        predecessor = Block(1, None, None, None, [], 0, time.time())
+        self.assertGreater(signers[0].get_mining_delay(2, predecessor.timestamp), 9)
+        block = Block(2, None, 'pre', 'creator', [], 0, time.time())
+        self.assertFalse(signers[0].mine(block, None, None, 1, 2, predecessor=predecessor))
+        block.signature = crypto_helper.sign(keys[0][0], signers[0].get_signing_payload(block))
+        self.assertFalse(signers[1].validate(block, None, None, 1, 2, predecessor=predecessor))
+
+        # The out of turn delay starts after the block period
+        predecessor = Block(1, None, None, None, [], 0, time.time() - 35)
+        self.assertEqual(signers[0].get_mining_delay(2, predecessor.timestamp), 0)
+        self.assertGreater(signers[1].get_mining_delay(2, predecessor.timestamp), 0)
+
+        # Only the authority in turn signs the block after the genesis block
+        genesis = Block(0, None, None, None, [], 0, 0)
+        self.assertEqual(signers[1].get_mining_delay(1, genesis.timestamp), 0)
+        self.assertIsNone(signers[0].get_mining_delay(1, genesis.timestamp))
+        block = Block(1, None, 'pre', 'creator', [], 0, time.time())
+        self.assertFalse(signers[0].mine(block, None, None, 1, 2, predecessor=genesis))
+        block.signature = crypto_helper.sign(keys[0][0], signers[0].get_signing_payload(block))
+        self.assertFalse(signers[1].validate(block, None, None, 1, 2, predecessor=genesis))
+        self.assertTrue(signers[1].mine(block, None, None, 1, 2, predecessor=genesis))
+        self.assertTrue(signers[0].validate(block, None, None, 1, 2, predecessor=genesis))
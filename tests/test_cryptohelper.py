@@ -4,7 +4,7 @@ from unittest import TestCase
 
 from Crypto.PublicKey import ECC
 
-from labchain.util.cryptoHelper import CryptoHelper
+from labchain.util.cryptoHelper import CryptoHelper, MIN_PARALLEL_SIGNATURES
 
 
 class Tests(TestCase):
@@ -105,3 +105,25 @@ class Tests(TestCase):
         key = ECC.import_key(private_key)
         public_key_true = key.public_key().export_key(format='PEM')
         self.assertEqual(public_key_true, public_key)
+
+    def test_validate_many(self):
+        helper = CryptoHelper.instance()
+        keys = [helper.generate_key_pair() for _ in range(3)]
+        items = []
+        for i in range(MIN_PARALLEL_SIGNATURES):
+            private_key, public_key = keys[i % len(keys)]
+            message = json.dumps({'message': i})
+            items.append((public_key, message, helper.sign(private_key, message)))
+        # Wrong message, wrong key and undecodable signature
+        items[1] = (items[1][0], json.dumps({'message': 'Bye World'}), items[1][2])
+        items[2] = (keys[0][1], items[2][1], items[2][2])
+        items[3] = (items[3][0], items[3][1], None)
+        expected = [i not in (1, 2, 3) for i in range(len(items))]
+
+        self.assertEqual(helper.validate_many(items), expected)
+        try:
+            helper.set_verification_workers(2)
+            self.assertEqual(helper.validate_many(items), expected)
+            self.assertEqual(helper.validate_many(items[:2]), expected[:2])
+        finally:
+            helper.set_verification_workers(1)
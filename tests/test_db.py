@@ -1,6 +1,16 @@
 import unittest
+import json
 import os
+import shutil
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from queue import Queue
+from unittest.mock import patch
 
+from labchain.blockchainNode import BlockChainNode
 from labchain.datastructure.blockchain import BlockChain
 from labchain.consensus.consensus import Consensus
 from labchain.util.cryptoHelper import CryptoHelper
@@ -8,19 +18,29 @@ from labchain.datastructure.transaction import Transaction
 from labchain.workflow.taskTransaction import WorkflowTransaction
 from labchain.datastructure.txpool import TxPool
 from labchain.util.configReader import ConfigReader
-from labchain.databaseInterface import Db
+from labchain.databaseInterface import Db, BlockPersister
 
 test_resources_dic_path = os.path.abspath(os.path.join(os.path.dirname(__file__), './resources'))
 test_db_file = test_resources_dic_path + '/labchaindb.sqlite'
 test_node_config_file = test_resources_dic_path + '/node_configuration.ini'
 
 
+def remove_database(db_file):
+    # WAL mode keeps the write ahead log and the shared memory index next to the database
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+
 class DbTestCase(unittest.TestCase):
 
     def setUp(self):
         self.database = Db(test_db_file)
         self.init_components()
 
+    def tearDown(self):
+        self.database.close()
+
     def init_components(self):
         config_reader = ConfigReader(test_node_config_file)
 
@@ -51,6 +71,28 @@ class DbTestCase(unittest.TestCase):
         self.database.open_connection(test_db_file)
         self.assertTrue(self.database.create_tables())
 
+    def test_wal_mode(self):
+        self.assertEqual(self.database.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_reader_connections_closed(self):
+        readers = []
+
+        def read():
+            self.database.get_block_transactions('unknown')
+            readers.append(self.database._reader_connection())
+
+        for _ in range(2):
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        # The connection of the first thread was closed when the second one opened its connection
+        self.assertRaises(sqlite3.ProgrammingError, readers[0].execute, 'SELECT 1')
+        self.assertEqual(list(self.database._reader_connections.values()), readers[1:])
+
+        self.database.close()
+        self.assertRaises(sqlite3.ProgrammingError, readers[1].execute, 'SELECT 1')
+        self.assertEqual(self.database._reader_connections, {})
+
     def test_save_block(self):
         block = self.get_block()
         self.assertTrue(self.database.save_block(block))
@@ -61,6 +103,347 @@ class DbTestCase(unittest.TestCase):
         self.assertTrue(self.database.save_block(workflow_block))
         self.assertIsInstance(self.database.get_blockchain_from_db()[1].transactions[0], WorkflowTransaction)
 
+    def test_transactions_loaded_on_access(self):
+        cache_db_file = test_resources_dic_path + '/labchaindb_cache.sqlite'
+        database = Db(cache_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = BlockChain(node_id="nodeId1", tolerance_value=2, pruning_interval=0,
+                                    consensus_obj=self.consensus, txpool_obj=self.txpool,
+                                    crypto_helper_obj=self.crypto_helper_obj,
+                                    min_blocks_for_difficulty=15, db=database, q=None,
+                                    max_resident_transactions=1)
+            pr_key1, pub_key1 = self.crypto_helper_obj.generate_key_pair()
+            pr_key2, pub_key2 = self.crypto_helper_obj.generate_key_pair()
+            blocks = []
+            transactions = []
+            for payload in ['Payload1', 'Payload2']:
+                txn = Transaction(pub_key1, pub_key2, payload)
+                txn.sign_transaction(self.crypto_helper_obj, pr_key1)
+                txn.transaction_hash = self.crypto_helper_obj.hash(txn.get_json())
+                block = blockchain.create_block([txn])
+                blockchain._add_block_to_blockchain(block, True)
+                blocks.append(block)
+                transactions.append(txn)
+
+            self.assertFalse(blocks[0].is_body_resident())
+            self.assertTrue(blocks[1].is_body_resident())
+            self.assertEqual(blockchain.get_transaction(transactions[0].transaction_hash),
+                             (transactions[0], blocks[0].get_computed_hash()))
+            self.assertTrue(blocks[0].is_body_resident())
+            self.assertFalse(blocks[1].is_body_resident())
+            self.assertEqual(blocks[1].transactions, [transactions[1]])
+        finally:
+            database.close()
+            remove_database(cache_db_file)
+
+    def test_transactions_evicted_while_read(self):
+        cache_db_file = test_resources_dic_path + '/labchaindb_evict.sqlite'
+        database = Db(cache_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = BlockChain(node_id="nodeId1", tolerance_value=2, pruning_interval=0,
+                                    consensus_obj=self.consensus, txpool_obj=self.txpool,
+                                    crypto_helper_obj=self.crypto_helper_obj,
+                                    min_blocks_for_difficulty=15, db=database, q=None,
+                                    max_resident_transactions=1)
+            pr_key1, pub_key1 = self.crypto_helper_obj.generate_key_pair()
+            pr_key2, pub_key2 = self.crypto_helper_obj.generate_key_pair()
+            txn = Transaction(pub_key1, pub_key2, 'Payload1')
+            txn.sign_transaction(self.crypto_helper_obj, pr_key1)
+            txn.transaction_hash = self.crypto_helper_obj.hash(txn.get_json())
+            transactions = [txn]
+            block = blockchain.create_block(transactions)
+            blockchain._add_block_to_blockchain(block, True)
+
+            def load_and_evict(evicted_block):
+                # Another reader evicts the transactions right after they were restored
+                loaded = blockchain._load_block_body(evicted_block)
+                evicted_block.evict_transactions(load_and_evict)
+                return loaded
+
+            block.evict_transactions(load_and_evict)
+            self.assertEqual(block.transactions, transactions)
+            self.assertFalse(block.is_body_resident())
+        finally:
+            database.close()
+            remove_database(cache_db_file)
+
+    def test_block_persister(self):
+        persister_db_file = test_resources_dic_path + '/labchaindb_persister.sqlite'
+        database = Db(persister_db_file, create_new_database=True, synchronous='NORMAL')
+        database.create_tables()
+        persister = BlockPersister(database, max_queue_size=2, max_batch_size=2)
+        try:
+            saved = []
+            blocks = [self.get_block() for _ in range(3)]
+            for block in blocks:
+                persister.put(block, saved.append)
+            persister.flush()
+            self.assertEqual(saved, blocks)
+            statistics = persister.get_statistics()
+            self.assertEqual(statistics['queue_depth'], 0)
+            self.assertEqual(statistics['saved_blocks'], 3)
+            self.assertEqual(statistics['failed_blocks'], 0)
+            self.assertGreaterEqual(statistics['max_lag'], statistics['last_lag'])
+
+            # The same block cannot be stored twice
+            persister.put(blocks[0])
+            persister.stop()
+            self.assertEqual(persister.get_statistics()['failed_blocks'], 1)
+            self.assertEqual(len(database.get_blockchain_from_db()), 3)
+        finally:
+            persister.stop()
+            database.close()
+            remove_database(persister_db_file)
+
+    def test_node_stop_writes_queued_blocks(self):
+        stop_db_file = test_resources_dic_path + '/labchaindb_stop.sqlite'
+        database = Db(stop_db_file, create_new_database=True)
+        database.create_tables()
+        node = BlockChainNode.__new__(BlockChainNode)
+        node.logger = logging.getLogger(__name__)
+        node.consensus_obj = self.consensus
+        node.crypto_helper_obj = self.crypto_helper_obj
+        node.mine_wakeup = threading.Event()
+        node.mine_shutdown = threading.Event()
+        node._mining_lock = threading.Lock()
+        node.mine_thread = None
+        node.blockchain_obj = self.blockchain
+        node.db = database
+        node.persister = BlockPersister(database)
+        try:
+            save_blocks = database.save_blocks
+
+            def slow_save_blocks(blocks):
+                time.sleep(0.2)
+                return save_blocks(blocks)
+
+            blocks = [self.get_block() for _ in range(3)]
+            with patch.object(database, 'save_blocks', side_effect=slow_save_blocks), \
+                    patch.object(self.consensus, 'close') as close_consensus, \
+                    patch.object(self.crypto_helper_obj, 'close') as close_crypto_helper:
+                for block in blocks:
+                    node.persister.put(block)
+                self.assertEqual(node.get_statistics()['persister']['saved_blocks'], 0)
+                node.stop()
+            self.assertTrue(node.mine_shutdown.is_set())
+            close_consensus.assert_called_once_with()
+            close_crypto_helper.assert_called_once_with()
+            self.assertEqual(node.persister.get_statistics()['saved_blocks'], 3)
+            database.open_connection(stop_db_file)
+            self.assertEqual(database.get_blockchain_from_db(), blocks)
+        finally:
+            self.consensus.kill_mine = 0
+            node.persister.stop()
+            database.close()
+            remove_database(stop_db_file)
+
+    def test_iterate_blockchain_from_db(self):
+        stream_db_file = test_resources_dic_path + '/labchaindb_stream.sqlite'
+        database = Db(stream_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            empty_block = self.blockchain.create_block([])
+            blocks = [self.get_block(), empty_block, self.get_block()]
+            self.assertTrue(database.save_blocks(blocks))
+            self.assertEqual(list(database.iterate_blockchain_from_db()), blocks)
+            self.assertEqual(database.conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = 'transactions' "
+                "AND sql LIKE '%block_hash%'").fetchone()[0], 1)
+        finally:
+            database.close()
+            remove_database(stream_db_file)
+
+    def test_schema_migration(self):
+        migration_db_file = test_resources_dic_path + '/labchaindb_migration.sqlite'
+        remove_database(migration_db_file)
+        conn = sqlite3.connect(migration_db_file)
+        conn.execute("CREATE TABLE blockchain (hash text PRIMARY KEY, block_id integer NOT NULL, "
+                     "merkle_tree_root text, predecessor_hash text NOT NULL, block_creator_id text NOT NULL, "
+                     "nonce integer NOT NULL, ts timestamp NOT NULL, difficulty integer NOT NULL)")
+        conn.execute("CREATE TABLE transactions (sender text NOT NULL, receiver text NOT NULL, "
+                     "payload text NOT NULL, signature text NOT NULL, transaction_hash text PRIMARY KEY, "
+                     "block_hash text NOT NULL, FOREIGN KEY (block_hash) REFERENCES blockchain (hash))")
+        # Block b1 has two children, b2 was saved first
+        for block_hash, predecessor_hash in [('b1', 'genesis'), ('b2', 'b1'), ('c2', 'b1')]:
+            conn.execute("INSERT INTO blockchain VALUES (?, 1, 'root', ?, 'node', 0, '1.5', 1)",
+                         (block_hash, predecessor_hash))
+        conn.execute("INSERT INTO transactions VALUES ('s', 'r', 'Payload', 'sig', 't1', 'c2')")
+        conn.commit()
+        conn.close()
+
+        database = Db(migration_db_file)
+        try:
+            self.assertTrue(database.create_tables())
+            self.assertEqual(database.conn.execute('PRAGMA user_version').fetchone()[0], Db.SCHEMA_VERSION)
+            self.assertEqual(database.conn.execute(
+                "SELECT hash, height, is_main_chain, typeof(ts) FROM blockchain ORDER BY rowid").fetchall(),
+                [('b1', 1, 1, 'real'), ('b2', 2, 1, 'real'), ('c2', 2, 0, 'real')])
+            self.assertEqual(database.get_main_chain_block_hash(2), 'b2')
+            self.assertEqual(database.get_main_chain_transactions(sender='s'), [])
+
+            self.assertTrue(database.update_main_chain(1, ['c2']))
+            self.assertEqual(database.get_main_chain_block_hash(1), 'b1')
+            self.assertEqual(database.get_main_chain_block_hash(2), 'c2')
+            transactions = database.get_main_chain_transactions(sender='s', receiver='r')
+            self.assertEqual([(txn.transaction_hash, block_hash) for txn, block_hash in transactions],
+                             [('t1', 'c2')])
+            indexes = [row[0] for row in database.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+            self.assertEqual(sorted(indexes), ['blockchain_block_id', 'blockchain_height', 'transactions_block_hash',
+                                               'transactions_receiver', 'transactions_sender'])
+        finally:
+            database.close()
+            remove_database(migration_db_file)
+
+    def test_main_chain_flags(self):
+        main_chain_db_file = test_resources_dic_path + '/labchaindb_main_chain.sqlite'
+        database = Db(main_chain_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = BlockChain(node_id="nodeId1", tolerance_value=2, pruning_interval=0,
+                                    consensus_obj=self.consensus, txpool_obj=self.txpool,
+                                    crypto_helper_obj=self.crypto_helper_obj,
+                                    min_blocks_for_difficulty=15, db=database, q=None)
+            block1 = blockchain.create_block([])
+            blockchain._add_block_to_blockchain(block1, True)
+            block2 = blockchain.create_block([])
+            blockchain._add_block_to_blockchain(block2, True)
+            blockchain.switch_to_longest_branch()
+            self.assertEqual(database.get_main_chain_block_hash(1), block1.get_computed_hash())
+            self.assertEqual(database.get_main_chain_block_hash(2), block2.get_computed_hash())
+        finally:
+            database.close()
+            remove_database(main_chain_db_file)
+
+    def test_add_stored_blocks(self):
+        stored_db_file = test_resources_dic_path + '/labchaindb_stored.sqlite'
+        database = Db(stored_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = BlockChain(node_id="nodeId1", tolerance_value=2, pruning_interval=0,
+                                    consensus_obj=self.consensus, txpool_obj=self.txpool,
+                                    crypto_helper_obj=self.crypto_helper_obj,
+                                    min_blocks_for_difficulty=15, db=database, q=None)
+            blocks = []
+            for _ in range(3):
+                block = self.get_block_for(blockchain)
+                blockchain._add_block_to_blockchain(block, True)
+                blocks.append(block)
+            hashes = [block.get_computed_hash() for block in blocks]
+
+            # The blocks are not mined, so only the trusted load accepts them
+            restarted = self.new_blockchain(database)
+            self.assertEqual(restarted.add_stored_blocks(database.iterate_blockchain_from_db(with_hashes=True),
+                                                         verify_merkle_root=True), 3)
+            self.assertEqual(restarted._main_chain[1:], hashes)
+            self.assertEqual(restarted.get_transaction(blocks[2].transactions[0].transaction_hash)[1], hashes[2])
+
+            # A tampered block and the blocks after it are validated in full
+            # The merkle root fails full validation for sure, a nonce may satisfy the low test difficulty
+            database.conn.execute("UPDATE blockchain SET merkle_tree_root = 'tampered' WHERE hash = ?", (hashes[1],))
+            database.conn.commit()
+            restarted = self.new_blockchain(database)
+            restarted.add_stored_blocks(database.iterate_blockchain_from_db(with_hashes=True), chunk_size=2)
+            self.assertEqual(restarted._main_chain[1:], hashes[:1])
+            self.assertNotIn(hashes[2], restarted._blockchain)
+        finally:
+            database.close()
+            remove_database(stored_db_file)
+
+    def test_snapshot(self):
+        snapshot_db_file = test_resources_dic_path + '/labchaindb_snapshot.sqlite'
+        snapshot_dir = tempfile.mkdtemp()
+        database = Db(snapshot_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = self.new_blockchain(database)
+            self.assertIsNone(blockchain.write_snapshot(snapshot_dir))
+            blocks = []
+            for _ in range(3):
+                block = self.get_block_for(blockchain)
+                blockchain._add_block_to_blockchain(block, True)
+                blockchain.switch_to_longest_branch()
+                blocks.append(block)
+                newest_snapshot = blockchain.write_snapshot(snapshot_dir)
+            hashes = [block.get_computed_hash() for block in blocks]
+            self.assertEqual(len(os.listdir(snapshot_dir)), 2)
+
+            restarted = self.new_blockchain(database)
+            mark = restarted.load_snapshot(snapshot_dir)
+            self.assertEqual(mark, database.get_save_mark())
+            self.assertEqual(restarted._main_chain[1:], hashes)
+            self.assertEqual(restarted.get_transaction(blocks[1].transactions[0].transaction_hash)[1], hashes[1])
+            self.assertEqual(list(database.iterate_blockchain_from_db(after_mark=mark)), [])
+            for index in ['_transaction_index', '_sender_index', '_receiver_index', '_block_id_index',
+                          '_workflow_index', '_lineage_index', '_next_in_charge_index', '_type_index']:
+                self.assertEqual(getattr(restarted, index), getattr(blockchain, index))
+            self.assertEqual(restarted.calculate_diff(), blockchain.calculate_diff())
+            # The snapshot only holds data, the transactions are read from the DB
+            with open(newest_snapshot, 'rb') as snapshot_file:
+                snapshot_file.readline()
+                self.assertEqual(json.loads(snapshot_file.read().decode())['mark'], list(mark))
+            self.assertFalse(restarted._blockchain[hashes[2]].is_body_resident())
+            self.assertEqual(restarted._blockchain[hashes[2]].transactions, blocks[2].transactions)
+
+            # A damaged snapshot is skipped, the blocks after the older one are read from the DB
+            with open(newest_snapshot, 'ab') as snapshot_file:
+                snapshot_file.write(b'damaged')
+            restarted = self.new_blockchain(database)
+            mark = restarted.load_snapshot(snapshot_dir)
+            self.assertEqual(restarted._main_chain[1:], hashes[:2])
+            self.assertEqual(restarted.add_stored_blocks(
+                database.iterate_blockchain_from_db(with_hashes=True, after_mark=mark)), 1)
+            self.assertEqual(restarted._main_chain[1:], hashes)
+        finally:
+            database.close()
+            remove_database(snapshot_db_file)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    def test_snapshot_skips_unstored_blocks(self):
+        snapshot_db_file = test_resources_dic_path + '/labchaindb_snapshot_unstored.sqlite'
+        snapshot_dir = tempfile.mkdtemp()
+        database = Db(snapshot_db_file, create_new_database=True)
+        database.create_tables()
+        try:
+            blockchain = self.new_blockchain(database)
+            block = self.get_block_for(blockchain)
+            # A sibling holding the same transaction can not be saved as the transaction hash is unique
+            sibling = blockchain.create_block(block.transactions)
+            sibling.nonce = 1
+            blockchain._add_block_to_blockchain(block, True)
+            blockchain.switch_to_longest_branch()
+            blockchain._add_block_to_blockchain(sibling, True)
+            self.assertFalse(sibling.is_stored())
+            self.assertIsNone(database.get_block_transactions(sibling.get_computed_hash()))
+            self.assertIsNotNone(blockchain.write_snapshot(snapshot_dir))
+
+            restarted = self.new_blockchain(database)
+            restarted.load_snapshot(snapshot_dir)
+            self.assertNotIn(sibling.get_computed_hash(), restarted._blockchain)
+            self.assertEqual(restarted._current_branch_heads, [block.get_computed_hash()])
+            transaction = block.transactions[0]
+            self.assertEqual(restarted.search_transaction_from_sender(transaction.sender), [transaction])
+        finally:
+            database.close()
+            remove_database(snapshot_db_file)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    def new_blockchain(self, database):
+        return BlockChain(node_id="nodeId1", tolerance_value=2, pruning_interval=0,
+                          consensus_obj=self.consensus, txpool_obj=self.txpool,
+                          crypto_helper_obj=self.crypto_helper_obj,
+                          min_blocks_for_difficulty=15, db=database, q=Queue())
+
+    def get_block_for(self, blockchain):
+        pr_key1, pub_key1 = self.crypto_helper_obj.generate_key_pair()
+        pr_key2, pub_key2 = self.crypto_helper_obj.generate_key_pair()
+        txn = Transaction(pub_key1, pub_key2, "Payload1")
+        txn.sign_transaction(self.crypto_helper_obj, pr_key1)
+        txn.transaction_hash = self.crypto_helper_obj.hash(txn.get_json())
+        return blockchain.create_block([txn])
+
     def get_block(self):
         pr_key1, pub_key1 = self.crypto_helper_obj.generate_key_pair()
         pr_key2, pub_key2 = self.crypto_helper_obj.generate_key_pair()
@@ -87,8 +470,7 @@ class DbTestCase(unittest.TestCase):
     @classmethod
     def tearDownClass(self):
         # clean up test database
-        if os.path.exists(test_db_file):
-            os.remove(test_db_file)
+        remove_database(test_db_file)
 
 
 if __name__ == '__main__':
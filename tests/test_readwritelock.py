@@ -0,0 +1,63 @@
+import threading
+from unittest import TestCase
+
+from labchain.util.readWriteLock import ReadWriteLock
+
+
+class ReadWriteLockTestCase(TestCase):
+
+    def setUp(self):
+        self.lock = ReadWriteLock()
+
+    def _acquire_in_thread(self, acquire, timeout):
+        result = []
+        release = self.lock.release_read if acquire == self.lock.acquire_read else self.lock.release_write
+
+        def _run():
+            result.append(acquire(timeout))
+            # A later thread may get the same ident, it must not inherit the lock
+            if result[0]:
+                release()
+
+        thread = threading.Thread(target=_run)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_readers_share_lock(self):
+        self.assertTrue(self.lock.acquire_read())
+        self.assertTrue(self._acquire_in_thread(self.lock.acquire_read, 0.1))
+        self.assertFalse(self._acquire_in_thread(self.lock.acquire_write, 0.1))
+        self.lock.release_read()
+
+    def test_writer_is_exclusive(self):
+        self.assertTrue(self.lock.acquire_write())
+        self.assertFalse(self._acquire_in_thread(self.lock.acquire_read, 0.1))
+        self.assertFalse(self._acquire_in_thread(self.lock.acquire_write, 0.1))
+        self.lock.release_write()
+        self.assertTrue(self._acquire_in_thread(self.lock.acquire_write, 0.1))
+
+    def test_writer_reentrant(self):
+        self.assertTrue(self.lock.acquire_write())
+        self.assertTrue(self.lock.acquire_write())
+        self.assertTrue(self.lock.acquire_read())
+        self.lock.release_read()
+        self.lock.release_write()
+        self.assertFalse(self._acquire_in_thread(self.lock.acquire_read, 0.1))
+        self.lock.release_write()
+        self.assertTrue(self._acquire_in_thread(self.lock.acquire_read, 0.1))
+
+    def test_upgrade_not_supported(self):
+        self.lock.acquire_read()
+        with self.assertRaises(RuntimeError):
+            self.lock.acquire_write()
+        self.lock.release_read()
+
+    def test_wait_statistics(self):
+        self.assertEqual(self.lock.get_wait_statistics(), (0.0, 0))
+        self.lock.acquire_write()
+        self._acquire_in_thread(self.lock.acquire_read, 0.05)
+        self.lock.release_write()
+        wait_time, contended = self.lock.get_wait_statistics()
+        self.assertEqual(contended, 1)
+        self.assertGreater(wait_time, 0)
@@ -3,6 +3,7 @@ import json
 import os
 import sys
 import unittest
+from unittest.mock import patch
 
 from labchain.consensus.consensus import Consensus
 from labchain.datastructure.blockchain import BlockChain
@@ -68,6 +69,22 @@ class TransactionTestCase(unittest.TestCase):
         my_transaction.sign_transaction(crypto_helper, real_pr_key)
         self.assertFalse(my_transaction.signature == "")
 
+    def test_verify_signatures(self):
+        crypto_helper = CryptoHelper.instance()
+        private_key, public_key = crypto_helper.generate_key_pair()
+        transactions = [Transaction(sender=public_key, receiver='r', payload=str(i)) for i in range(3)]
+        for transaction in transactions:
+            transaction.sign_transaction(crypto_helper, private_key)
+        transactions[1] = Transaction(sender=public_key, receiver='r', payload='changed',
+                                      signature=transactions[1].signature)
+        self.assertEqual(Transaction.verify_signatures(transactions, crypto_helper), [True, False, True])
+
+        # Verified transactions are not passed to the crypto helper again
+        with patch.object(crypto_helper, 'validate_many', wraps=crypto_helper.validate_many) as validate_many:
+            self.assertEqual(Transaction.verify_signatures(transactions, crypto_helper), [True, False, True])
+            validate_many.assert_called_once()
+            self.assertEqual(len(validate_many.call_args[0][0]), 1)
+
     def test_eq_true(self):
         """Test transaction comparison"""
         my_transaction = Transaction(sender="s", receiver="r", payload="1", signature="sig")
@@ -116,6 +133,17 @@ class TransactionTestCase(unittest.TestCase):
         my_transaction.sign_transaction(crypto_helper, real_pr_key)
         self.assertFalse(my_transaction.validate_transaction(crypto_helper, None))
 
+    def test_verify_signature_cached(self):
+        """Test that a valid signature is only checked once"""
+        crypto_helper = CryptoHelper.instance()
+        pr_key, pu_key = crypto_helper.generate_key_pair()
+        my_transaction = Transaction(sender=pu_key, receiver="test", payload="1")
+        my_transaction.sign_transaction(crypto_helper, pr_key)
+        with patch.object(crypto_helper, 'validate', wraps=crypto_helper.validate) as validate:
+            self.assertTrue(my_transaction.verify_signature(crypto_helper))
+            self.assertTrue(my_transaction.validate_transaction(crypto_helper, None))
+            self.assertEqual(validate.call_count, 1)
+
     def test_set_signature(self):
         """Test for signature setting"""
         transaction = Transaction(sender="s", receiver="r", payload="1")
@@ -292,6 +320,39 @@ class TaskTransactionTestCase(TaskTransactionCommon):
 
         self.assertTrue(taskTransaction._check_permissions_write(workflowTransaction, workflowTransaction))
 
+    def test_duplicate_transactions(self):
+        pr_key1, pu_key1 = self.crypto_helper_obj.generate_key_pair()
+        pr_key2, pu_key2 = self.crypto_helper_obj.generate_key_pair()
+        task_transaction_json = self.getDummyTask(pu_key1, pu_key2, "{}_2".format(pu_key2))
+        task_transaction_json['payload']['previous_transaction'] = 'previous_hash'
+        task_transaction_json['payload']['next_in_charge'] = "{}_3".format(pu_key2)
+        transaction1 = TaskTransaction.from_json(json.dumps(task_transaction_json))
+        transaction2 = TaskTransaction.from_json(json.dumps(task_transaction_json))
+        self.assertTrue(transaction2._check_for_duplicate_transactions(self.blockchain_obj))
+        block = LogicalBlock(block_id=1, transactions=[transaction1])
+        self.blockchain_obj._blockchain[block.get_computed_hash()] = block
+        self.blockchain_obj._index_block(block)
+        self.assertFalse(transaction2._check_for_duplicate_transactions(self.blockchain_obj))
+        self.assertEqual([transaction1], self.blockchain_obj.get_task_transactions_by_next_in_charge(
+            "{}_3".format(pu_key2)))
+        task_transaction_json['payload']['previous_transaction'] = 'other_hash'
+        transaction3 = TaskTransaction.from_json(json.dumps(task_transaction_json))
+        self.assertTrue(transaction3._check_for_duplicate_transactions(self.blockchain_obj))
+        self.blockchain_obj._unindex_block(block)
+        self.assertTrue(transaction2._check_for_duplicate_transactions(self.blockchain_obj))
+
+        # A parallel transaction in the pool is a duplicate, the pool entry of the transaction itself is not
+        task_transaction_json['payload']['previous_transaction'] = 'previous_hash'
+        task_transaction_json['payload']['document'] = {'stringAttribute': '5678'}
+        transaction4 = TaskTransaction.from_json(json.dumps(task_transaction_json))
+        self._txPoolObj._transactions.append(transaction4)
+        self._txPoolObj._index_transaction(transaction4)
+        try:
+            self.assertFalse(transaction2._check_for_duplicate_transactions(self.blockchain_obj))
+            self.assertTrue(transaction4._check_for_duplicate_transactions(self.blockchain_obj))
+        finally:
+            self._txPoolObj.remove_transaction(transaction4)
+
     def test_process_definition(self):
         pr_key1, pu_key1 = self.crypto_helper_obj.generate_key_pair()
         pr_key2, pu_key2 = self.crypto_helper_obj.generate_key_pair()
@@ -471,9 +532,43 @@ class WorkflowTransactionTestCase(TaskTransactionCommon):
         transaction2.sign_transaction(self.crypto_helper_obj, pr_key1)
         result = transaction1.validate_transaction(CryptoHelper.instance(), self.blockchain_obj)
         self.assertTrue(result)
-        self.blockchain_obj._blockchain[123456] = LogicalBlock(transactions=[transaction1])
+        # The pool entry of the transaction itself is not a duplicate
+        self.assertTrue(self._txPoolObj.add_transaction_if_not_exist(transaction1, self.blockchain_obj))
+        self.assertTrue(transaction1.validate_transaction(CryptoHelper.instance(), self.blockchain_obj))
+        self.assertFalse(transaction2.validate_transaction(CryptoHelper.instance(), self.blockchain_obj))
+        self._txPoolObj.remove_transaction(transaction1)
+        block = LogicalBlock(transactions=[transaction1])
+        self.blockchain_obj._blockchain[block.get_computed_hash()] = block
+        self.blockchain_obj._index_block(block)
         result = transaction2.validate_transaction(CryptoHelper.instance(), self.blockchain_obj)
         self.assertFalse(result)
+        # An identical copy of a workflow transaction in a block is a duplicate as well
+        copy = WorkflowTransaction.from_json(transaction1.get_json_with_signature())
+        self.assertFalse(copy.validate_transaction(CryptoHelper.instance(), self.blockchain_obj))
+
+    def test_highest_workflow_ID(self):
+        pr_key1, pu_key1 = self.crypto_helper_obj.generate_key_pair()
+        pr_key2, pu_key2 = self.crypto_helper_obj.generate_key_pair()
+        self.assertEqual(0, self.blockchain_obj.get_highest_workflow_ID())
+        transactions = []
+        for workflow_id in ['3', '7']:
+            json_dict = WorkflowTransactionTestCase.getDummyWorkflowJson(pu_key1, pu_key2)
+            json_dict['payload']['workflow_id'] = workflow_id
+            transaction = WorkflowTransaction.from_json(json.dumps(json_dict))
+            transaction.sign_transaction(self.crypto_helper_obj, pr_key1)
+            transactions.append(transaction)
+        block = LogicalBlock(block_id=1, transactions=[transactions[0]])
+        self.blockchain_obj._blockchain[block.get_computed_hash()] = block
+        self.blockchain_obj._index_block(block)
+        self.assertEqual(3, self.blockchain_obj.get_highest_workflow_ID())
+        self.assertTrue(self._txPoolObj.add_transaction_if_not_exist(transactions[1], self.blockchain_obj))
+        self.assertEqual(7, self.blockchain_obj.get_highest_workflow_ID())
+        self.assertEqual([transactions[1]], self.blockchain_obj.get_workflow_transactions_by_id('7'))
+        self._txPoolObj.remove_transaction(transactions[1])
+        self.assertEqual(3, self.blockchain_obj.get_highest_workflow_ID())
+        self.blockchain_obj._unindex_block(block)
+        self.assertEqual(0, self.blockchain_obj.get_highest_workflow_ID())
+        self.assertEqual([], self.blockchain_obj.get_workflow_transactions_by_id('3'))
 
     def test_DummyWorkflow_valid(self):
         pr_key1, pu_key1 = self.crypto_helper_obj.generate_key_pair()
@@ -3,6 +3,7 @@ import os
 
 from labchain.datastructure.txpool import TxPool
 from labchain.datastructure.transaction import Transaction
+from labchain.workflow.taskTransaction import WorkflowTransaction
 from labchain.util.cryptoHelper import CryptoHelper
 from labchain.datastructure.blockchain import BlockChain
 from labchain.util.configReader import ConfigReader
@@ -155,6 +156,20 @@ class TxPoolTestCase(unittest.TestCase):
         transaction = self._txPoolObj.get_transaction_by_hash(hash_val)[0]
         self.assertEqual(t1, transaction)
 
+    def test_get_typed_transactions(self):
+        """Test listing the task and workflow transactions of the txpool"""
+        self.assertEqual([], self._txPoolObj.get_task_transactions())
+        self.assertEqual([], self._txPoolObj.get_workflow_transactions())
+        payload = {'workflow_id': '1', 'document': {}, 'in_charge': '{}_1'.format(self.public_key2),
+                   'processes': {}, 'permissions': {}, 'previous_transaction': '', 'workflow_transaction': ''}
+        t1 = WorkflowTransaction(self.public_key1, self.public_key2, payload)
+        t1.sign_transaction(self.crypto_helper_obj, self.private_key1)
+        self.assertTrue(self._txPoolObj.add_transaction_if_not_exist(t1, self.blockchain_obj))
+        self.assertEqual([], self._txPoolObj.get_task_transactions())
+        self.assertEqual([t1], self._txPoolObj.get_workflow_transactions())
+        self._txPoolObj.remove_transaction(t1)
+        self.assertEqual([], self._txPoolObj.get_workflow_transactions())
+
 
 if __name__ == '__main__':
     unittest.main()